@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import asyncio
+import os
+
+from winsys._compat import unittest
+
+from winsys import aio
+
+class FakeReader (object):
+
+  def __init__ (self, completions, buffer_size):
+    self.completions = completions
+    self.buffer_size = buffer_size
+    self.n_reads = 0
+    self.cancelled = False
+
+  def start (self):
+    self.n_reads += 1
+    self.completions.buffer_sizes.append (self.buffer_size)
+
+  def cancel (self):
+    self.cancelled = True
+
+  async def changes (self):
+    return await self.completions.changes.get ()
+
+class FakeCompletions (object):
+  """Stand in for Win32Completions: directory changes are whatever has been
+  queued by the test and files are bytearrays.
+  """
+
+  def __init__ (self):
+    self.changes = asyncio.Queue ()
+    self.buffer_sizes = []
+    self.readers = []
+    self.closed = []
+
+  def open_directory (self, root):
+    return root
+
+  def close (self, handle):
+    self.closed.append (handle)
+
+  def directory_reader (self, handle, buffer_size, subdirs, watch_for):
+    self.readers.append (FakeReader (self, buffer_size))
+    return self.readers[-1]
+
+  async def read_at (self, handle, offset, size):
+    await asyncio.sleep (0)
+    return bytes (handle[offset:offset + size])
+
+  async def write_at (self, handle, offset, data):
+    await asyncio.sleep (0)
+    handle[offset:offset + len (data)] = data
+    return len (data)
+
+def run (coroutine):
+  loop = asyncio.new_event_loop ()
+  try:
+    return loop.run_until_complete (coroutine)
+  finally:
+    loop.close ()
+
+class TestAIO (unittest.TestCase):
+
+  def test_watch (self):
+    async def _test ():
+      completions = FakeCompletions ()
+      root = os.path.join ("c:", "temp")
+      watcher = aio.watch (root, completions=completions)
+      completions.changes.put_nowait ([(aio.ADDED, "a"), (aio.RENAMED_OLD_NAME, "b"), (aio.RENAMED_NEW_NAME, "c")])
+      completions.changes.put_nowait ([(aio.REMOVED, "a")])
+      changes = []
+      async for change in watcher:
+        changes.append (change)
+        if len (changes) == 3:
+          break
+      return changes
+    root = os.path.join ("c:", "temp")
+    self.assertEqual (run (_test ()), [
+      (aio.ADDED, None, os.path.join (root, "a")),
+      (aio.RENAMED_NEW_NAME, os.path.join (root, "b"), os.path.join (root, "c")),
+      (aio.REMOVED, os.path.join (root, "a"), None),
+    ])
+
+  def test_watch_overflow_grows_buffer (self):
+    async def _test ():
+      completions = FakeCompletions ()
+      watcher = aio.watch ("root", buffer_size=1024, max_buffer_size=2048, completions=completions)
+      for i in range (3):
+        completions.changes.put_nowait ([])
+      changes = [await watcher.__anext__ () for i in range (3)]
+      return watcher, completions, changes
+    watcher, completions, changes = run (_test ())
+    self.assertEqual (changes, [(aio.OVERFLOWED, None, None)] * 3)
+    self.assertEqual (completions.buffer_sizes, [1024, 2048, 2048, 2048])
+    self.assertEqual ([reader.n_reads for reader in completions.readers], [1, 3])
+    self.assertEqual (completions.closed, ["root"])
+    self.assertEqual (watcher.n_overflows, 3)
+
+  def test_watch_keeps_a_read_in_flight (self):
+    async def _test ():
+      completions = FakeCompletions ()
+      watcher = aio.watch ("root", completions=completions)
+      n_reads = [completions.readers[0].n_reads]
+      completions.changes.put_nowait ([(aio.ADDED, "a"), (aio.ADDED, "b")])
+      await watcher.__anext__ ()
+      n_reads.append (completions.readers[0].n_reads)
+      await watcher.__anext__ ()
+      n_reads.append (completions.readers[0].n_reads)
+      return completions, n_reads
+    completions, n_reads = run (_test ())
+    self.assertEqual (n_reads, [1, 2, 2])
+    self.assertEqual (len (completions.readers), 1)
+
+  def test_close_stops_watcher (self):
+    async def _test ():
+      completions = FakeCompletions ()
+      changes = []
+      async with aio.watch ("root", completions=completions) as watcher:
+        asyncio.get_running_loop ().call_later (0.01, watcher.close)
+        async for change in watcher:
+          changes.append (change)
+      return completions, changes
+    completions, changes = run (_test ())
+    self.assertEqual (changes, [])
+    self.assertEqual (completions.closed, ["root"])
+    self.assertTrue (completions.readers[0].cancelled)
+
+  def test_read_write_at (self):
+    async def _test ():
+      completions = FakeCompletions ()
+      data = bytearray (b"0123456789")
+      n_bytes = await aio.write_at (data, 4, b"abc", completions=completions)
+      return n_bytes, data, await aio.read_at (data, 3, 5, completions=completions), await aio.read_at (data, 8, 5, completions=completions)
+    n_bytes, data, read, tail = run (_test ())
+    self.assertEqual (n_bytes, 3)
+    self.assertEqual (data, bytearray (b"0123abc789"))
+    self.assertEqual (read, b"3abc7")
+    self.assertEqual (tail, b"89")
+
+if __name__ == "__main__":
+  unittest.main ()
@@ -6,6 +6,7 @@ import os, sys
 import glob
 import tempfile
 import threading
+import time
 import uuid
 from winsys._compat import unittest
 
@@ -197,6 +198,36 @@ class TestDir (unittest.TestCase):
     self.assertEqual(set(str(d) for d in dirs), fsutils.dirs_in(filepath))
     self.assertEqual(set(str(f) for f in files), fsutils.files_in(filepath))
 
+  def test_walk_deeper_than_recursion_limit (self):
+    top = fs.dir (fsutils.TEST_ROOT).dir ("deep")
+    depth = sys.getrecursionlimit () + 10
+    deepest = fs.dir (top + fs.sep.join ("x" * depth)).create ()
+    try:
+      dirpaths = [dirpath for dirpath, dirs, files in top.walk (depthfirst=True)]
+      self.assertEqual (len (dirpaths), depth + 1)
+      self.assertEqual (dirpaths[0], deepest)
+    finally:
+      top.delete (recursive=True)
+
+  def test_walk_workers (self):
+    filepath = fsutils.TEST_ROOT
+    self.assertEqual (
+      list (fs.dir (filepath).walk (workers=4)),
+      list (fs.dir (filepath).walk ())
+    )
+
+  def test_walk_workers_unordered (self):
+    filepath = fsutils.TEST_ROOT
+    self.assertEqual (
+      set (dirpath for dirpath, dirs, files in fs.dir (filepath).walk (workers=4, ordered=False)),
+      set (dirpath for dirpath, dirs, files in fs.dir (filepath).walk ())
+    )
+
+  def test_walk_workers_depthfirst_unordered (self):
+    filepath = fsutils.TEST_ROOT
+    dirpaths = [dirpath for dirpath, dirs, files in fs.dir (filepath).walk (depthfirst=True, workers=4, ordered=False)]
+    self.assertEqual (dirpaths[-1], filepath + "\\")
+
   def test_flat (self):
     filepath = fsutils.TEST_ROOT
     self.assertEqual (
@@ -212,6 +243,47 @@ class TestDir (unittest.TestCase):
       fsutils.dirs_in(filepath) | fsutils.files_in(filepath) | fsutils.dirs_in(filepath2) | fsutils.files_in(filepath2)
     )
 
+  def test_flat_records (self):
+    filepath = fsutils.TEST_ROOT
+    records = list (fs.dir (filepath).flat (records=True))
+    self.assertTrue (all (isinstance (r, fs.EntryRecord) for r in records))
+    self.assertEqual (
+      set (str (r) for r in records),
+      set (str (f) for f in fs.dir (filepath).flat ())
+    )
+
+  def test_walk_records (self):
+    filepath = fsutils.TEST_ROOT
+    self.assertEqual (
+      [(str (dirpath), set (str (d) for d in dirs), set (str (f) for f in files)) for dirpath, dirs, files in fs.dir (filepath).walk (records=True)],
+      [(str (dirpath), set (str (d) for d in dirs), set (str (f) for f in files)) for dirpath, dirs, files in fs.dir (filepath).walk ()]
+    )
+
+  def test_flat_filter_size (self):
+    filepath = fsutils.TEST_ROOT
+    with open (os.path.join (filepath, "d", "big"), "wb") as f:
+      f.write (b"x" * 1024)
+    self.assertEqual (
+      [str (f) for f in fs.dir (filepath).flat (min_size=1)],
+      [os.path.join (filepath, "d", "big")]
+    )
+
+  def test_walk_filter_prunes_dirs (self):
+    filepath = fsutils.TEST_ROOT
+    self.assertEqual (
+      [str (dirpath) for dirpath, dirs, files in fs.dir (filepath).walk (filter=fs.Filter (prune_name="^d$"))],
+      [str (dirpath) for dirpath, dirs, files in fs.dir (filepath).walk () if dirpath.name != "d"]
+    )
+
+  def test_record_entry (self):
+    filepath = fsutils.TEST_ROOT
+    for record in fs.dir (filepath).entries (records=True):
+      e = record.entry ()
+      self.assertEqual (e, fs.entry (str (record)))
+      self.assertEqual (isinstance (e, fs.Dir), record.directory)
+      self.assertEqual (e.written_at, fs.entry (str (record)).written_at)
+      self.assertEqual (e.size, record.size)
+
   def test_dir_copy_to_new_dir (self):
     source_name = uuid.uuid1 ().hex
     target_name = uuid.uuid1 ().hex
@@ -259,6 +331,62 @@ class TestDir (unittest.TestCase):
     self.assertEqual (len (callback_result), 10)
     self.assertEqual (callback_result, [(0, 0, callback_data) for i in range (10)])
 
+  def test_copy_tree (self):
+    source = os.path.join (fsutils.TEST_ROOT, "d")
+    target = os.path.join (fsutils.TEST_ROOT, uuid.uuid1 ().hex)
+    summary = fs.copy_tree (source, target, workers=2)
+    self.assertTrue (*fsutils.dirs_are_equal (source, target))
+    self.assertEqual (summary.n_files, len (self.filenames))
+    self.assertEqual (summary.errors, [])
+
+  def test_copy_tree_resumes_from_journal (self):
+    source = os.path.join (fsutils.TEST_ROOT, "d")
+    target = os.path.join (fsutils.TEST_ROOT, uuid.uuid1 ().hex)
+    journal = os.path.join (fsutils.TEST_ROOT, "copy.journal")
+    os.mkdir (target)
+    with open (journal, "w") as f:
+      for filename in self.filenames[:2]:
+        open (os.path.join (target, filename), "w").close ()
+        f.write (filename + "\n")
+    summary = fs.copy_tree (source, target, journal=journal)
+    self.assertTrue (*fsutils.dirs_are_equal (source, target))
+    self.assertEqual ((summary.n_files, summary.n_skipped), (len (self.filenames) - 2, 2))
+    self.assertFalse (os.path.exists (journal))
+
+  def test_sync (self):
+    source = os.path.join (fsutils.TEST_ROOT, "d")
+    target = os.path.join (fsutils.TEST_ROOT, uuid.uuid1 ().hex)
+    report = fs.dir (source).sync (target)
+    self.assertTrue (*fsutils.dirs_are_equal (source, target))
+    self.assertEqual (sorted (report.copied), sorted (self.filenames))
+    with open (os.path.join (source, self.filenames[0]), "w") as f:
+      f.write ("changed")
+    open (os.path.join (target, "extra"), "w").close ()
+    report = fs.dir (source).sync (target, delete_extras=True)
+    self.assertEqual ((report.copied, report.updated, report.deleted), ([], [self.filenames[0]], ["extra"]))
+    self.assertEqual (report.n_unchanged, len (self.filenames) - 1)
+    self.assertTrue (*fsutils.dirs_are_equal (source, target))
+
+  def test_sync_ignores_target_quirks (self):
+    source = os.path.join (fsutils.TEST_ROOT, "d")
+    target = os.path.join (fsutils.TEST_ROOT, uuid.uuid1 ().hex)
+    fs.dir (source).sync (target)
+    for filename in self.filenames:
+      target_filepath = os.path.join (target, filename)
+      win32file.SetFileAttributesW (target_filepath, fs.FILE_ATTRIBUTE.NOT_CONTENT_INDEXED)
+      written_at = os.path.getmtime (target_filepath)
+      os.utime (target_filepath, (written_at, written_at + 1))
+    report = fs.dir (source).sync (target)
+    self.assertEqual ((report.copied, report.updated), ([], []))
+    self.assertEqual (report.n_unchanged, len (self.filenames))
+
+  def test_sync_dry_run (self):
+    source = os.path.join (fsutils.TEST_ROOT, "d")
+    target = os.path.join (fsutils.TEST_ROOT, uuid.uuid1 ().hex)
+    report = fs.dir (source).sync (target, dry_run=True)
+    self.assertEqual (sorted (report.copied), sorted (self.filenames))
+    self.assertFalse (os.path.exists (target))
+
   def test_delete (self):
     filepath = os.path.join (fsutils.TEST_ROOT, "empty")
     self.assertTrue (os.path.exists (filepath))
@@ -272,6 +400,30 @@ class TestDir (unittest.TestCase):
     fs.Dir (filepath).delete (recursive=True)
     self.assertFalse (os.path.exists (filepath))
 
+  def test_delete_tree (self):
+    filepath = os.path.join (fsutils.TEST_ROOT, "d")
+    os.mkdir (os.path.join (filepath, "sub"))
+    readonly = os.path.join (filepath, "sub", "readonly")
+    open (readonly, "w").close ()
+    win32file.SetFileAttributesW (readonly, win32file.FILE_ATTRIBUTE_READONLY)
+    summary = fs.delete_tree (filepath, workers=4)
+    self.assertFalse (os.path.exists (filepath))
+    self.assertEqual ((summary.n_files, summary.n_dirs, summary.errors), (len (self.filenames) + 1, 2, []))
+
+  def test_delete_tree_readonly_root (self):
+    filepath = os.path.join (fsutils.TEST_ROOT, "d")
+    win32file.SetFileAttributesW (filepath, win32file.FILE_ATTRIBUTE_READONLY)
+    summary = fs.delete_tree (filepath)
+    self.assertFalse (os.path.exists (filepath))
+    self.assertEqual (summary.errors, [])
+
+  def test_delete_recursive_fails_fast (self):
+    filepath = os.path.join (fsutils.TEST_ROOT, "d")
+    locked = os.path.join (filepath, self.filenames[0])
+    with open (locked):
+      self.assertRaises (fs.exc.x_winsys, fs.Dir (filepath).delete, recursive=True)
+    self.assertTrue (os.path.exists (filepath))
+
   def test_watch (self):
     filepath = fsutils.TEST_ROOT
     removed_filename = os.path.join (filepath, "1")
@@ -291,6 +443,146 @@ class TestDir (unittest.TestCase):
     self.assertEqual (next (watcher), (fs.FILE_ACTION.RENAMED_NEW_NAME, old_filename, new_filename))
     t.join ()
 
+  def test_watch_batches (self):
+    filepath = fsutils.TEST_ROOT
+    added_filename = os.path.join (filepath, uuid.uuid1 ().hex)
+    def _change_dir ():
+      with open (added_filename, "w") as f:
+        f.write ("x")
+      with open (added_filename, "a") as f:
+        f.write ("y")
+
+    watcher = fs.dir (filepath).watch ()
+    t = threading.Timer (0.5, _change_dir)
+    t.start ()
+    batch = next (watcher.batches (window_ms=500))
+    t.join ()
+    watcher.stop ()
+    self.assertFalse (batch.overflowed)
+    self.assertEqual (batch[0], (fs.FILE_ACTION.ADDED, None, added_filename))
+    self.assertEqual (len ([c for c in batch if c[2] == added_filename]), 1)
+
+  def test_watch_grows_buffer (self):
+    filepath = fsutils.TEST_ROOT
+    def _change_dir ():
+      for i in range (200):
+        open (os.path.join (filepath, "%s-%d" % (uuid.uuid1 ().hex, i)), "w").close ()
+
+    watcher = fs.dir (filepath).watch (buffer_size=1024, max_buffer_size=65536)
+    t = threading.Timer (0.5, _change_dir)
+    t.start ()
+    for batch in watcher.batches (window_ms=500):
+      break
+    t.join ()
+    watcher.stop ()
+    self.assertTrue (watcher.n_reads >= 1)
+    self.assertTrue (watcher.n_grown >= 1)
+    self.assertTrue (1024 < watcher.buffer_size <= 65536)
+
+  def test_watch_group (self):
+    d = os.path.join (fsutils.TEST_ROOT, "d")
+    empty = os.path.join (fsutils.TEST_ROOT, "empty")
+    added_filename = os.path.join (empty, uuid.uuid1 ().hex)
+    def _change_dirs ():
+      os.remove (os.path.join (d, "1"))
+      open (added_filename, "w").close ()
+
+    group = fs.WatchGroup ()
+    group.add (d, tag="d").add (empty, tag="empty")
+    self.assertEqual (len (group.roots ()), 2)
+    t = threading.Timer (0.5, _change_dirs)
+    t.start ()
+    tag, action, old_filename, new_filename = next (group)
+    self.assertEqual ((tag, action, new_filename), ("d", fs.FILE_ACTION.REMOVED, None))
+    group.remove (d)
+    tag, action, old_filename, new_filename = next (group)
+    self.assertEqual ((tag, action, old_filename), ("empty", fs.FILE_ACTION.ADDED, None))
+    self.assertEqual (fs.entry (new_filename), added_filename)
+    t.join ()
+    group.stop ()
+    self.assertEqual (list (group), [])
+
+  def test_watch_group_root_fails (self):
+    doomed = os.path.join (fsutils.TEST_ROOT, "doomed")
+    os.mkdir (doomed)
+    open (os.path.join (doomed, "x"), "w").close ()
+    empty = os.path.join (fsutils.TEST_ROOT, "empty")
+    added_filename = os.path.join (empty, uuid.uuid1 ().hex)
+    def _change_dirs ():
+      fs.dir (doomed).delete (recursive=True)
+      time.sleep (0.5)
+      open (added_filename, "w").close ()
+
+    group = fs.WatchGroup ()
+    group.add (doomed, tag="doomed").add (empty, tag="empty")
+    t = threading.Timer (0.5, _change_dirs)
+    t.start ()
+    safety = threading.Timer (10, group.stop)
+    safety.start ()
+    seen = set ()
+    for tag, action, old_filename, new_filename in group:
+      if action == fs.WatchGroup.ERROR:
+        seen.add ((tag, action))
+      elif tag == "empty" and action == fs.FILE_ACTION.ADDED:
+        seen.add ((tag, action))
+      if len (seen) == 2:
+        break
+    safety.cancel ()
+    t.join ()
+    self.assertEqual (seen, set ([("doomed", fs.WatchGroup.ERROR), ("empty", fs.FILE_ACTION.ADDED)]))
+    self.assertEqual (group.roots (), [fs.dir (empty)])
+    group.stop ()
+
+  def test_snapshot_diff (self):
+    root = fs.dir (fsutils.TEST_ROOT)
+    manifest_dirpath = tempfile.mkdtemp ()
+    try:
+      before = root.snapshot (os.path.join (manifest_dirpath, "before.gz"), hash=True)
+      self.assertEqual (
+        [e.path for e in fs.read_manifest (before)],
+        self.filenames + ["d"] + [os.path.join ("d", f) for f in self.filenames] + ["empty"]
+      )
+      os.remove (os.path.join (fsutils.TEST_ROOT, "d", "1"))
+      with open (os.path.join (fsutils.TEST_ROOT, "2"), "w") as f:
+        f.write ("changed")
+      open (os.path.join (fsutils.TEST_ROOT, "empty", "new"), "w").close ()
+      after = root.snapshot (os.path.join (manifest_dirpath, "after"), hash=True)
+      self.assertEqual (
+        [(action, (new or old).path) for action, old, new in fs.diff (before, after) if not (new or old).directory],
+        [
+          (fs.FILE_ACTION.MODIFIED, "2"),
+          (fs.FILE_ACTION.REMOVED, os.path.join ("d", "1")),
+          (fs.FILE_ACTION.ADDED, os.path.join ("empty", "new")),
+        ]
+      )
+    finally:
+      fs.dir (manifest_dirpath).delete (recursive=True)
+
+  def test_listing_cache (self):
+    filepath = fsutils.TEST_ROOT
+    cache = fs.enable_listing_cache ([filepath])
+    try:
+      first = list (fs.dir (filepath).entries ())
+      self.assertEqual (cache.misses, 1)
+      second = list (fs.dir (filepath).entries ())
+      self.assertEqual (cache.hits, 1)
+      self.assertEqual (first, second)
+    finally:
+      fs.disable_listing_cache ()
+
+  def test_listing_cache_sees_change (self):
+    filepath = fsutils.TEST_ROOT
+    fs.enable_listing_cache ([filepath])
+    try:
+      before = set (fs.dir (filepath).dir ("d").entries ())
+      added_filename = os.path.join (filepath, "d", uuid.uuid1 ().hex)
+      open (added_filename, "w").close ()
+      time.sleep (1)
+      after = set (fs.dir (filepath).dir ("d").entries ())
+      self.assertEqual (after - before, set ([added_filename]))
+    finally:
+      fs.disable_listing_cache ()
+
   def test_zip (self):
     import zipfile
     filepath = fsutils.TEST_ROOT
@@ -303,6 +595,20 @@ class TestDir (unittest.TestCase):
       set (f.relative_to (unzip_filepath) for f in fs.flat (unzip_filepath))
     )
 
+  def test_zip_workers (self):
+    import zipfile
+    filepath = fsutils.TEST_ROOT
+    with open (os.path.join (filepath, "d", "big"), "w") as f:
+      f.write ("abc" * 100000)
+    zipped = fs.dir (filepath).zip (workers=4)
+    self.assertIsNone (zipfile.ZipFile (zipped).testzip ())
+    unzip_filepath = os.path.join (fsutils.TEST_ROOT2)
+    zipped.extract (unzip_filepath, workers=4)
+    self.assertEqual (
+      set (f.relative_to (filepath) for f in fs.flat (filepath)),
+      set (f.relative_to (unzip_filepath) for f in fs.flat (unzip_filepath))
+    )
+
 if __name__ == "__main__":
   unittest.main ()
   if sys.stdout.isatty (): raw_input ("Press enter...")
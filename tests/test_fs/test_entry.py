@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os, sys
+from winsys._compat import unittest
+
+import win32file
+
+from winsys import fs
+from . import utils as fsutils
+
+class TestEntry (unittest.TestCase):
+
+  def setUp (self):
+    fsutils.mktemp ()
+    self.filepath = os.path.join (fsutils.TEST_ROOT, "entry.txt")
+    with open (self.filepath, "w") as f:
+      f.write ("x" * 100)
+
+  def tearDown (self):
+    fs.disable_stat_cache ()
+    fsutils.rmtemp ()
+
+  def test_refresh (self):
+    attributes, created_at, accessed_at, written_at, size = win32file.GetFileAttributesExW (self.filepath)
+    f = fs.File (self.filepath).refresh ()
+    self.assertEqual (f._attributes.flags, attributes)
+    self.assertEqual (f._written_at, written_at)
+    self.assertEqual (f._accessed_at, accessed_at)
+    self.assertEqual (f._size, 100)
+
+  def test_refresh_sees_change (self):
+    f = fs.File (self.filepath)
+    self.assertEqual (f.size, 100)
+    with open (self.filepath, "a") as f0:
+      f0.write ("x")
+    self.assertEqual (f.size, 100)
+    self.assertEqual (f.refresh ().size, 101)
+
+  def test_no_instance_dict (self):
+    for e in fs.File (self.filepath), fs.Dir (fsutils.TEST_ROOT):
+      self.assertFalse (hasattr (e, "__dict__"))
+
+  def test_stat_cache_shared (self):
+    cache = fs.enable_stat_cache ()
+    fs.File (self.filepath).size
+    fs.File (self.filepath).written_at
+    self.assertEqual ((cache.misses, cache.hits), (1, 1))
+
+  def test_stat_cache_invalidated (self):
+    cache = fs.enable_stat_cache ()
+    f = fs.File (self.filepath)
+    self.assertFalse (f.readonly)
+    f.readonly = True
+    try:
+      self.assertTrue (fs.File (self.filepath).readonly)
+    finally:
+      f.readonly = False
+
+  def test_stat_cache_invalidated_beneath (self):
+    cache = fs.enable_stat_cache ()
+    for key in ["c:\\a", "c:\\a\\b", "c:\\a\\b\\c", "c:\\ab"]:
+      cache.put (key, key)
+    cache.invalidate ("c:\\a", beneath=True)
+    self.assertEqual (len (cache), 1)
+    self.assertEqual (cache.get ("c:\\ab"), "c:\\ab")
+
+  def test_stat_cache_dir_move (self):
+    cache = fs.enable_stat_cache ()
+    os.mkdir (os.path.join (fsutils.TEST_ROOT, "d"))
+    filepath = os.path.join (fsutils.TEST_ROOT, "d", "f.txt")
+    open (filepath, "w").close ()
+    fs.File (filepath).size
+    fs.Dir (os.path.join (fsutils.TEST_ROOT, "d")).move (os.path.join (fsutils.TEST_ROOT, "e"))
+    self.assertRaises (fs.x_no_such_file, getattr, fs.File (filepath), "size")
+
+  def test_stat_cache_expires (self):
+    cache = fs.enable_stat_cache (ttl_secs=0)
+    fs.File (self.filepath).size
+    fs.File (self.filepath).size
+    self.assertEqual (cache.hits, 0)
+
+  def test_stat_cache_max_entries (self):
+    cache = fs.enable_stat_cache (max_entries=2)
+    for i in range (3):
+      cache.put ("%d" % i, i)
+    self.assertEqual (len (cache), 2)
+    self.assertIsNone (cache.get ("0"))
+    self.assertEqual (cache.get ("2"), 2)
+
+if __name__ == "__main__":
+  unittest.main ()
+  if sys.stdout.isatty (): raw_input ("Press enter...")
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os, sys
+import io
+import zipfile
+from winsys._compat import unittest
+
+from winsys import fs
+from . import utils as fsutils
+
+class TestFile (unittest.TestCase):
+
+  def setUp (self):
+    fsutils.mktemp ()
+    self.filepath = os.path.join (fsutils.TEST_ROOT, "file.txt")
+    self.contents = b"".join (b"line %d\r\n" % i for i in range (10000))
+    with open (self.filepath, "wb") as f:
+      f.write (self.contents)
+
+  def tearDown (self):
+    fsutils.rmtemp ()
+
+  def test_chunks (self):
+    chunks = list (fs.file (self.filepath).chunks (1000))
+    self.assertTrue (all (len (chunk) <= 1000 for chunk in chunks))
+    self.assertEqual (b"".join (chunks), self.contents)
+
+  def test_lines (self):
+    self.assertEqual (list (fs.file (self.filepath).lines ()), self.contents.splitlines (True))
+    self.assertEqual (
+      list (fs.file (self.filepath).lines (encoding="ascii")),
+      [line + "\n" for line in self.contents.decode ("ascii").splitlines ()]
+    )
+
+  def test_mmap (self):
+    with fs.file (self.filepath).mmap () as view:
+      self.assertEqual (len (view), len (self.contents))
+      self.assertEqual (view[:6].tobytes (), self.contents[:6])
+
+  def test_mmap_empty (self):
+    filepath = os.path.join (fsutils.TEST_ROOT, "empty.txt")
+    open (filepath, "wb").close ()
+    with fs.file (filepath).mmap () as view:
+      self.assertEqual (len (view), 0)
+
+  def test_copy_to (self):
+    target = io.BytesIO ()
+    self.assertEqual (fs.file (self.filepath).copy_to (target, buffer_size=4096), len (self.contents))
+    self.assertEqual (target.getvalue (), self.contents)
+
+  def test_unzip_streaming (self):
+    zip_filepath = os.path.join (fsutils.TEST_ROOT, "file.zip")
+    with zipfile.ZipFile (zip_filepath, "w") as zf:
+      zf.write (self.filepath, "file.txt")
+    for name, f in fs.file (zip_filepath).unzip (streaming=True):
+      target = io.BytesIO ()
+      fs.stream_copy (f, target)
+      self.assertEqual ((name, target.getvalue ()), ("file.txt", self.contents))
+
+  def test_unzip_streaming_closed_early (self):
+    zip_filepath = os.path.join (fsutils.TEST_ROOT, "file.zip")
+    with zipfile.ZipFile (zip_filepath, "w") as zf:
+      zf.write (self.filepath, "file1.txt")
+      zf.write (self.filepath, "file2.txt")
+    members = fs.file (zip_filepath).unzip (streaming=True)
+    name, f = next (members)
+    members.close ()
+    self.assertEqual (name, "file1.txt")
+    self.assertTrue (f.closed)
+
+  def test_extract_workers_stays_in_target (self):
+    zip_filepath = os.path.join (fsutils.TEST_ROOT, "file.zip")
+    with zipfile.ZipFile (zip_filepath, "w") as zf:
+      zf.write (self.filepath, "../../escaped/file.txt")
+    target = fs.file (zip_filepath).extract (os.path.join (fsutils.TEST_ROOT, "target"), workers=2)
+    self.assertFalse (os.path.exists (os.path.join (fsutils.TEST_ROOT, "escaped")))
+    self.assertFalse (os.path.exists (os.path.join (os.path.dirname (fsutils.TEST_ROOT), "escaped")))
+    self.assertTrue (os.path.exists (os.path.join (target, "escaped", "file.txt")))
+
+if __name__ == "__main__":
+  unittest.main ()
+  if sys.stdout.isatty (): raw_input ("Press enter...")
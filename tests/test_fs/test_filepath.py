@@ -121,6 +121,12 @@ class TestFilepath (unittest.TestCase):
             "Path: %s; Part %s; expected: %s; result: %s" % (path, test_item, result, getattr (fp, test_item))
           )
 
+  def test_derived_parts (self):
+    for path in [r"\\a\b\c\d.txt", r"c:\boot.ini", r"c:\t", r"c:\t\a.txt", r"c:\t\s\a.txt", "c:a.txt", "a.txt", r"s\a.txt"]:
+      fp = fs.filepath (path)
+      for derived in [fp.root, fp.path] + ([] if fp.is_relative () else [fp.parent]):
+        self.assertEqual (derived.parts, fs.get_parts (derived), "Path: %s; derived: %s" % (path, derived))
+
   #
   # Concatenation
   #
@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 
 import os, sys
 import tempfile
+import time
 from winsys._compat import unittest
 import uuid
 
@@ -29,12 +30,134 @@ class TestFS (unittest.TestCase):
     pattern = os.path.join (fsutils.TEST_ROOT, "*")
     self.assertEqual (list (fs.glob (pattern)), glob.glob (pattern))
 
+  def test_glob_recursive (self):
+    for dirpath in ["a/x", "b/y/x", "c"]:
+      os.makedirs (os.path.join (fsutils.TEST_ROOT, dirpath))
+      for filename in ["1.log", "2.txt", "3.dat"]:
+        open (os.path.join (fsutils.TEST_ROOT, dirpath, filename), "w").close ()
+    self.assertEqual (
+      set (str (f) for f in fs.glob (os.path.join (fsutils.TEST_ROOT, "**", "x", "*.{log,txt}"))),
+      set (os.path.join (fsutils.TEST_ROOT, dirpath, filename) for dirpath in ["a\\x", "b\\y\\x"] for filename in ["1.log", "2.txt"])
+    )
+
+  def test_glob_literal_brackets (self):
+    for filename in ["a[1].txt", "a1.txt", "b[1]c.log"]:
+      open (os.path.join (fsutils.TEST_ROOT, filename), "w").close ()
+    self.assertEqual ([f.name for f in fs.glob (os.path.join (fsutils.TEST_ROOT, "a[1].txt"))], ["a[1].txt"])
+    self.assertEqual ([f.name for f in fs.glob (os.path.join (fsutils.TEST_ROOT, "a[12].txt"))], ["a1.txt"])
+    self.assertEqual ([f.name for f in fs.glob (os.path.join (fsutils.TEST_ROOT, "b[1]*"))], ["b[1]c.log"])
+
   def test_listdir (self):
     import os
     fs_version = list (fs.listdir (fsutils.TEST_ROOT))
     os_version = os.listdir (fsutils.TEST_ROOT)
     self.assertEqual (fs_version, os_version, "%s differs from %s" % (fs_version, os_version))
 
+  def test_files_several_patterns (self):
+    pattern = "|".join (os.path.join (fsutils.TEST_ROOT, p) for p in ["1", "3", "1*"])
+    self.assertEqual (
+      [f.name for f in fs.files (pattern)],
+      ["1", "3"]
+    )
+
+  def test_files_several_patterns_windows_wildcards (self):
+    pattern = "|".join (os.path.join (fsutils.TEST_ROOT, p) for p in ["*.*", "1"])
+    self.assertEqual (
+      sorted (f.name for f in fs.files (pattern)),
+      self.filenames
+    )
+
+  def test_matcher (self):
+    m = fs.matcher ("*.TXT|a?")
+    self.assertIs (fs.matcher ("*.TXT|a?"), m)
+    self.assertIs (fs.matcher (m), m)
+    self.assertTrue (m.match ("x.txt"))
+    self.assertTrue (m.match ("ab"))
+    self.assertFalse (m.match ("abc"))
+
+  def test_duplicates (self):
+    for filename, contents in [("a", "abc"), ("b", "abc"), ("c", "abd"), ("d", "abc" * 100000), ("e", "abc" * 100000)]:
+      with open (os.path.join (fsutils.TEST_ROOT, filename), "w") as f:
+        f.write (contents)
+    self.assertEqual (
+      sorted ([f.name for f in files] for files in fs.duplicates (fsutils.TEST_ROOT)),
+      [["a", "b"], ["d", "e"]]
+    )
+
+  def test_duplicates_skips_hard_links (self):
+    for filename in ["a", "c"]:
+      with open (os.path.join (fsutils.TEST_ROOT, filename), "w") as f:
+        f.write ("abc")
+    os.link (os.path.join (fsutils.TEST_ROOT, "a"), os.path.join (fsutils.TEST_ROOT, "b"))
+    self.assertEqual (
+      [[f.name for f in files] for files in fs.duplicates (fsutils.TEST_ROOT)],
+      [["a", "c"]]
+    )
+
+  def test_inventory (self):
+    inv = fs.inventory (fsutils.TEST_ROOT)
+    self.assertEqual (len (inv), len (self.filenames))
+    self.assertEqual (
+      set (inv.filepaths ()),
+      set (os.path.join (fsutils.TEST_ROOT, filename) for filename in self.filenames)
+    )
+    self.assertEqual (sum (inv.sizes), 0)
+    self.assertEqual (inv.size_by_ext (), {"" : 0})
+
+  def test_catalogue (self):
+    with open (os.path.join (fsutils.TEST_ROOT, "big.dat"), "wb") as f:
+      f.write (b"x" * 1000)
+    os.mkdir (os.path.join (fsutils.TEST_ROOT, "sub"))
+    open (os.path.join (fsutils.TEST_ROOT, "sub", "notes.txt"), "w").close ()
+    with fs.Catalogue (":memory:") as catalogue:
+      catalogue.add_root (fsutils.TEST_ROOT)
+      self.assertEqual (len (list (catalogue.query ())), len (self.filenames) + 2)
+      self.assertEqual ([r.name for r in catalogue.query (min_size=1)], ["big.dat"])
+      self.assertEqual ([r.name for r in catalogue.query ("*.TXT")], ["notes.txt"])
+      self.assertEqual ([r.name for r in catalogue.query (under=os.path.join (fsutils.TEST_ROOT, "sub"))], ["notes.txt"])
+
+      removed_filename = os.path.join (fsutils.TEST_ROOT, "big.dat")
+      added_filename = os.path.join (fsutils.TEST_ROOT, "sub", "new.txt")
+      os.remove (removed_filename)
+      open (added_filename, "w").close ()
+      catalogue.update ([
+        (fs.FILE_ACTION.REMOVED, removed_filename, None),
+        (fs.FILE_ACTION.ADDED, None, added_filename),
+      ])
+      self.assertEqual (list (catalogue.query ("big.dat")), [])
+      self.assertEqual (sorted (r.name for r in catalogue.query ("*.txt")), ["new.txt", "notes.txt"])
+
+  def test_catalogue_multi_dot_pattern (self):
+    for filename in ["logs.tar.gz", "logs.gz", "logs.tar"]:
+      open (os.path.join (fsutils.TEST_ROOT, filename), "w").close ()
+    with fs.Catalogue (":memory:") as catalogue:
+      catalogue.add_root (fsutils.TEST_ROOT)
+      self.assertEqual ([r.name for r in catalogue.query ("*.tar.gz")], ["logs.tar.gz"])
+      self.assertEqual (sorted (r.name for r in catalogue.query ("*.gz")), ["logs.gz", "logs.tar.gz"])
+
+  def test_top_files (self):
+    os.mkdir (os.path.join (fsutils.TEST_ROOT, "sub"))
+    for filename, size in [("a", 10), ("b", 30), (os.path.join ("sub", "c"), 20), (os.path.join ("sub", "d"), 40)]:
+      with open (os.path.join (fsutils.TEST_ROOT, filename), "wb") as f:
+        f.write (b"x" * size)
+    self.assertEqual ([(f.name, f.size) for f in fs.top_files (fsutils.TEST_ROOT, 3)], [("d", 40), ("b", 30), ("c", 20)])
+    self.assertEqual ([f.name for f in fs.top_files (fsutils.TEST_ROOT, 2, max_size=35)], ["b", "c"])
+
+    top = fs.watch_top_files (fsutils.TEST_ROOT, 1)
+    deadline = time.time () + 10
+    while top.n_scans == 0 and time.time () < deadline:
+      time.sleep (0.1)
+    top.stop ()
+    self.assertFalse (top.is_alive ())
+    self.assertEqual ([f.name for f in top.files ()], ["d"])
+    removed_filename = os.path.join (fsutils.TEST_ROOT, "sub", "d")
+    os.remove (removed_filename)
+    top.update ([(fs.FILE_ACTION.REMOVED, removed_filename, None)])
+    self.assertEqual ([f.name for f in top.files ()], ["b"])
+    os.remove (os.path.join (fsutils.TEST_ROOT, "b"))
+    top.update ([(fs.FILE_ACTION.REMOVED, os.path.join (fsutils.TEST_ROOT, "b"), None)])
+    self.assertEqual ([f.name for f in top.files ()], ["c"])
+
 #
 # All the other module-level functions are hand-offs
 # to the corresponding Entry methods.
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import struct
+
+from winsys._compat import unittest
+
+from winsys import _usn
+
+def buffer(next_value, *records):
+    return struct.pack("<q", next_value) + b"".join(records)
+
+class TestUsn(unittest.TestCase):
+
+    def test_journal_data(self):
+        data = struct.pack("<QqqqqQQ", 0x1234, 100, 900, 0, 2 ** 62, 32 * 1024 * 1024, 4 * 1024 * 1024)
+        journal_data = _usn.journal_data(data + b"\x00" * 24)
+        self.assertEqual(journal_data.journal_id, 0x1234)
+        self.assertEqual(journal_data.first_usn, 100)
+        self.assertEqual(journal_data.next_usn, 900)
+
+    def test_read_journal_data(self):
+        data = _usn.read_journal_data(500, 0xffffffff, 0x1234, bytes_to_wait_for=1)
+        self.assertEqual(len(data), 40)
+        self.assertEqual(struct.unpack("<qLLQQQ", data), (500, 0xffffffff, 0, 0, 1, 0x1234))
+
+    def test_records(self):
+        data = buffer(
+            1200,
+            _usn.pack_record(1000, 0x10000000000021, 0x5000000000005, 130000000000000000, 0x100, 0x20, "a.txt"),
+            _usn.pack_record(1088, 0x10000000000022, 0x5000000000005, 130000000000000001, 0x80000200, 0x10, "directory with a long name")
+        )
+        self.assertEqual(_usn.next_value(data), 1200)
+        records = list(_usn.records(data))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0], _usn.UsnRecord(1000, 0x10000000000021, 0x5000000000005, 130000000000000000, 0x100, 0, 0, 0x20, "a.txt"))
+        self.assertEqual(records[1].name, "directory with a long name")
+        self.assertEqual(records[1].reason, 0x80000200)
+
+    def test_records_aligned(self):
+        for name in ["a", "ab", "abc", "abcd"]:
+            self.assertEqual(len(_usn.pack_record(0, 0, 0, 0, 0, 0, name)) % 8, 0)
+
+    def test_records_v3(self):
+        name = "ref.txt".encode("utf-16-le")
+        length = 76 + len(name)
+        record = struct.pack(
+            "<LHHQQQQqqLLLLHH", length, 3, 0,
+            1, 2, 3, 4,
+            42, 7, 0x2, 0, 0, 0x20, len(name), 76
+        ) + name
+        records = list(_usn.records(buffer(50, record)))
+        self.assertEqual(records[0].file_reference, 1 | (2 << 64))
+        self.assertEqual(records[0].parent_reference, 3 | (4 << 64))
+        self.assertEqual(records[0].usn, 42)
+        self.assertEqual(records[0].name, "ref.txt")
+
+    def test_records_skips_unknown_versions(self):
+        v4 = struct.pack("<LHH", 16, 4, 0) + b"\x00" * 8
+        data = buffer(0, v4, _usn.pack_record(7, 1, 2, 0, 0, 0, "x"))
+        self.assertEqual([r.name for r in _usn.records(data)], ["x"])
+
+    def test_records_n_bytes(self):
+        data = buffer(0, _usn.pack_record(7, 1, 2, 0, 0, 0, "x")) + b"\xff" * 64
+        self.assertEqual(len(list(_usn.records(bytearray(data), len(data) - 64))), 1)
+
+    def test_no_records(self):
+        self.assertEqual(list(_usn.records(buffer(99))), [])
+
+def reference(record_number, sequence_number=1):
+    return record_number | (sequence_number << 48)
+
+ROOT = os.path.join("c:", os.sep)
+DIRECTORY = 0x10
+#
+# As returned by FSCTL_ENUM_USN_DATA in two reads, the second out of
+# record order, with one entry in a metadata directory which isn't listed.
+#
+ENUM_BUFFERS = [
+    buffer(
+        reference(40),
+        _usn.pack_record(0, reference(5, 5), reference(5, 5), 0, 0, DIRECTORY, "."),
+        _usn.pack_record(0, reference(30), reference(5, 5), 0, 0, DIRECTORY, "Users"),
+        _usn.pack_record(0, reference(31, 2), reference(30), 0, 0, DIRECTORY, "tim"),
+        _usn.pack_record(0, reference(32), reference(31, 2), 0, 0, 0x20, "notes.TXT"),
+    ),
+    buffer(
+        reference(99),
+        _usn.pack_record(0, reference(45), reference(31, 2), 0, 0, 0x20, "photo.jpg"),
+        _usn.pack_record(0, reference(41), reference(5, 5), 0, 0, 0x20, "notes.txt"),
+        _usn.pack_record(0, reference(42), reference(11), 0, 0, 0x20, "$Secure"),
+    ),
+]
+
+class TestVolumeIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = _usn.VolumeIndex(ROOT)
+        start = 0
+        for data in ENUM_BUFFERS:
+            start = self.index.add_buffer(data)
+        self.start = start
+
+    def test_add_buffer(self):
+        self.assertEqual(self.start, reference(99))
+        self.assertEqual(len(self.index), 7)
+
+    def test_paths(self):
+        self.assertEqual(sorted(self.index), sorted([
+            ROOT,
+            os.path.join(ROOT, "Users"),
+            os.path.join(ROOT, "Users", "tim"),
+            os.path.join(ROOT, "Users", "tim", "notes.TXT"),
+            os.path.join(ROOT, "Users", "tim", "photo.jpg"),
+            os.path.join(ROOT, "notes.txt"),
+        ]))
+
+    def test_named(self):
+        self.assertEqual(sorted(self.index.named("NOTES.txt")), sorted([
+            os.path.join(ROOT, "Users", "tim", "notes.TXT"),
+            os.path.join(ROOT, "notes.txt"),
+        ]))
+        self.assertEqual(list(self.index.named("missing")), [])
+
+    def test_with_extension(self):
+        self.assertEqual(sorted(self.index.with_extension("txt")), sorted([
+            os.path.join(ROOT, "Users", "tim", "notes.TXT"),
+            os.path.join(ROOT, "notes.txt"),
+        ]))
+        self.assertEqual(list(self.index.with_extension(".jpg")), [os.path.join(ROOT, "Users", "tim", "photo.jpg")])
+
+    def test_in_directory(self):
+        self.assertEqual(sorted(self.index.in_directory("users/TIM")), sorted([
+            os.path.join(ROOT, "Users", "tim", "notes.TXT"),
+            os.path.join(ROOT, "Users", "tim", "photo.jpg"),
+        ]))
+        self.assertEqual(sorted(self.index.in_directory("")), sorted([
+            os.path.join(ROOT, "Users"),
+            os.path.join(ROOT, "notes.txt"),
+        ]))
+        self.assertEqual(list(self.index.in_directory("nowhere")), [])
+
+    def test_dirpath(self):
+        self.assertEqual(self.index.dirpath(reference(31, 2)), os.path.join(ROOT, "Users", "tim"))
+        self.assertEqual(self.index.dirpath(reference(11)), None)
+
+    def test_dirpath_stale_reference(self):
+        self.assertEqual(self.index.dirpath(reference(31, 1)), None)
+        self.assertEqual(self.index.dirpath(reference(31, 2)), os.path.join(ROOT, "Users", "tim"))
+
+    def test_dirpath_cycle(self):
+        index = _usn.VolumeIndex(ROOT)
+        index.add_buffer(buffer(
+            reference(99),
+            _usn.pack_record(0, reference(50), reference(51), 0, 0, DIRECTORY, "a"),
+            _usn.pack_record(0, reference(51), reference(50), 0, 0, DIRECTORY, "b"),
+            _usn.pack_record(0, reference(52), reference(51), 0, 0, 0x20, "c.txt"),
+        ))
+        self.assertEqual(index.dirpath(reference(50)), None)
+        self.assertEqual(list(index), [])
+
+if __name__ == "__main__":
+    unittest.main()
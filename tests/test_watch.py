@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+
+from winsys._compat import unittest
+
+from winsys import _watch
+
+class TestWatch (unittest.TestCase):
+
+  def test_changes (self):
+    root = os.path.join ("c:", "temp")
+    raw_changes = [
+      (_watch.ADDED, "a"),
+      (_watch.MODIFIED, "a"),
+      (_watch.RENAMED_OLD_NAME, "a"),
+      (_watch.RENAMED_NEW_NAME, "b"),
+      (_watch.REMOVED, "b"),
+    ]
+    self.assertEqual (list (_watch.changes (root, raw_changes)), [
+      (_watch.ADDED, None, os.path.join (root, "a")),
+      (_watch.MODIFIED, os.path.join (root, "a"), os.path.join (root, "a")),
+      (_watch.RENAMED_NEW_NAME, os.path.join (root, "a"), os.path.join (root, "b")),
+      (_watch.REMOVED, os.path.join (root, "b"), None),
+    ])
+
+  def test_changes_ignores_unknown_actions (self):
+    self.assertEqual (list (_watch.changes ("root", [(99, "a")])), [])
+
+  def test_changes_unpaired_new_name (self):
+    self.assertEqual (
+      list (_watch.changes ("root", [(_watch.RENAMED_NEW_NAME, "b")])),
+      [(_watch.RENAMED_NEW_NAME, None, os.path.join ("root", "b"))]
+    )
+
+if __name__ == "__main__":
+  unittest.main ()
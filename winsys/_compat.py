@@ -23,6 +23,11 @@ try:
 except NameError:
     long = int
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 import unittest as unittest0
 try:
   unittest0.skipUnless
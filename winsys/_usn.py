@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""Pack and unpack the structures used to read an NTFS / ReFS change journal.
+
+The buffers returned by FSCTL_READ_USN_JOURNAL and FSCTL_ENUM_USN_DATA
+start with a 64-bit value -- the next USN or file reference number to
+ask for -- and are followed by variable-length USN_RECORD_V2 or _V3
+structures. Each record is unpacked in place from a memoryview over the
+buffer by one precompiled :class:`struct.Struct`; only the filename is
+copied out. :class:`VolumeIndex` holds what an enumeration of the MFT
+returns compactly enough for a volume with millions of files.
+
+NB This module *MUST NOT* import any Windows-specific modules so that
+it can be tested against recorded buffers anywhere.
+"""
+from __future__ import unicode_literals
+
+import array
+import collections
+import os
+import struct
+
+#
+# USN_JOURNAL_DATA_V0
+#
+JOURNAL_DATA = struct.Struct("<QqqqqQQ")
+JournalData = collections.namedtuple(
+    "JournalData",
+    "journal_id first_usn next_usn lowest_valid_usn max_usn maximum_size allocation_delta"
+)
+#
+# READ_USN_JOURNAL_DATA_V0
+#
+READ_JOURNAL_DATA = struct.Struct("<qLLQQQ")
+#
+# MFT_ENUM_DATA_V0
+#
+MFT_ENUM_DATA = struct.Struct("<Qqq")
+
+_NEXT = struct.Struct("<q")
+_HEADER = struct.Struct("<LHH")
+_RECORD_V2 = struct.Struct("<LHHQQqqLLLLHH")
+_RECORD_V3 = struct.Struct("<LHHQQQQqqLLLLHH")
+
+UsnRecord = collections.namedtuple(
+    "UsnRecord",
+    "usn file_reference parent_reference timestamp reason source_info security_id attributes name"
+)
+
+def journal_data(buffer):
+    """Unpack the USN_JOURNAL_DATA returned by FSCTL_QUERY_USN_JOURNAL
+    """
+    return JournalData(*JOURNAL_DATA.unpack_from(buffer, 0))
+
+def read_journal_data(start_usn, reason_mask, journal_id, return_only_on_close=False, timeout=0, bytes_to_wait_for=0):
+    """Pack a READ_USN_JOURNAL_DATA to pass to FSCTL_READ_USN_JOURNAL
+    """
+    return READ_JOURNAL_DATA.pack(
+        start_usn, reason_mask, 1 if return_only_on_close else 0, timeout, bytes_to_wait_for, journal_id
+    )
+
+def mft_enum_data(start_file_reference=0, low_usn=0, high_usn=0x7fffffffffffffff):
+    """Pack an MFT_ENUM_DATA to pass to FSCTL_ENUM_USN_DATA
+    """
+    return MFT_ENUM_DATA.pack(start_file_reference, low_usn, high_usn)
+
+def next_value(buffer):
+    """Return the USN or file reference number at the start of a buffer
+    returned by FSCTL_READ_USN_JOURNAL or FSCTL_ENUM_USN_DATA from which
+    the next read should start
+    """
+    return _NEXT.unpack_from(buffer, 0)[0]
+
+def records(buffer, n_bytes=None):
+    """Generate a :class:`UsnRecord` for each USN_RECORD_V2 or _V3 in a
+    buffer returned by FSCTL_READ_USN_JOURNAL or FSCTL_ENUM_USN_DATA.
+    Records of any other version, eg the range-tracking USN_RECORD_V4,
+    are skipped. Version 3 file references are 128-bit integers.
+
+    :param buffer: anything supporting the buffer interface
+    :param n_bytes: how much of the buffer was filled [all of it]
+    """
+    view = memoryview(buffer)
+    end = len(view) if n_bytes is None else n_bytes
+    offset = _NEXT.size
+    unpack_header = _HEADER.unpack_from
+    unpack_v2 = _RECORD_V2.unpack_from
+    unpack_v3 = _RECORD_V3.unpack_from
+    while offset + _HEADER.size <= end:
+        length, major_version, minor_version = unpack_header(view, offset)
+        if length < _HEADER.size or offset + length > end:
+            break
+        if major_version == 2:
+            (
+                length, major_version, minor_version,
+                file_reference, parent_reference,
+                usn, timestamp, reason, source_info, security_id, attributes,
+                name_length, name_offset
+            ) = unpack_v2(view, offset)
+        elif major_version == 3:
+            (
+                length, major_version, minor_version,
+                file_reference_lo, file_reference_hi, parent_reference_lo, parent_reference_hi,
+                usn, timestamp, reason, source_info, security_id, attributes,
+                name_length, name_offset
+            ) = unpack_v3(view, offset)
+            file_reference = file_reference_lo | (file_reference_hi << 64)
+            parent_reference = parent_reference_lo | (parent_reference_hi << 64)
+        else:
+            offset += length
+            continue
+        start = offset + name_offset
+        name = view[start:start + name_length].tobytes().decode("utf-16-le")
+        yield UsnRecord(
+            usn, file_reference, parent_reference, timestamp,
+            reason, source_info, security_id, attributes, name
+        )
+        offset += length
+
+def pack_record(usn, file_reference, parent_reference, timestamp, reason, attributes, name, source_info=0, security_id=0):
+    """Pack a USN_RECORD_V2, 8-byte aligned, as the filesystem would. Mostly
+    useful for building buffers to test against.
+    """
+    encoded_name = name.encode("utf-16-le")
+    length = _RECORD_V2.size + len(encoded_name)
+    length += -length % 8
+    return _RECORD_V2.pack(
+        length, 2, 0, file_reference, parent_reference,
+        usn, timestamp, reason, source_info, security_id, attributes,
+        len(encoded_name), _RECORD_V2.size
+    ) + encoded_name + b"\x00" * (length - _RECORD_V2.size - len(encoded_name))
+
+def _equal_range(rows, key, value):
+    """Return the slice of rows -- sorted by key -- whose key is value
+    """
+    lo, hi = 0, len(rows)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key(rows[mid]) < value:
+            lo = mid + 1
+        else:
+            hi = mid
+    start, hi = lo, len(rows)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if value < key(rows[mid]):
+            hi = mid
+        else:
+            lo = mid + 1
+    return rows[start:lo]
+
+class VolumeIndex(object):
+    """Every file and directory on a volume as enumerated from its master
+    file table by FSCTL_ENUM_USN_DATA, held in parallel arrays of MFT record
+    numbers, sequence numbers, parent file reference numbers, attributes and
+    names. Full paths are only built when asked for, by walking up through
+    the parents; directory paths are remembered as they're built.
+
+    Lookups by name, extension and directory each sort an array of row numbers
+    the first time they're used; names and extensions are matched without regard
+    to case.
+    """
+
+    #
+    # The low 48 bits of a file reference number are its MFT record number;
+    # the high 16 are a sequence number which changes when the record is reused.
+    #
+    RECORD_MASK = 0xFFFFFFFFFFFF
+    SEQUENCE_SHIFT = 48
+    ROOT_RECORD = 5
+
+    def __init__(self, root=""):
+        self.root = root
+        self.names = []
+        self._records = array.array(str("Q"))
+        self._sequences = array.array(str("H"))
+        self._parents = array.array(str("Q"))
+        self._attributes = array.array(str("L"))
+        self._in_order = True
+        self._sorted_rows = {}
+        self._dirpaths = {}
+
+    def __repr__(self):
+        return "<%s of %d entries under %s>" % (self.__class__.__name__, len(self), self.root)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, usn_records):
+        """Add the :class:`UsnRecord` objects in usn_records to the index
+        """
+        last_record = self._records[-1] if self._records else -1
+        for record in usn_records:
+            record_number = record.file_reference & self.RECORD_MASK
+            if record_number < last_record:
+                self._in_order = False
+            last_record = record_number
+            self._records.append(record_number)
+            self._sequences.append(record.file_reference >> self.SEQUENCE_SHIFT)
+            self._parents.append(record.parent_reference)
+            self._attributes.append(record.attributes)
+            self.names.append(record.name)
+        self._sorted_rows.clear()
+        self._dirpaths.clear()
+
+    def add_buffer(self, buffer, n_bytes=None):
+        """Add the records in a buffer returned by FSCTL_ENUM_USN_DATA
+
+        :returns: the file reference number from which to continue the enumeration
+        """
+        self.add(records(buffer, n_bytes))
+        return next_value(buffer)
+
+    def _put_in_order(self):
+        #
+        # The MFT is enumerated in record order, so this is only needed
+        # if records have been added out of order.
+        #
+        if not self._in_order:
+            rows = sorted(range(len(self)), key=self._records.__getitem__)
+            self._records = array.array(str("Q"), (self._records[row] for row in rows))
+            self._sequences = array.array(str("H"), (self._sequences[row] for row in rows))
+            self._parents = array.array(str("Q"), (self._parents[row] for row in rows))
+            self._attributes = array.array(str("L"), (self._attributes[row] for row in rows))
+            self.names = [self.names[row] for row in rows]
+            self._in_order = True
+
+    def _row(self, record_number):
+        self._put_in_order()
+        records = self._records
+        lo, hi = 0, len(records)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if records[mid] < record_number:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(records) and records[lo] == record_number:
+            return lo
+        return None
+
+    def _rows_by(self, name, key):
+        rows = self._sorted_rows.get(name)
+        if rows is None:
+            self._put_in_order()
+            rows = self._sorted_rows[name] = array.array(str("L"), sorted(range(len(self)), key=key))
+        return rows
+
+    def _name_key(self, row):
+        return self.names[row].lower()
+
+    def _ext_key(self, row):
+        name = self.names[row]
+        dot = name.rfind(".")
+        return name[dot:].lower() if dot > 0 else ""
+
+    def _parent_key(self, row):
+        return self._parents[row] & self.RECORD_MASK
+
+    def _row_for(self, file_reference):
+        """Return the row of the entry whose file reference number is
+        file_reference, or None if there isn't one or its MFT record has
+        been reused since. A sequence number of 0 matches any.
+        """
+        row = self._row(file_reference & self.RECORD_MASK)
+        if row is None:
+            return None
+        sequence_number = file_reference >> self.SEQUENCE_SHIFT
+        if sequence_number and sequence_number != self._sequences[row]:
+            return None
+        return row
+
+    def _dirpath(self, file_reference):
+        #
+        # Walk up through the parents until a directory whose path is
+        # known, then remember the path of each one on the way back down.
+        # A damaged or changing MFT could have a directory among its own
+        # ancestors, so a loop gives up rather than go round for ever.
+        #
+        rows = []
+        seen = set()
+        while True:
+            record_number = file_reference & self.RECORD_MASK
+            if record_number == self.ROOT_RECORD:
+                dirpath = self.root
+                break
+            dirpath = self._dirpaths.get(file_reference)
+            if dirpath is not None:
+                break
+            if record_number in seen:
+                return None
+            seen.add(record_number)
+            row = self._row_for(file_reference)
+            if row is None:
+                return None
+            rows.append((file_reference, row))
+            file_reference = self._parents[row]
+        for file_reference, row in reversed(rows):
+            dirpath = self._dirpaths[file_reference] = os.path.join(dirpath, self.names[row])
+        return dirpath
+
+    def path(self, row):
+        """Return the full path of the entry in row, or None if it is not
+        beneath the root, eg because it is a metadata file
+        """
+        self._put_in_order()
+        if self._records[row] == self.ROOT_RECORD:
+            return self.root
+        dirpath = self._dirpath(self._parents[row])
+        if dirpath is None:
+            return None
+        return os.path.join(dirpath, self.names[row])
+
+    def dirpath(self, file_reference):
+        """Return the full path of the directory whose file reference number
+        is file_reference, eg the parent_reference of a change journal record,
+        or None if it isn't in the index or its MFT record has been reused
+        """
+        return self._dirpath(file_reference)
+
+    def attributes(self, row):
+        return self._attributes[row]
+
+    def _paths(self, rows):
+        for row in rows:
+            path = self.path(row)
+            if path is not None:
+                yield path
+
+    def __iter__(self):
+        return self._paths(range(len(self)))
+
+    def named(self, name):
+        """Generate the full path of every entry called name
+        """
+        return self._paths(_equal_range(self._rows_by("name", self._name_key), self._name_key, name.lower()))
+
+    def with_extension(self, ext):
+        """Generate the full path of every entry whose name ends with ext, eg ".txt"
+        """
+        ext = ext.lower()
+        if ext and not ext.startswith("."):
+            ext = "." + ext
+        return self._paths(_equal_range(self._rows_by("ext", self._ext_key), self._ext_key, ext))
+
+    def _children(self, record_number):
+        return _equal_range(self._rows_by("parent", self._parent_key), self._parent_key, record_number)
+
+    def in_directory(self, dirpath):
+        """Generate the full path of every entry directly inside dirpath, which
+        is relative to the root. Nothing is generated if there is no such directory.
+        """
+        record_number = self.ROOT_RECORD
+        for part in [p for p in dirpath.replace("/", "\\").split("\\") if p]:
+            for row in self._children(record_number):
+                if self._records[row] != record_number and self.names[row].lower() == part.lower():
+                    record_number = self._records[row]
+                    break
+            else:
+                return iter([])
+        return self._paths(row for row in self._children(record_number) if self._records[row] != record_number)
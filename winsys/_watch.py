@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Turn what ReadDirectoryChangesW returns into the changes reported by
+the watchers in :mod:`winsys.fs` and :mod:`winsys.aio`.
+
+A read returns a list of (action, filename) pairs with filenames relative
+to the directory watched; a rename comes as two of them, the old name
+followed by the new. :func:`changes` pairs those up and generates
+(action, old_filename, new_filename) triples.
+
+NB This module *MUST NOT* import any Windows-specific modules so that
+it can be used by :mod:`winsys.aio` and tested anywhere.
+"""
+from __future__ import unicode_literals
+
+import os
+
+#
+# The FILE_ACTION_* values from winnt.h, as returned by ReadDirectoryChangesW
+# and as found in :const:`fs.FILE_ACTION`. OVERFLOWED is reported by a watcher
+# when changes have been lost and the directory should be looked at again.
+#
+OVERFLOWED = 0
+ADDED = 1
+REMOVED = 2
+MODIFIED = 3
+RENAMED_OLD_NAME = 4
+RENAMED_NEW_NAME = 5
+
+#
+# Every one of the FILE_NOTIFY_CHANGE_* values from winnt.h
+#
+WATCH_FOR = 0x17f
+
+def changes(root, raw_changes):
+    """Pair up renames from a list of (action, filename) and generate
+    (action, old_filename, new_filename) with each filename joined to root:
+    old_filename is None for an addition and new_filename is None for a
+    removal; both are the same for a modification. A rename is reported once,
+    as RENAMED_NEW_NAME, when its new name arrives. Unknown actions are ignored.
+    """
+    old_filename = None
+    for action, filename in raw_changes:
+        filename = os.path.join(root, filename)
+        if action == ADDED:
+            yield action, None, filename
+        elif action == REMOVED:
+            yield action, filename, None
+        elif action == MODIFIED:
+            yield action, filename, filename
+        elif action == RENAMED_OLD_NAME:
+            old_filename = filename
+        elif action == RENAMED_NEW_NAME:
+            yield action, old_filename, filename
+            old_filename = None
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""Watch directories and read and write files from asyncio code without
+holding a thread for each outstanding operation::
+
+    import asyncio
+    from winsys import aio
+
+    async def main():
+        async with aio.watch("c:/temp", subdirs=True) as watcher:
+            async for action, old_filename, new_filename in watcher:
+                print(action, old_filename, new_filename)
+
+    asyncio.run(main())
+
+The overlapped calls themselves are made by a completion source, by default
+a :class:`Win32Completions`. Under the proactor event loop -- the default on
+Windows -- it hands each wait to the proactor, which waits on the operation's
+event from the system thread pool and wakes the loop through its completion
+port. Any other loop has no way to wait on a handle, so each wait is made in
+the loop's default executor instead and holds one of its threads until the
+operation completes: a few watchers will use up a small executor.
+
+Anything with the same methods -- `open_directory`, `close`,
+`directory_reader`, and the coroutines `read_at` and `write_at` -- can stand
+in for a :class:`Win32Completions`. The reader returned by `directory_reader`
+has `start`, to issue a read, `cancel`, to stop an outstanding one, and the
+coroutine `changes`, to wait for it.
+
+Nothing Windows-specific is imported until a :class:`Win32Completions`
+is first used.
+"""
+from __future__ import unicode_literals
+
+import asyncio
+import collections
+
+from winsys import _watch
+from winsys._watch import OVERFLOWED, ADDED, REMOVED, MODIFIED, RENAMED_OLD_NAME, RENAMED_NEW_NAME, WATCH_FOR
+
+BUFFER_SIZE = 8192
+MAX_BUFFER_SIZE = 64 * 1024
+
+class _DirectoryReader(object):
+    """Read the changes beneath a directory handle, one ReadDirectoryChangesW
+    after another into the same buffer and with the same event
+    """
+
+    def __init__(self, completions, handle, buffer_size, subdirs, watch_for):
+        import win32file
+        from winsys.fs import wrapped
+        self.completions = completions
+        self.handle = handle
+        self.subdirs = subdirs
+        self.watch_for = watch_for
+        self.buffer = wrapped(win32file.AllocateReadBuffer, buffer_size)
+        self.overlapped = completions._overlapped()
+        self._pending = False
+
+    def start(self):
+        """Issue the next read
+        """
+        import win32event, win32file
+        from winsys.fs import wrapped
+        wrapped(win32event.ResetEvent, self.overlapped.hEvent)
+        wrapped(
+            win32file.ReadDirectoryChangesW,
+            self.handle, self.buffer, self.subdirs, self.watch_for, self.overlapped
+        )
+        self._pending = True
+
+    def cancel(self):
+        """Cancel the outstanding read, if there is one, and wait for the
+        cancellation to take effect
+        """
+        if self._pending:
+            self._pending = False
+            self.completions._cancel(self.handle, self.overlapped)
+
+    async def changes(self):
+        """Wait for the outstanding read, issuing one if there is none, and
+        return its (action, filename) pairs, or an empty list if changes were
+        lost. The pairs are copied out of the buffer, so the next read can be
+        issued as soon as they are returned.
+        """
+        import win32file, winerror
+        from winsys import exc
+        from winsys.fs import wrapped
+        if not self._pending:
+            self.start()
+        try:
+            n_bytes = await self.completions._result(self.handle, self.overlapped)
+        except exc.x_winsys as err:
+            (errno, errctx, errmsg) = err.args
+            if errno != winerror.ERROR_NOTIFY_ENUM_DIR:
+                raise
+            n_bytes = 0
+        finally:
+            self._pending = False
+        if n_bytes == 0:
+            return []
+        else:
+            return wrapped(win32file.FILE_NOTIFY_INFORMATION, self.buffer, n_bytes)
+
+class Win32Completions(object):
+    """Issue overlapped Win32 calls through pywin32 and wait for them to
+    complete on the running asyncio loop. If the loop is a proactor loop, each
+    wait is passed to its proactor's `wait_for_handle`; any other loop waits
+    in its default executor, holding one of its threads for each outstanding
+    call.
+
+    If the awaiting task is cancelled, the outstanding call is cancelled too.
+    """
+
+    def _overlapped(self, offset=0):
+        import pywintypes, win32event
+        from winsys.fs import wrapped
+        overlapped = wrapped(pywintypes.OVERLAPPED)
+        overlapped.hEvent = wrapped(win32event.CreateEvent, None, 1, 0, None)
+        overlapped.Offset = offset & 0xFFFFFFFF
+        overlapped.OffsetHigh = offset >> 32
+        return overlapped
+
+    async def _result(self, handle, overlapped):
+        """Wait for the call using overlapped to complete and return
+        the number of bytes it transferred
+        """
+        import win32event, win32file
+        from winsys.fs import wrapped
+        loop = asyncio.get_running_loop()
+        proactor = getattr(loop, "_proactor", None)
+        try:
+            if proactor is not None:
+                await proactor.wait_for_handle(int(overlapped.hEvent))
+            else:
+                await loop.run_in_executor(
+                    None, win32event.WaitForSingleObject, overlapped.hEvent, win32event.INFINITE
+                )
+        except asyncio.CancelledError:
+            self._cancel(handle, overlapped)
+            raise
+        return wrapped(win32file.GetOverlappedResult, handle, overlapped, False)
+
+    def _cancel(self, handle, overlapped):
+        """Cancel the call using overlapped. The buffer must not be released
+        while the kernel might still write into it, so wait for the
+        cancellation to take effect.
+        """
+        import win32file
+        try:
+            win32file.CancelIoEx(handle, overlapped)
+            win32file.GetOverlappedResult(handle, overlapped, True)
+        except win32file.error:
+            pass
+
+    def open_directory(self, root):
+        from winsys import fs
+        return fs._watch_handle(root)
+
+    def close(self, handle):
+        handle.close()
+
+    def directory_reader(self, handle, buffer_size, subdirs, watch_for):
+        """Return a reader for the changes beneath a directory handle which
+        uses one buffer of buffer_size bytes for all its reads
+        """
+        return _DirectoryReader(self, handle, buffer_size, subdirs, watch_for)
+
+    async def read_at(self, handle, offset, size):
+        import win32file, winerror
+        from winsys import exc
+        from winsys.fs import wrapped
+        buffer = wrapped(win32file.AllocateReadBuffer, size)
+        overlapped = self._overlapped(offset)
+        try:
+            wrapped(win32file.ReadFile, handle, buffer, overlapped)
+            n_bytes = await self._result(handle, overlapped)
+        except exc.x_winsys as err:
+            (errno, errctx, errmsg) = err.args
+            if errno != winerror.ERROR_HANDLE_EOF:
+                raise
+            n_bytes = 0
+        return bytes(buffer[:n_bytes])
+
+    async def write_at(self, handle, offset, data):
+        import win32file
+        from winsys.fs import wrapped
+        overlapped = self._overlapped(offset)
+        wrapped(win32file.WriteFile, handle, data, overlapped)
+        n_bytes = await self._result(handle, overlapped)
+        return n_bytes
+
+def _completions(completions):
+    return Win32Completions() if completions is None else completions
+
+class AsyncWatcher(object):
+    """An asynchronous iterator over the changes beneath a directory, returned
+    by :func:`watch`. Each change is an (action, old_filename, new_filename)
+    triple as for :func:`fs.watch`, except that the filenames are not looked
+    up. When changes have been lost, action is :const:`OVERFLOWED`, the
+    filenames are None and the buffer used for later reads is doubled, up
+    to `max_buffer_size`.
+
+    A read is issued when the watcher is created and again as soon as each
+    one completes, so changes are being collected while earlier ones are
+    consumed. All the reads on one handle share a buffer.
+
+    :meth:`close` stops the watcher, cancelling any outstanding read, and is
+    called when the watcher is used as an asynchronous context manager.
+    """
+
+    def __init__(
+        self,
+        root,
+        subdirs=False,
+        watch_for=WATCH_FOR,
+        buffer_size=BUFFER_SIZE,
+        max_buffer_size=MAX_BUFFER_SIZE,
+        completions=None
+    ):
+        self.root = root
+        self.subdirs = subdirs
+        self.watch_for = watch_for
+        self.buffer_size = buffer_size
+        self.max_buffer_size = max(buffer_size, max_buffer_size)
+        self.n_overflows = 0
+        self.completions = _completions(completions)
+        self._changes = collections.deque()
+        self._read = None
+        self._handle = self._reader = None
+        self._open()
+
+    def __repr__(self):
+        return "<%s for %s>" % (self.__class__.__name__, self.root)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._changes:
+            if self._handle is None:
+                raise StopAsyncIteration
+            self._read = asyncio.ensure_future(self._reader.changes())
+            try:
+                raw_changes = await self._read
+            except asyncio.CancelledError:
+                if self._handle is None:
+                    raise StopAsyncIteration
+                raise
+            finally:
+                self._read = None
+            if raw_changes:
+                self._changes.extend(_watch.changes(self.root, raw_changes))
+                self._reader.start()
+            else:
+                self.n_overflows += 1
+                self._changes.append((OVERFLOWED, None, None))
+                if self.buffer_size < self.max_buffer_size:
+                    self._grow()
+                else:
+                    self._reader.start()
+        return self._changes.popleft()
+
+    def _open(self):
+        """Open the root and issue the first read on it
+        """
+        handle = self.completions.open_directory(self.root)
+        try:
+            reader = self.completions.directory_reader(handle, self.buffer_size, self.subdirs, self.watch_for)
+            reader.start()
+        except BaseException:
+            self.completions.close(handle)
+            raise
+        self._handle, self._reader = handle, reader
+
+    def _grow(self):
+        """Double the buffer size and open the root again: the kernel keeps
+        its own buffer for a handle, sized by the first read made on it.
+        """
+        self.buffer_size = min(2 * self.buffer_size, self.max_buffer_size)
+        handle, self._handle = self._handle, None
+        try:
+            self._open()
+        finally:
+            self.completions.close(handle)
+
+    def close(self):
+        """Stop watching, cancelling any outstanding read
+        """
+        if self._handle is not None:
+            handle, self._handle = self._handle, None
+            if self._read is not None:
+                self._read.cancel()
+            self._reader.cancel()
+            self.completions.close(handle)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+def watch(
+    root,
+    subdirs=False,
+    watch_for=WATCH_FOR,
+    buffer_size=BUFFER_SIZE,
+    max_buffer_size=MAX_BUFFER_SIZE,
+    completions=None
+):
+    """Return an :class:`AsyncWatcher` over the changes beneath root
+
+    :param root: the path of the directory to watch
+    :param subdirs: whether to watch the whole tree beneath root
+    :param watch_for: a combination of :const:`fs.FILE_NOTIFY_CHANGE` values
+    :param buffer_size: the size in bytes of the buffer to start with
+    :param max_buffer_size: the size in bytes beyond which the buffer will not grow
+    :param completions: the completion source to use [a :class:`Win32Completions`]
+    """
+    return AsyncWatcher(root, subdirs, watch_for, buffer_size, max_buffer_size, completions)
+
+async def read_at(handle, offset, size, completions=None):
+    """Read up to size bytes from offset in a file opened for overlapped I/O,
+    returning fewer -- or none -- at the end of the file
+
+    :param handle: a handle opened with FILE_FLAG_OVERLAPPED
+    :param offset: the position in bytes from the start of the file
+    :param size: the most bytes to read
+    :param completions: the completion source to use [a :class:`Win32Completions`]
+    :returns: bytes
+    """
+    data = await _completions(completions).read_at(handle, offset, size)
+    return data
+
+async def write_at(handle, offset, data, completions=None):
+    """Write data at offset in a file opened for overlapped I/O
+
+    :param handle: a handle opened with FILE_FLAG_OVERLAPPED
+    :param offset: the position in bytes from the start of the file
+    :param data: bytes or anything supporting the buffer interface
+    :param completions: the completion source to use [a :class:`Win32Completions`]
+    :returns: the number of bytes written
+    """
+    n_bytes = await _completions(completions).write_at(handle, offset, data)
+    return n_bytes
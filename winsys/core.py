@@ -14,6 +14,12 @@ from winsys import utils
 
 class _WinSysObject(object):
 
+    #
+    # No per-instance attributes here so that subclasses which are created
+    # in bulk, eg fs.Entry, can do without a __dict__ by declaring __slots__.
+    #
+    __slots__ = ()
+
     def as_string(self):
         """Produce a readable version of the data, used by
         __str__.
@@ -8,12 +8,10 @@ from __future__ import with_statement
 import os, sys
 import cgi
 import datetime
-import operator
 import socket
 import threading
 import time
 import traceback
-import Queue
 import urllib
 import urlparse
 from wsgiref.simple_server import make_server
@@ -59,139 +57,57 @@ def deltastamp(delta):
 
     return output_format % output
 
-class x_stop_exception(Exception):
-    pass
-
-def get_files(path, size_threshold_mb, results, stop_event):
-    """Intended to run inside a thread: scan the contents of
-    a tree recursively, pushing every file which is at least
-    as big as the size threshold onto a results queue. Stop
-    if the stop_event is set.
-    """
-    size_threshold = size_threshold_mb * 1024 * 1024
-    root = fs.dir(path)
-    top_level_folders = sorted(root.dirs(), key=operator.attrgetter("written_at"), reverse=True)
-    try:
-        for tlf in top_level_folders:
-            for f in tlf.flat(ignore_access_errors=True):
-                if stop_event.isSet():
-                    print("stop event set")
-                    raise x_stop_exception
-                try:
-                    if f.size > size_threshold:
-                        results.put(f)
-                except fs.exc.x_winsys:
-                    continue
-    except x_stop_exception:
-        return
-
-def watch_files(path, size_threshold_mb, results, stop_event):
-    """Intended to run inside a thread: monitor a directory tree
-    for file changes. Convert the changed files to fs.File objects
-    and push then onto a results queue. Stop if the stop_event is set.
-    """
-    size_threshold = size_threshold_mb * 1024 * 1024
-    BUFFER_SIZE = 8192
-    MAX_BUFFER_SIZE = 1024 * 1024
-
-    #
-    # The double loop is because the watcher process
-    # can fall over with an internal which is (I think)
-    # related to a small buffer size. If that happens,
-    # restart the process with a bigger buffer up to a
-    # maximum size.
-    #
-    buffer_size = BUFFER_SIZE
-    while True:
-        watcher = fs.watch(path, True, buffer_size=buffer_size)
-
-        while True:
-            if stop_event.isSet(): break
-            try:
-                action, old_file, new_file = watcher.next()
-                core.warn("Monitored: %s - %s => %s" % (action, old_file, new_file))
-                if old_file is not None:
-                    if (not old_file) or (old_file and old_file.size > size_threshold):
-                        results.put(old_file)
-                if new_file is not None and new_file != old_file:
-                    if new_file and new_file.size > size_threshold:
-                        results.put(new_file)
-            except fs.exc.x_winsys:
-                pass
-            except RuntimeError:
-                try:
-                    watcher.stop()
-                except:
-                    pass
-                buffer_size = min(2 * buffer_size, MAX_BUFFER_SIZE)
-                print("Tripped up on a RuntimeError. Trying with buffer of", buffer_size)
-
 class Path(object):
-    """Keep track of the files and changes under a particular
+    """Keep track of the largest files under a particular
     path tree. No attempt is made to optimise the cases where
     one tree is contained within another.
 
-    When the Path is started, it kicks of two threads: one to
-    do a complete scan; the other to monitor changes. Both
-    write back to the same results queue which is the basis
-    for the set of files which will be sorted and presented
-    on the webpage.
-
-    For manageability, the files are pulled off the queue a
-    chunk at a time (by default 1000).
+    When the Path is started, it hands the tree to an
+    fs.TopFiles which scans it in a thread of its own and
+    then watches it for changes. Only the largest files over
+    the size threshold are held -- a few more than are shown --
+    so however big the tree, the page only ever has a short,
+    already-sorted list to render.
     """
 
-    def __init__(self, path, size_threshold_mb, n_files_at_a_time):
+    def __init__(self, path, size_threshold_mb, top_n_files):
         self._path = path
         self._size_threshold_mb = size_threshold_mb
-        self._n_files_at_a_time = n_files_at_a_time
-        self._changes = Queue.Queue()
-        self._stop_event = threading.Event()
-        self._files = set()
-
-        self.file_getter = threading.Thread(
-            target=get_files,
-            args=(path, size_threshold_mb, self._changes, self._stop_event)
-        )
-        self.file_getter.setDaemon(1)
-        self.file_getter.start()
-
-        self.file_watcher = threading.Thread(
-            target=watch_files,
-            args=(path, size_threshold_mb, self._changes, self._stop_event)
+        self._top_n_files = top_n_files
+        self._top_files = fs.watch_top_files(
+            path,
+            top_n_files,
+            key="size",
+            error_handler=self.error_handler,
+            min_size=size_threshold_mb * 1024 * 1024
         )
-        self.file_watcher.setDaemon(1)
-        self.file_watcher.start()
 
     def __str__(self):
-        return "<Path: %s (%d files above %d Mb)>" % (self._path, len(self._files), self._size_threshold_mb)
+        return "<Path: %s (top %d files above %d Mb)>" % (self._path, self._top_n_files, self._size_threshold_mb)
     __repr__ = __str__
 
+    @staticmethod
+    def error_handler(exc_info):
+        """Skip anything which can't be read rather than stopping the scan
+        """
+        core.warn("Skipped: %s" % exc_info[1])
+        return True
+
     def updated(self):
-        """Pull at most _n_files_at_a_time files from the queue. If the
-        file exists, add it to the set (which will, of course, ignore
-        duplicates). If it doesn't exist, remove it from the set, ignoring
-        the case where it isn't there to start with.
+        """Return the largest files, biggest first, as fs.File objects
+        with the size and times from the scan or the last change already
+        in place.
         """
-        for i in range(self._n_files_at_a_time):
-            try:
-                f = self._changes.get_nowait()
-                if f:
-                    self._files.add(f)
-                else:
-                    self._files.discard(f)
-            except Queue.Empty:
-                break
-        return self._files
+        return [f.entry() for f in self._top_files.files()]
 
     def finish(self):
-        self._stop_event.set()
+        self._top_files.stop()
 
     def status(self):
         status = []
-        if self.file_getter.isAlive():
+        if self._top_files.scanning:
             status.append("Scanning")
-        if self.file_watcher.isAlive():
+        if self._top_files.is_alive():
             status.append("Monitoring")
         return " & ".join(status)
 
@@ -203,7 +119,6 @@ class App(object):
     """
 
     PATH = ""
-    N_FILES_AT_A_TIME = 1000
     SIZE_THRESHOLD_MB = 100
     TOP_N_FILES = 50
     REFRESH_SECS = 60
@@ -227,7 +142,7 @@ class App(object):
         highlight_delta = datetime.timedelta(days=highlight_days, hours=highlight_hrs, minutes=highlight_mins)
         highlight_deltastamp = deltastamp(highlight_delta)
         if files:
-            title = cgi.escape("Top %d files on %s over %dMb - %s" % (min(len(files), self.TOP_N_FILES), path, size_threshold_mb, status))
+            title = cgi.escape("Top %d files on %s over %dMb - %s" % (min(len(files), top_n_files), path, size_threshold_mb, status))
         else:
             title = cgi.escape("Top files on %s over %dMb - %s" % (path, size_threshold_mb, status))
 
@@ -289,6 +204,7 @@ class App(object):
     def handler(self, form):
         path = form.get("path", self.PATH)
         size_threshold_mb = int(form.get("size_threshold_mb", self.SIZE_THRESHOLD_MB) or 0)
+        top_n_files = int(form.get("top_n_files", self.TOP_N_FILES) or 0)
         refresh_secs = int(form.get("refresh_secs", self.REFRESH_SECS) or 0)
         status = "Waiting"
         if path and fs.Dir(path):
@@ -297,15 +213,21 @@ class App(object):
             # Create a new path handler if needed, or pull back
             # and existing one, and return the latest list.
             #
+            #
+            # Finishing a path handler waits for its thread, so
+            # the handlers finished with are only collected while
+            # the lock is held and are finished once it's released.
+            #
+            finished = []
             with self._paths_lock:
                 if path not in self.paths:
-                    self.paths[path] = Path(path, size_threshold_mb, self.N_FILES_AT_A_TIME)
+                    self.paths[path] = Path(path, size_threshold_mb, top_n_files)
                 path_handler = self.paths[path]
-                if path_handler._size_threshold_mb != size_threshold_mb:
-                    path_handler.finish()
-                    path_handler = self.paths[path] = Path(path, size_threshold_mb, self.N_FILES_AT_A_TIME)
+                if (path_handler._size_threshold_mb, path_handler._top_n_files) != (size_threshold_mb, top_n_files):
+                    finished.append(path_handler)
+                    path_handler = self.paths[path] = Path(path, size_threshold_mb, top_n_files)
                 self._paths_accessed[path] = win32timezone.utcnow()
-                files = sorted(path_handler.updated(), key=operator.attrgetter("size"), reverse=True)
+                files = path_handler.updated()
                 status = path_handler.status()
 
                 #
@@ -314,13 +236,14 @@ class App(object):
                 # its entry. If it is queried again, it will just
                 # be restarted as new.
                 #
-                for path, last_accessed in self._paths_accessed.iteritems():
+                for path, last_accessed in list(self._paths_accessed.items()):
                     if (win32timezone.utcnow() - last_accessed).seconds > 180:
-                        path_handler = self.paths.get(path)
+                        path_handler = self.paths.pop(path, None)
                         if path_handler:
-                            path_handler.finish()
-                            del self.paths[path]
-                            del self._paths_accessed[path]
+                            finished.append(path_handler)
+                        del self._paths_accessed[path]
+            for path_handler in finished:
+                path_handler.finish()
 
         else:
             files = []
@@ -10,18 +10,28 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import os, sys
+import array
 import codecs
 import collections
 import contextlib
+import datetime
 import filecmp
 import fnmatch
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import mmap as mmap_
 import msvcrt
 import operator
 import re
+import sqlite3
 import struct
 import threading
 import time
 import zipfile
+import zlib
 
 import ntsecuritycon
 import pywintypes
@@ -39,7 +49,7 @@ if not hasattr(winerror, 'ERROR_BAD_RECOVERY_POLICY'):
     winerror.ERROR_BAD_RECOVERY_POLICY = 6012
 
 from winsys._compat import *
-from winsys import constants, core, exc, handles, security as security_, utils, _kernel32
+from winsys import constants, core, exc, handles, security as security_, utils, _kernel32, _usn, _watch
 
 sep = unicode(os.sep)
 seps = "/\\"
@@ -65,6 +75,9 @@ class x_not_ready(x_fs):
 class x_sharing_violation(x_fs):
     "Raised when a sharing violation occurs"
 
+class x_journal_entries_lost(x_fs):
+    "Raised when change journal records have been discarded since the USN asked for"
+
 WINERROR_MAP = {
     winerror.ERROR_ACCESS_DENIED : exc.x_access_denied,
     winerror.ERROR_PATH_NOT_FOUND : x_no_such_file,
@@ -75,6 +88,7 @@ WINERROR_MAP = {
     winerror.ERROR_NOT_READY : x_not_ready,
     winerror.ERROR_INVALID_HANDLE : exc.x_invalid_handle,
     winerror.ERROR_SHARING_VIOLATION : x_sharing_violation,
+    winerror.ERROR_JOURNAL_ENTRY_DELETED : x_journal_entries_lost,
     2310 : x_no_such_file,
 }
 wrapped = exc.wrapper(WINERROR_MAP, x_fs)
@@ -108,11 +122,11 @@ FILE_FLAG.doc("File flags")
 FILE_NOTIFY_CHANGE = constants.Constants.from_pattern("FILE_NOTIFY_CHANGE_*", namespace=win32con)
 FILE_NOTIFY_CHANGE.doc("Notification types to watch for when a file changes")
 FILE_ACTION = constants.Constants.from_dict(dict(
-    ADDED = 1,
-    REMOVED = 2,
-    MODIFIED = 3,
-    RENAMED_OLD_NAME = 4,
-    RENAMED_NEW_NAME = 5
+    ADDED = _watch.ADDED,
+    REMOVED = _watch.REMOVED,
+    MODIFIED = _watch.MODIFIED,
+    RENAMED_OLD_NAME = _watch.RENAMED_OLD_NAME,
+    RENAMED_NEW_NAME = _watch.RENAMED_NEW_NAME
 ))
 FILE_ACTION.doc("Results of a file change")
 FILE_ATTRIBUTE = constants.Constants.from_pattern("FILE_ATTRIBUTE_*", namespace=win32file)
@@ -157,6 +171,32 @@ COMPRESSION_FORMAT = constants.Constants.from_dict(dict(
 COMPRESSION_FORMAT.doc("Ways in which a file can be compressed")
 FSCTL = constants.Constants.from_pattern("FSCTL_*", namespace=winioctlcon)
 FSCTL.doc("Types of fsctl operation")
+USN_REASON = constants.Constants.from_dict(dict(
+    USN_REASON_DATA_OVERWRITE = 0x00000001,
+    USN_REASON_DATA_EXTEND = 0x00000002,
+    USN_REASON_DATA_TRUNCATION = 0x00000004,
+    USN_REASON_NAMED_DATA_OVERWRITE = 0x00000010,
+    USN_REASON_NAMED_DATA_EXTEND = 0x00000020,
+    USN_REASON_NAMED_DATA_TRUNCATION = 0x00000040,
+    USN_REASON_FILE_CREATE = 0x00000100,
+    USN_REASON_FILE_DELETE = 0x00000200,
+    USN_REASON_EA_CHANGE = 0x00000400,
+    USN_REASON_SECURITY_CHANGE = 0x00000800,
+    USN_REASON_RENAME_OLD_NAME = 0x00001000,
+    USN_REASON_RENAME_NEW_NAME = 0x00002000,
+    USN_REASON_INDEXABLE_CHANGE = 0x00004000,
+    USN_REASON_BASIC_INFO_CHANGE = 0x00008000,
+    USN_REASON_HARD_LINK_CHANGE = 0x00010000,
+    USN_REASON_COMPRESSION_CHANGE = 0x00020000,
+    USN_REASON_ENCRYPTION_CHANGE = 0x00040000,
+    USN_REASON_OBJECT_ID_CHANGE = 0x00080000,
+    USN_REASON_REPARSE_POINT_CHANGE = 0x00100000,
+    USN_REASON_STREAM_CHANGE = 0x00200000,
+    USN_REASON_TRANSACTED_CHANGE = 0x00400000,
+    USN_REASON_INTEGRITY_CHANGE = 0x00800000,
+    USN_REASON_CLOSE = 0x80000000
+), pattern="USN_REASON_*")
+USN_REASON.doc("Reasons for a change journal record")
 STYPE = constants.Constants.from_pattern("STYPE_*", namespace=win32netcon)
 
 PyHANDLE = pywintypes.HANDLEType
@@ -176,6 +216,16 @@ PATHSEG = "(" + LEGAL_FILECHARS + ")" + sep * 2 + "?"
 PATHSEGS = "(?:%s)*" % PATHSEG
 FILEPATH = PREFIX + PATHSEGS
 
+CHUNK_SIZE = 1024 * 1024
+
+#
+# What reading a damaged, encrypted or unsupported zipfile member can raise
+#
+_ZIP_ERRORS = (zipfile.BadZipfile, zipfile.LargeZipFile, zlib.error, NotImplementedError, RuntimeError, EOFError, IOError)
+
+_DRIVE_LETTERS = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz")
+_PREFIX = re.compile(PREFIX)
+
 def get_parts(filepath):
     r"""Helper function to regularise a file path and then
     to pick out its drive and path components.
@@ -227,8 +277,14 @@ def get_parts(filepath):
     with a trailing slash. This is stripped off.
     """
     filepath = filepath.replace("/", sep)
-    prefix_match = re.match(PREFIX, filepath)
 
+    #
+    # Most paths start with a drive letter, which needs no regex
+    #
+    if filepath[1:3] == ":" + sep and filepath[:1] in _DRIVE_LETTERS:
+        return [_intern(filepath[:3])] + filepath[3:].rstrip(sep).split(sep)
+
+    prefix_match = _PREFIX.match(filepath)
     if prefix_match:
         prefix = prefix_match.group(1)
         rest = filepath[len(prefix):].rstrip(sep)
@@ -240,10 +296,32 @@ def get_parts(filepath):
         #
         if prefix.startswith("\\") or not prefix.endswith(":"):
             prefix = prefix.rstrip(sep) + sep
-        return [prefix] + rest.split(sep)
+        return [_intern(prefix)] + rest.split(sep)
     else:
         return [""] + filepath.split(sep)
 
+_interned = {}
+_MAX_INTERNED = 10000
+
+def _intern(text):
+    """Return a single shared copy of text, so that the roots and directory
+    names common to many paths are held only once. (The builtin intern
+    won't take unicode strings under Python 2).
+    """
+    try:
+        return _interned[text]
+    except KeyError:
+        if len(_interned) >= _MAX_INTERNED:
+            _interned.clear()
+        _interned[text] = text
+        return text
+
+def _is_absolute(filepath):
+    """Return True if filepath is a UNC path or starts with a drive and a
+    slash, ie if its meaning doesn't depend on the current directory.
+    """
+    return filepath[1:3] == ":" + sep or filepath.startswith(2 * sep)
+
 def normalised(filepath):
     """Convert any path or path-like object into the
     length-unlimited unicode equivalent. This should avoid
@@ -373,6 +451,8 @@ class FilePath(unicode):
     a.txt               _          a.txt     a.txt     _         _           x_fs        a     .txt
     =================== ========== ========= ========= ========= =========== =========== ===== ====
     """
+    __slots__ = ("_parts", "_root", "_filename", "_name", "_dirname", "_path", "_parent", "_base", "_ext")
+
     def __new__(meta, filepath):
         fp = unicode.__new__(meta, filepath.replace("/", sep))
         fp._parts = None
@@ -437,6 +517,15 @@ class FilePath(unicode):
     def __radd__(self, other):
         return self.__class__.factory(os.path.join(unicode(other), unicode(self)))
 
+    def _derived(self, filepath, parts):
+        """Return the result of :meth:`factory` for filepath, a path derived
+        from this one whose parts are already known and needn't be parsed again.
+        """
+        derived = self.__class__.factory(filepath)
+        if isinstance(derived, FilePath) and derived._parts is None:
+            derived._parts = parts
+        return derived
+
     def _get_parts(self):
         if self._parts is None:
             self._parts = get_parts(self)
@@ -445,7 +534,8 @@ class FilePath(unicode):
 
     def _get_root(self):
         if self._root is None:
-            self._root = self.__class__.factory(self.parts[0])
+            root = self.parts[0]
+            self._root = self._derived(root, [root, ""])
         return self._root
     root = property(_get_root)
 
@@ -457,13 +547,17 @@ class FilePath(unicode):
 
     def _get_dirname(self):
         if self._dirname is None:
-            self._dirname = sep.join(self.parts[1:-1])
+            self._dirname = _intern(sep.join(self.parts[1:-1]))
         return self._dirname
     dirname = property(_get_dirname)
 
     def _get_path(self):
         if self._path is None:
-            self._path = self.__class__.factory((self.root or "") + self.dirname)
+            parts = self.parts
+            self._path = self._derived(
+                parts[0] + self.dirname,
+                parts[:-1] if len(parts) > 2 else [parts[0], ""]
+            )
         return self._path
     path = property(_get_path)
 
@@ -473,7 +567,10 @@ class FilePath(unicode):
         if self._parent is None:
             parent_dir = [p for p in self.parts if p][:-1]
             if parent_dir:
-                self._parent = self.__class__.factory(parent_dir[0] + sep.join(parent_dir[1:]))
+                self._parent = self._derived(
+                    parent_dir[0] + sep.join(parent_dir[1:]),
+                    parent_dir if len(parent_dir) > 1 else [parent_dir[0], ""]
+                )
             else:
                 self._parent = None
         return self._parent
@@ -703,6 +800,26 @@ class Volume(core._WinSysObject):
         """
         dir(filepath).dismount()
 
+    def handle(self):
+        """Return a handle to the volume itself, eg for FSCTL operations.
+        This usually needs administrative rights.
+        """
+        return wrapped(
+            win32file.CreateFile,
+            self.name.rstrip(sep),
+            FILE_ACCESS.READ,
+            FILE_SHARE.READ | FILE_SHARE.WRITE,
+            None,
+            FILE_CREATION.OPEN_EXISTING,
+            0,
+            None
+        )
+
+    def change_journal(self, *args, **kwargs):
+        """Return a :class:`ChangeJournal` for this volume, as per :func:`change_journal`
+        """
+        return ChangeJournal(self, *args, **kwargs)
+
 class Share(core._WinSysObject):
     """Wraps a drive share
     """
@@ -779,6 +896,131 @@ class Share(core._WinSysObject):
     def delete(self):
         wrapped(win32net.NetShareDel, self.servername, self.sharename)
 
+class StatCache(core._WinSysObject):
+    """Hold the metadata returned by GetFileAttributesEx for recently-seen
+    files so that reading the attributes, times and size of the same file
+    repeatedly, even via different :class:`Entry` objects, needs no further
+    calls to the filesystem. An item is discarded once it is older than
+    `ttl_secs` and the least-recently-used items are discarded once there
+    are more than `max_entries`. Changes made through this module discard
+    the items for the files involved -- and, when a directory is moved or
+    deleted, for everything beneath it; changes made elsewhere will only be
+    seen once an item has expired.
+
+    Use :func:`enable_stat_cache` to have a process-wide cache used by
+    every :class:`Entry`.
+    """
+
+    TTL_SECS = 5.0
+    MAX_ENTRIES = 10000
+
+    def __init__(self, ttl_secs=TTL_SECS, max_entries=MAX_ENTRIES):
+        self.ttl_secs = ttl_secs
+        self.max_entries = max_entries
+        self.hits = self.misses = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def as_string(self):
+        return "StatCache of %d items (ttl %ss)" % (len(self._items), self.ttl_secs)
+
+    def dumped(self, level=0):
+        output = []
+        output.append("ttl_secs: %s" % self.ttl_secs)
+        output.append("max_entries: %s" % self.max_entries)
+        output.append("items: %s" % len(self._items))
+        output.append("hits: %s" % self.hits)
+        output.append("misses: %s" % self.misses)
+        return utils.dumped("\n".join(output), level)
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, normpath):
+        """Return the file attribute data cached for normpath or :const:`None`
+        if there is none or if what there is has expired.
+        """
+        key = normpath.lower()
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None or time.time() - item[0] > self.ttl_secs:
+                self.misses += 1
+                return None
+            else:
+                self.hits += 1
+                self._items[key] = item
+                return item[1]
+
+    def put(self, normpath, file_attribute_data):
+        key = normpath.lower()
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = time.time(), file_attribute_data
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def invalidate(self, normpath=None, beneath=False):
+        """Discard the data cached for normpath or, if normpath is :const:`None`,
+        discard everything. If beneath is True, also discard the data for
+        everything beneath normpath, eg when a directory has been moved.
+        """
+        with self._lock:
+            if normpath is None:
+                self._items.clear()
+            else:
+                key = normpath.lower()
+                self._items.pop(key, None)
+                if beneath:
+                    prefix = key.rstrip(sep) + sep
+                    for k in [k for k in self._items if k.startswith(prefix)]:
+                        del self._items[k]
+
+_stat_cache = None
+
+def enable_stat_cache(ttl_secs=StatCache.TTL_SECS, max_entries=StatCache.MAX_ENTRIES):
+    """Start caching file metadata across the whole process, replacing any
+    existing cache. Code which reads several attributes from many files
+    will then only query the filesystem once per file::
+
+        from winsys import fs
+        fs.enable_stat_cache(ttl_secs=30)
+        for f in fs.flat("c:/temp"):
+            print(f, f.size, f.written_at, f.attributes)
+
+    :param ttl_secs: how long an item is considered up-to-date
+    :param max_entries: how many items are held before the least-recently-used are dropped
+    :returns: the new :class:`StatCache`
+    """
+    global _stat_cache
+    _stat_cache = StatCache(ttl_secs, max_entries)
+    return _stat_cache
+
+def disable_stat_cache():
+    """Stop caching file metadata, discarding anything already cached
+    """
+    global _stat_cache
+    _stat_cache = None
+
+def _file_attribute_data(normpath, refresh=False):
+    """Return the (attributes, created, accessed, written, size) tuple from
+    GetFileAttributesEx for normpath, using and updating the stat cache if
+    there is one. If refresh is True, always go to the filesystem.
+    """
+    cache = _stat_cache
+    if cache is not None and not refresh:
+        file_attribute_data = cache.get(normpath)
+        if file_attribute_data is not None:
+            return file_attribute_data
+    file_attribute_data = wrapped(win32file.GetFileAttributesExW, normpath)
+    if cache is not None:
+        cache.put(normpath, file_attribute_data)
+    return file_attribute_data
+
+def _invalidate(normpath, beneath=False):
+    cache = _stat_cache
+    if cache is not None:
+        cache.invalidate(normpath, beneath)
+
 class Entry(FilePath, core._WinSysObject):
     """Heart of the fs module. This is a subtype of :class:`FilePath` and
     therefore of the base unicode type and is the parent of the
@@ -807,9 +1049,16 @@ class Entry(FilePath, core._WinSysObject):
     * The str representation is the filepath utf8-encoded; unicode is the filepath itself
     * Adding one path to another will use os.path.join semantics
     """
+    __slots__ = ("_normalised", "_attributes", "_created_at", "_accessed_at", "_written_at", "_size", "_reparse_tag")
+
     def __new__(meta, filepath, _file_info=core.UNSET):
         fp = FilePath.__new__(meta, filepath)
-        fp._normpath = normalised(fp)
+        #
+        # The normalised form of an absolute path can't change so it
+        # waits until a call needs it; a relative path is resolved
+        # against the current directory straightaway.
+        #
+        fp._normalised = None if _is_absolute(fp) else normalised(fp)
         #
         # An Entry can be initialised from a Win32 FIND_FILES object, in which
         # case cache the information available for speed.
@@ -890,6 +1139,12 @@ class Entry(FilePath, core._WinSysObject):
     def factory(cls, filepath):
         return entry(filepath)
 
+    def _get_normpath(self):
+        if self._normalised is None:
+            self._normalised = normalised(self)
+        return self._normalised
+    _normpath = property(_get_normpath)
+
     def _get_readable(self):
         #
         # Check whether the user has at least enough
@@ -903,58 +1158,81 @@ class Entry(FilePath, core._WinSysObject):
             return True
     readable = property(_get_readable)
 
+    def refresh(self):
+        """Re-read all the metadata cached for this entry -- attributes, creation,
+        access and modification times and size -- from the filesystem. The
+        filesystem is queried once for all of them, and any stat cache
+        (cf :func:`enable_stat_cache`) is updated with the result.
+
+        :returns: self
+        """
+        self._set_file_attribute_data(_file_attribute_data(self._normpath, refresh=True))
+        return self
+
+    def _set_file_attribute_data(self, file_attribute_data):
+        attributes, created_at, accessed_at, written_at, size = file_attribute_data
+        self._attributes = constants.Attributes(attributes, FILE_ATTRIBUTE)
+        self._created_at = utils.from_pytime(created_at)
+        self._accessed_at = utils.from_pytime(accessed_at)
+        self._written_at = utils.from_pytime(written_at)
+        self._size = size
+
+    def _fill(self):
+        #
+        # One of the metadata fields has been asked for and none was
+        # stored: fetch them all at once, from the stat cache if possible.
+        #
+        self._set_file_attribute_data(_file_attribute_data(self._normpath))
+
     def get_created_at(self):
         """Get and store the latest creation time from the filesystem. Note that this forces a
         re-read of the metadata."""
-        self._created_at = utils.from_pytime(wrapped(win32file.GetFileAttributesExW, self._normpath)[1])
-        return self._created_at
+        return self.refresh()._created_at
     def _get_created_at(self):
         """Get the creation time from the original file read or the latest from
         the filesystem if none was stored."""
         if self._created_at is core.UNSET:
-            return self.get_created_at()
-        else:
-            return self._created_at
+            self._fill()
+        return self._created_at
     def _set_created_at(self, created_at, handle=None):
-        with Handle(handle or self.normapth, True) as handle:
+        with Handle(handle or self, True) as handle:
             created_at = pywintypes.Time(time.mktime(created_at.timetuple()))
             wrapped(win32file.SetFileTime, handle, created_at, None, None)
+        _invalidate(self._normpath)
     created_at = property(_get_created_at, _set_created_at)
 
     def get_accessed_at(self):
         """Get and store the latest access time from the filesystem. Note that this
         forces a re-read of the metadata"""
-        self._accessed_at = utils.from_pytime(wrapped(win32file.GetFileAttributesExW, self._normpath)[3])
-        return self._accessed_at
+        return self.refresh()._accessed_at
     def _get_accessed_at(self):
         """Get the access time from the original file read or the latest from
         the filesystem if none was stored."""
         if self._accessed_at is core.UNSET:
-            return self.get_accessed_at()
-        else:
-            return self._accessed_at
+            self._fill()
+        return self._accessed_at
     def _set_accessed_at(self, accessed_at, handle=None):
         with Handle(handle or self, True) as handle:
             accessed_at = pywintypes.Time(time.mktime(accessed_at.timetuple()))
             wrapped(win32file.SetFileTime, handle, None, accessed_at, None)
+        _invalidate(self._normpath)
     accessed_at = property(_get_accessed_at, _set_accessed_at)
 
     def get_written_at(self):
         """Get and store the latest modification time from the filesystem. Note that this
         forces a re-read of the metadata"""
-        self._written_at = utils.from_pytime(wrapped(win32file.GetFileAttributesExW, self._normpath)[2])
-        return self._written_at
+        return self.refresh()._written_at
     def _get_written_at(self):
         """Get and store the modification time from the original file read or the latest from
         the filesystem if none was stored."""
         if self._written_at is core.UNSET:
-            return self.get_written_at()
-        else:
-            return self._written_at
+            self._fill()
+        return self._written_at
     def _set_written_at(self, written_at, handle=None):
         with Handle(handle or self, True) as handle:
             written_at = pywintypes.Time(time.mktime(written_at.timetuple()))
             wrapped(win32file.SetFileTime, handle, None, None, written_at)
+        _invalidate(self._normpath)
     written_at = property(_get_written_at, _set_written_at)
 
     def _get_uncompressed_size(self, handle=None):
@@ -971,26 +1249,23 @@ class Entry(FilePath, core._WinSysObject):
         self._size = wrapped(_kernel32.GetCompressedFileSize, self._normpath)
         return self._size
     def _get_size(self):
-        """Get and store the (possibly compressed) size from the original file read or the latest from
+        """Get and store the size from the original file read or the latest from
         the filesystem if none was stored."""
         if self._size is core.UNSET:
-            return self.get_size()
-        else:
-            return self._size
+            self._fill()
+        return self._size
     size = property(_get_size)
 
     def get_attributes(self):
         """Get and store the latest file attributes from the filesystem. Note that this
         forces a re-read of the metadata"""
-        self._attributes = constants.Attributes(wrapped(win32file.GetFileAttributesExW, self._normpath)[0], FILE_ATTRIBUTE)
-        return self._attributes
+        return self.refresh()._attributes
     def _get_attributes(self):
         """Get and store the file attributes from the original file read or the latest from
         the filesystem if none was stored."""
         if self._attributes is core.UNSET:
-            return self.get_attributes()
-        else:
-            return self._attributes
+            self._fill()
+        return self._attributes
     attributes = property(_get_attributes)
 
     def _get_id(self):
@@ -1021,6 +1296,7 @@ class Entry(FilePath, core._WinSysObject):
             wrapped(win32file.SetFileAttributesW, normalised(self), self.attributes.flags | attr)
         else:
             wrapped(win32file.SetFileAttributesW, normalised(self), self.attributes.flags & ~attr)
+        _invalidate(self._normpath)
 
     def _get_archive(self):
         "Is the archive bit set on the file?"
@@ -1056,6 +1332,7 @@ class Entry(FilePath, core._WinSysObject):
         return self.attributes.normal
     def _set_normal(self, value):
         wrapped(win32file.SetFileAttributesW, normalised(self), FILE_ATTRIBUTE.NORMAL)
+        _invalidate(self._normpath)
     normal = property(_get_normal, _set_normal)
 
     def _get_not_content_indexed(self):
@@ -1110,17 +1387,17 @@ class Entry(FilePath, core._WinSysObject):
 
     def like(self, pattern):
         """Return true if this filename's name (not the path) matches
-        `pattern` according to `fnmatch`, eg::
+        `pattern` according to `fnmatch`, regardless of case, eg::
 
             from winsys import fs
             for f in fs.files ():
                 if f.directory and f.like("test_*"):
                     print f
 
-        :param pattern: an `fnmatch` pattern
+        :param pattern: an `fnmatch` pattern, several of them separated by |, or a :class:`Matcher`
         :returns: True if this file matches `pattern`
         """
-        return fnmatch.fnmatch(self.name, pattern)
+        return matcher(pattern).match(self.name)
 
     def ancestors(self):
         """Iterate over this entry's ancestors, yielding the :class:`Dir` object
@@ -1166,7 +1443,8 @@ class Entry(FilePath, core._WinSysObject):
         with Handle(self, True) as hFile:
             compression_type = struct.pack("H", COMPRESSION_FORMAT.DEFAULT)
             wrapped(win32file.DeviceIoControl, hFile, FSCTL.SET_COMPRESSION, compression_type, None, None)
-            return self
+        _invalidate(self._normpath)
+        return self
 
     def uncompress(self):
         """Uncompress this entry; if it is a file, it will be uncompressed, if it
@@ -1178,7 +1456,8 @@ class Entry(FilePath, core._WinSysObject):
         with Handle(self, True) as hFile:
             compression_type = struct.pack("H", COMPRESSION_FORMAT.NONE)
             wrapped(win32file.DeviceIoControl, hFile, FSCTL.SET_COMPRESSION, compression_type, None, None)
-            return self
+        _invalidate(self._normpath)
+        return self
 
     def encrypt(self):
         """FIXME: Need to work out how to create certificates for this
@@ -1186,6 +1465,7 @@ class Entry(FilePath, core._WinSysObject):
         :returns: self
         """
         wrapped(win32file.EncryptFile, self._normpath)
+        _invalidate(self._normpath)
         return self
 
     def unencrypt(self):
@@ -1194,6 +1474,7 @@ class Entry(FilePath, core._WinSysObject):
         :returns: self
         """
         wrapped(win32file.DecryptFile, self._normpath)
+        _invalidate(self._normpath)
         return self
 
     def encryption_users(self):
@@ -1237,6 +1518,8 @@ class Entry(FilePath, core._WinSysObject):
             callback_data,
             flags
         )
+        _invalidate(self._normpath, beneath=True)
+        _invalidate(normalised(target_filepath), beneath=True)
         return entry(unicode(target_filepath))
     rename = move
 
@@ -1289,6 +1572,8 @@ class Entry(FilePath, core._WinSysObject):
 
 class File(Entry):
 
+    __slots__ = ("hFile", "fd")
+
     ##
     ## 3 ways in which 2 files can be equal:
     ##     Their filepaths are equal
@@ -1322,6 +1607,7 @@ class File(Entry):
         :returns: self
         """
         wrapped(win32file.DeleteFileW, self._normpath)
+        _invalidate(self._normpath)
         return self
 
     def copy(self, other, callback=None, callback_data=None):
@@ -1339,13 +1625,7 @@ class File(Entry):
             target_filepath = other_file + self.filename
         else:
             target_filepath = other_file
-        wrapped(
-            win32file.CopyFileEx,
-            self._normpath,
-            normalised(target_filepath),
-            progress_wrapper(callback),
-            callback_data
-        )
+        _copy_file(self._normpath, normalised(target_filepath), callback, callback_data)
         return file(target_filepath)
 
     def equal_contents(self, other):
@@ -1423,24 +1703,105 @@ class File(Entry):
             0,
             None
         ).close()
+        _invalidate(self._normpath)
         return self
 
     def is_zip(self):
         return zipfile.is_zipfile(self)
 
-    def unzip(self):
+    def unzip(self, streaming=False):
+        """Iterate over the files in this zipfile, yielding the name and
+        contents of each one, or (None, None) for a member which can't be
+        read. If streaming is True, the contents are yielded as a file-like
+        object to be read before the next iteration, eg with :func:`stream_copy`,
+        rather than as a bytes object, so that no member is ever held in memory::
+
+            from winsys import fs
+            for name, f in fs.file("c:/temp/logs.zip").unzip(streaming=True):
+                for line in f:
+                    pass
+
+        :param streaming: whether to yield file-like objects rather than bytes [False]
+        """
         try:
             zf = zipfile.ZipFile(self)
-        except:
+        except _ZIP_ERRORS:
             yield None, None
-        else:
+            return
+
+        with zf:
             for zi in zf.infolist():
-                if not zi.is_dir():
+                if zi.is_dir():
+                    continue
+                try:
+                    f = zf.open(zi)
+                except _ZIP_ERRORS:
+                    yield None, None
+                    continue
+                with f:
+                    if streaming:
+                        yield zi.filename, f
+                        continue
                     try:
-                        with zf.open(zi) as f:
-                            yield zi.filename, f.read()
-                    except:
-                        yield None, None
+                        contents = f.read()
+                    except _ZIP_ERRORS:
+                        contents = None
+                if contents is None:
+                    yield None, None
+                else:
+                    yield zi.filename, contents
+
+    def extract(self, target_filepath=core.UNSET, workers=None):
+        """Extract every member of this zipfile into a directory, by default
+        one named after the zipfile alongside it. If `workers` is given, that
+        many threads each read and decompress members from their own handle
+        on the zipfile.
+
+        :param target_filepath: anything accepted by :func:`dir` [this file without its extension]
+        :param workers: how many threads extract members [None: extract in this thread]
+        :returns: a :class:`Dir` object representing the target directory
+        """
+        if target_filepath is core.UNSET:
+            target_filepath = os.path.join(self.path, self.base)
+        target = dir(target_filepath).create()
+        with zipfile.ZipFile(self) as zf:
+            if not workers:
+                zf.extractall(unicode(target))
+                return target
+            infos = zf.infolist()
+
+        #
+        # Create all the directories first so that the workers
+        # never race each other to create the same one.
+        #
+        dirpaths = set()
+        for zi in infos:
+            segments = _zip_member_segments(zi.filename)
+            if not zi.filename.endswith("/"):
+                segments = segments[:-1]
+            if segments:
+                dirpaths.add(tuple(segments))
+        for segments in sorted(dirpaths):
+            dir(os.path.join(unicode(target), *segments)).create()
+
+        local = threading.local()
+        def _extract(zi):
+            if not hasattr(local, "zf"):
+                local.zf = zipfile.ZipFile(self)
+                zipfiles.append(local.zf)
+            local.zf.extract(zi, unicode(target))
+
+        zipfiles = []
+        try:
+            members = [zi for zi in infos if not zi.filename.endswith("/")]
+            with contextlib.closing(_threaded_map(_extract, members, workers)) as extracted:
+                for zi, _, exc_info in extracted:
+                    if exc_info:
+                        raise exc_info[1]
+        finally:
+            for zf in zipfiles:
+                zf.close()
+        return target
 
     def zip(self, zip_filename=core.UNSET, mode="w", compression=zipfile.ZIP_DEFLATED, allow_zip64=False):
         """Zip the file up into a zipfile. By default, the zipfile will have the
@@ -1484,10 +1845,91 @@ class File(Entry):
         with codecs.open(self, "r", encoding=encoding) as f:
             return f.read()
 
+    def chunks(self, size=CHUNK_SIZE):
+        """Iterate over the contents of the file in blocks of up to `size` bytes,
+        so that a file of any size can be processed in a fixed amount of memory.
+
+        :param size: the most bytes to yield at once
+        :returns: yields bytes objects (str in 2.x)
+        """
+        with io.open(self._normpath, "rb") as f:
+            while True:
+                chunk = f.read(size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def lines(self, encoding=None, errors="strict"):
+        """Iterate over the lines of the file without reading all of it at once.
+        Without an encoding, the lines are bytes including their line endings;
+        with one, they are text with universal newlines.
+
+        :param encoding: valid encoding to pass to io.open, or None to yield bytes
+        :param errors: passed to io.open along with encoding
+        :returns: yields one bytes or text object for each line
+        """
+        if encoding is None:
+            f = io.open(self._normpath, "rb")
+        else:
+            f = io.open(self._normpath, "r", encoding=encoding, errors=errors)
+        with f:
+            for line in f:
+                yield line
+
+    @contextlib.contextmanager
+    def mmap(self):
+        """Map the file into memory read-only for the duration of a with-block,
+        yielding a memoryview of it. The operating system pages the contents in
+        as they're touched, so the whole file is never read at once::
+
+            from winsys import fs
+            with fs.file("c:/temp/big.log").mmap() as view:
+                print(view[:16].tobytes())
+
+        Any slices taken from the view must be released, or their contents
+        copied, before the with-block ends.
+        """
+        with io.open(self._normpath, "rb") as f:
+            #
+            # An empty file can't be mapped
+            #
+            if os.fstat(f.fileno()).st_size == 0:
+                yield memoryview(b"")
+                return
+            mapping = mmap_.mmap(f.fileno(), 0, access=mmap_.ACCESS_READ)
+            try:
+                try:
+                    view = memoryview(mapping)
+                except TypeError:
+                    #
+                    # Python 2's mmap doesn't offer the new buffer interface
+                    #
+                    view = mapping
+                try:
+                    yield view
+                finally:
+                    if isinstance(view, memoryview):
+                        view.release()
+            finally:
+                mapping.close()
+
+    def copy_to(self, fileobj, buffer_size=CHUNK_SIZE):
+        """Write the contents of this file to an open, writable file-like
+        object. cf :func:`stream_copy`
+
+        :param fileobj: an object with a write method
+        :param buffer_size: cf :func:`stream_copy`
+        :returns: the number of bytes copied
+        """
+        with io.open(self._normpath, "rb") as f:
+            return stream_copy(f, fileobj, buffer_size)
+
     touch = create
 
 class Dir(Entry):
 
+    __slots__ = ()
+
     def __new__(meta, filepath, *args, **kwargs):
         #
         # Ensure that a directory always ends in a backslash
@@ -1655,56 +2097,99 @@ class Dir(Entry):
         """
         return (f for f in self.entries(pattern, *args, **kwargs) if isinstance(f, Dir))
 
-    def walk(self, depthfirst=False, error_handler=None):
+    def walk(self, depthfirst=False, error_handler=None, workers=None, ordered=True, records=False, filter=None, **criteria):
         """Mimic os.walk, iterating over each directory and the files within
         in. Each iteration yields:
 
             :class:`Dir`, (generator for :class:`Dir` objects), (generator for :class:`File` objects)
 
+        If `workers` is given, that many threads list directories concurrently
+        from a shared queue, which pays off when each listing involves a
+        network round-trip, eg on a remote share. By default the results are
+        still yielded in the same order as a single-threaded walk; if `ordered`
+        is False they are yielded as soon as each directory has been listed,
+        although with `depthfirst` a directory still comes after all of its
+        subdirectories. The threads never get more than a few dozen listings
+        each ahead of the caller, so memory use stays flat on a large tree.
+
         :param depthfirst: Whether to use breadth-first (the default) or depth-first traversal
         :param error_handler: a callable which is passed sys.exc_info and returns True if the iteration is to continue, False otherwise
+        :param workers: the number of threads to list directories with [None - list them in this thread]
+        :param ordered: whether a multi-threaded walk yields in the single-threaded order [True]
+        :param records: whether to yield lists of :class:`EntryRecord` instead of :class:`Dir` and :class:`File` objects [False]
+        :param filter: a :class:`Filter` which files must pass; directories it prunes are not visited
+        :param criteria: keyword arguments for a :class:`Filter`, as an alternative to `filter`
         """
-        top = self
-        dirs, nondirs = [], []
-        for f in self.entries(error_handler=error_handler):
-            if isinstance(f, Dir):
-                dirs.append(f)
-            else:
-                nondirs.append(f)
-
-        if not depthfirst: yield top, dirs, nondirs
-        for d in dirs:
-            for x in d.walk(depthfirst=depthfirst, error_handler=error_handler):
-                yield x
-        if depthfirst: yield top, dirs, nondirs
+        filter = _filter(filter, criteria)
+        if workers:
+            return _parallel_walk(self, depthfirst, error_handler, records, filter, workers, ordered)
+        else:
+            return self._walk(depthfirst, error_handler, records, filter)
 
-    def flat(self, pattern="*", includedirs=False, depthfirst=False, error_handler=None):
+    def _walk(self, depthfirst=False, error_handler=None, records=False, filter=None):
+        #
+        # Keep an explicit stack of directories rather than recursing
+        # through one generator per level: each result goes straight
+        # to the caller however deep it is, and a very deep tree can't
+        # hit the recursion limit. The order is the same as recursing.
+        #
+        if depthfirst:
+            dirs, nondirs = _listing(self, error_handler, records, filter)
+            stack = [(self, dirs, nondirs, iter(dirs))]
+            while stack:
+                top, dirs, nondirs, subdirs = stack[-1]
+                for d in subdirs:
+                    d_dirs, d_nondirs = _listing(d, error_handler, records, filter)
+                    stack.append((d, d_dirs, d_nondirs, iter(d_dirs)))
+                    break
+                else:
+                    stack.pop()
+                    yield top, dirs, nondirs
+        else:
+            stack = [self]
+            while stack:
+                top = stack.pop()
+                dirs, nondirs = _listing(top, error_handler, records, filter)
+                yield top, dirs, nondirs
+                #
+                # Only look at dirs once the caller has seen it so that,
+                # as with os.walk, removing a directory from the list
+                # stops the walk from descending into it.
+                #
+                stack.extend(reversed(dirs))
+
+    def flat(self, pattern="*", includedirs=False, depthfirst=False, error_handler=None, workers=None, ordered=True, records=False, filter=None, **criteria):
         """Iterate over this directory and all its subdirectories, yielding one
         :class:`File` object on each iteration, and optionally :class:`Dir` objects
         as well.
 
-        :param pattern: limit the files returned by filename
+        :param pattern: limit the files returned by filename: |-separated wildcards or a :class:`Matcher`
         :includedirs: whether to yield directories as well as files [False]
         :depthfirst: as for :meth:`Dir.walk`
         :error_handler: as for :meth:`Dir.walk`
+        :workers: as for :meth:`Dir.walk`
+        :ordered: as for :meth:`Dir.walk`
+        :records: as for :meth:`Dir.walk`
+        :filter: as for :meth:`Dir.walk`
+        :criteria: as for :meth:`Dir.walk`
         """
-        patterns = pattern.split("|")
+        match = matcher(pattern).match
         walker = self.walk(
             depthfirst=depthfirst,
-            error_handler=error_handler
+            error_handler=error_handler,
+            workers=workers,
+            ordered=ordered,
+            records=records,
+            filter=_filter(filter, criteria)
         )
         for dirpath, dirs, files in walker:
             if includedirs:
                 for dir in dirs:
-                    for pattern in patterns:
-                        if dir.like(pattern):
-                            yield dir
-                            break
+                    if match(dir.name):
+                        yield dir
             for file in files:
-                for pattern in patterns:
-                    if file.like(pattern):
-                        yield file
-                        break
+                if match(file.name):
+                    yield file
 
     def mounted_by(self):
         """Return the volume mounted on this directory, or None.
@@ -1743,48 +2228,141 @@ class Dir(Entry):
         wrapped(win32file.DeleteVolumeMountPoint, self._normpath)
         return self
 
-    def copy(self, target_filepath, callback=None, callback_data=None):
+    def copy(self, target_filepath, callback=None, callback_data=None, workers=None, journal=None):
         """Copy this directory to another, which must be a directory if it
         exists. If it does exist, this directory's contents will be copied
         inside it; if it does not exist, this directory will become it.
         NB To copy this directory inside another, set the `target_filepath`
         to `other_directory + self.name`.
 
+        If `workers` or `journal` is given, the copy is done by :func:`copy_tree`,
+        which copies several files at once and can pick up an interrupted copy
+        where it left off; call that directly for its :class:`CopySummary`.
+
         :param target_filepath: anything accepted by :func:`entry`
         :param callback: cf :meth:`File.copy`
         :param callback_data: cf :meth:`File.copy`
+        :param workers: cf :func:`copy_tree`
+        :param journal: cf :func:`copy_tree`
         :returns: a :class:`Dir` object representing target_filepath
         """
         target = entry(target_filepath.rstrip(sep) + sep)
         if target and not target.directory:
             raise x_no_such_file(None, "Dir.copy", "%s exists but is not a directory")
+        if workers or journal:
+            return copy_tree(
+                self, target,
+                workers=workers or 1,
+                journal=journal,
+                callback=callback,
+                callback_data=callback_data
+            ).target
         if not target:
             target.create()
 
-        for dirpath, dirs, files in self.walk():
+        #
+        # Each directory is seen after its parent so it only needs
+        # creating itself, and the targets are known to be files and
+        # directories without asking the filesystem.
+        #
+        target_base = target._normpath
+        prefix_len = len(_walk_prefix(self))
+        for dirpath, dirs, files in self.walk(records=True):
             for d in dirs:
-                target_dir = Dir(target + d.relative_to(self))
-                target_dir.create()
+                _mkdir(os.path.join(target_base, d.filepath[prefix_len:]))
             for f in files:
-                target_file = File(target + f.relative_to(self))
-                f.copy(target_file, callback, callback_data)
+                _copy_file(
+                    normalised(f.filepath),
+                    os.path.join(target_base, f.filepath[prefix_len:]),
+                    callback, callback_data
+                )
 
         return target
 
-    def delete(self, recursive=False):
+    def sync(self, target_filepath, delete_extras=False, dry_run=False, callback=None, callback_data=None, error_handler=None, time_tolerance_secs=2):
+        """Bring the target directory into line with this one, copying only
+        those files which are new or which differ in size, modification time
+        or attributes, optionally deleting anything in the target which isn't
+        here. Each directory on each side is read once and compared as raw
+        directory data, so an unchanged tree costs little more than listing
+        both sides. eg::
+
+            from winsys import fs
+            report = fs.dir("c:/data").sync("//backup/data", delete_extras=True, dry_run=True)
+            report.dump()
+
+        Only the read-only, hidden and system attributes are compared, so that
+        a target which compresses, encrypts or doesn't index its files isn't
+        recopied every time, and modification times are allowed to differ by
+        up to `time_tolerance_secs` as FAT and many SMB servers keep them to
+        the nearest 2 seconds.
+
+        :param target_filepath: anything accepted by :func:`dir`
+        :param delete_extras: whether to delete files and directories in the target which are not in this directory [False]
+        :param dry_run: whether to report what would be done without doing it [False]
+        :param callback: cf :meth:`File.copy`
+        :param callback_data: cf :meth:`File.copy`
+        :param error_handler: passed sys.exc_info for each failure; returns True to note the failure and carry on
+        :param time_tolerance_secs: how far apart modification times can be and still count as the same [2]
+        :returns: a :class:`SyncReport`
+        """
+        return _Syncer(
+            self, dir(target_filepath), delete_extras, dry_run, callback, callback_data, error_handler, time_tolerance_secs
+        ).run()
+
+    def snapshot(self, manifest_filepath, hash=False, error_handler=None):
+        """Write a manifest of everything beneath this directory: one line for each
+        file and directory giving its path relative to this one, its size, the time
+        it was last written as an integer FILETIME, its attributes and, if `hash` is
+        True, the SHA1 of a file's contents. The lines are sorted as :func:`diff`
+        expects and are written as the tree is walked, each directory's listing
+        being sorted on its own, so memory use doesn't depend on the size of the
+        tree. If manifest_filepath ends with ".gz", the manifest is compressed::
+
+            from winsys import fs
+            fs.dir("c:/data").snapshot("c:/snapshots/monday.gz")
+            ...
+            fs.dir("c:/data").snapshot("c:/snapshots/tuesday.gz")
+            for action, old, new in fs.diff("c:/snapshots/monday.gz", "c:/snapshots/tuesday.gz"):
+                print(fs.FILE_ACTION.name_from_value(action), (new or old).path)
+
+        :param manifest_filepath: anything accepted by :func:`file`
+        :param hash: whether to include the SHA1 of each file's contents [False]
+        :param error_handler: as for :meth:`walk`
+        :returns: a :class:`File` object representing the manifest
+        """
+        manifest_filepath = file(manifest_filepath)
+        prefix_len = len(_walk_prefix(self))
+        with _open_manifest(manifest_filepath, "w") as manifest:
+            manifest.write("%s\t%s\n" % (MANIFEST_HEADER, self))
+            for record in _sorted_walk(self, error_handler):
+                digest = ""
+                if hash and not record.directory:
+                    digest = codecs.encode(_hash_file(normalised(record.filepath), record.size), "hex").decode("ascii")
+                manifest.write("%s\t%d\t%d\t%d\t%s\n" % (
+                    record.filepath[prefix_len:], record.size, record.written_at, record.attributes, digest
+                ))
+        return manifest_filepath
+
+    def delete(self, recursive=False, workers=None):
         """Delete this directory, optionally including its children.
+        A recursive delete is done by :func:`delete_tree` and, as with a
+        plain delete, stops at the first thing which can't be deleted,
+        raising its error. Use :func:`delete_tree` directly to carry on
+        past errors and collect them all.
 
         :param recursive: whether to remove all subdirectories and files first
+        :param workers: cf :func:`delete_tree`
         :returns: this :class:`Dir`
         """
         if recursive:
-            for dirpath, dirs, files in self.walk(depthfirst=True):
-                for d in dirs:
-                    d.delete(recursive=True)
-                for f in files:
-                    f.delete()
-
-        wrapped(win32file.RemoveDirectory, self._normpath)
+            summary = delete_tree(self, workers=workers, fail_fast=True)
+            if summary.errors:
+                filepath, exception = summary.errors[0]
+                raise exception
+        else:
+            wrapped(win32file.RemoveDirectory, self._normpath)
+        _invalidate(self._normpath, beneath=True)
         return self
 
     def watch(self, *args, **kwargs):
@@ -1792,7 +2370,7 @@ class Dir(Entry):
         """
         return watch(self, *args, **kwargs)
 
-    def zip(self, zip_filename=core.UNSET, mode="w", compression=zipfile.ZIP_DEFLATED):
+    def zip(self, zip_filename=core.UNSET, mode="w", compression=zipfile.ZIP_DEFLATED, workers=None):
         """Zip the directory up into a zip file. By default, the file will have the
         name of the directory with ".zip" appended and will be a sibling of the directory.
         Also by default a new zipfile will be created, overwriting any existing one, and
@@ -1801,17 +2379,28 @@ class Dir(Entry):
         A different zip filename can be specific as the zip_filename parameter, and this
         can be appended to (if it exists) by specifying "a" as the mode param.
 
+        If `workers` is given, the mode is "w" and the compression is ZIP_DEFLATED,
+        that many threads compress files at once (zlib releases the GIL while it
+        works) and this thread writes them into the archive in the order of
+        :meth:`flat`. Files larger than :const:`ZIP_BUFFERED_SIZE` are still
+        compressed as they're written so that they're never held in memory.
+
         The created / appended zip file is returned.
 
         :param zip_filename: The name of the zip file to hold the archive of this
                                                  directory and its children. [directory.zip]
         :param mode: cf zipfile.ZipFile
         :param compressions: cf zipfile.ZipFile
+        :param workers: how many threads compress files [None: compress in this thread]
         :returns: a :class:`File` object representing the resulting zip file
         """
         if zip_filename is core.UNSET:
             zip_filename = os.path.join(self.parent, self.name + ".zip")
 
+        if workers and mode == "w" and compression == zipfile.ZIP_DEFLATED:
+            _parallel_zip(zip_filename, self, workers)
+            return file(zip_filename)
+
         z = zipfile.ZipFile(zip_filename, mode=mode, compression=compression)
         try:
             for f in self.flat():
@@ -1825,6 +2414,8 @@ class Dir(Entry):
 
 class SharedDir(Dir):
 
+    __slots__ = ()
+
     def mounted_by(self):
         raise NotImplementedError
 
@@ -1835,7 +2426,249 @@ class SharedDir(Dir):
         raise NotImplementedError
 
 
-def files(pattern="*", ignore=[".", ".."], error_handler=None):
+class Matcher(object):
+    """A compiled form of one or more |-separated wildcard patterns, matched
+    against a filename without regard to case. Build one with :func:`matcher`,
+    which caches them, and pass it wherever a pattern is accepted by
+    :meth:`Entry.like` or :meth:`Dir.flat` to avoid recompiling it, eg::
+
+        from winsys import fs
+        sources = fs.matcher("*.py|*.pyw|*.pyx")
+        for f in fs.flat("c:/src", pattern=sources):
+            print(f)
+
+    :param pattern: one or more `fnmatch` patterns, separated by |
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self._regex = re.compile(
+            "|".join("(?:%s)" % fnmatch.translate(p) for p in pattern.split("|")),
+            re.IGNORECASE | re.UNICODE
+        )
+
+    def __repr__(self):
+        return "<%s: %s>" % (self.__class__.__name__, self.pattern)
+
+    def __eq__(self, other):
+        return isinstance(other, Matcher) and self.pattern == other.pattern
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.pattern)
+
+    def match(self, name):
+        """Return True if name matches any of this matcher's patterns
+        """
+        return self._regex.match(name) is not None
+    __call__ = match
+
+_matchers = {}
+_MAX_MATCHERS = 256
+
+def matcher(pattern):
+    """Return a :class:`Matcher` for one or more |-separated wildcard patterns,
+    reusing one already compiled for the same patterns if possible. A
+    :class:`Matcher` is passed straight back.
+
+    :param pattern: a :class:`Matcher` or a string of |-separated wildcards
+    :returns: a :class:`Matcher`
+    """
+    if isinstance(pattern, Matcher):
+        return pattern
+    try:
+        return _matchers[pattern]
+    except KeyError:
+        if len(_matchers) >= _MAX_MATCHERS:
+            _matchers.clear()
+        m = _matchers[pattern] = Matcher(pattern)
+        return m
+
+class Filter(object):
+    """Criteria tested against the raw data for each entry as a directory is
+    read, so that entries which fail are dropped before any object is built
+    for them. The size, time, attribute and name criteria apply to files;
+    directories are only dropped, along with everything beneath them, if
+    they match `prune_attributes` or `prune_name`. eg to find the large
+    files changed in the last week, ignoring hidden and system files and
+    without descending into junctions or .git directories::
+
+        import datetime
+        from winsys import fs
+        recent = fs.Filter(
+            min_size=10 * 1024 * 1024,
+            modified_after=datetime.timedelta(days=7),
+            attributes_none=["hidden", "system"],
+            prune_attributes="reparse_point",
+            prune_name="^[.]git$"
+        )
+        for f in fs.flat("c:/data", filter=recent):
+            print(f, f.size)
+
+    The same criteria can be passed as keyword arguments to :func:`files`,
+    :func:`walk` and :func:`flat` instead of as a Filter object.
+
+    :param min_size: files must be at least this many bytes
+    :param max_size: files must be no more than this many bytes
+    :param modified_after: files must have been written after this datetime or,
+                           if this is a timedelta, within that long before now
+    :param attributes_any: files must have at least one of these :const:`FILE_ATTRIBUTE` flags
+    :param attributes_none: files must have none of these :const:`FILE_ATTRIBUTE` flags
+    :param name: a regular expression, text or compiled, which must be found in the filename;
+                 text is compiled to ignore case
+    :param prune_attributes: directories with any of these :const:`FILE_ATTRIBUTE` flags are skipped
+    :param prune_name: a regular expression, text or compiled; directories whose name matches it are skipped
+    """
+
+    def __init__(
+        self,
+        min_size=None, max_size=None,
+        modified_after=None,
+        attributes_any=None, attributes_none=None,
+        name=None,
+        prune_attributes=None, prune_name=None
+    ):
+        self.min_size = min_size
+        self.max_size = max_size
+        if isinstance(modified_after, datetime.timedelta):
+            modified_after = datetime.datetime.now() - modified_after
+        self.modified_after = None if modified_after is None else utils.filetime_from_datetime(modified_after)
+        self.attributes_any = FILE_ATTRIBUTE.constant(attributes_any) or 0
+        self.attributes_none = FILE_ATTRIBUTE.constant(attributes_none) or 0
+        self.name = self._compiled(name)
+        self.prune_attributes = FILE_ATTRIBUTE.constant(prune_attributes) or 0
+        self.prune_name = self._compiled(prune_name)
+
+    @staticmethod
+    def _compiled(regex):
+        if isinstance(regex, basestring):
+            return re.compile(regex, re.IGNORECASE | re.UNICODE)
+        else:
+            return regex
+
+    def accepts(self, file_info):
+        """Return True if the FindFilesIterator tuple file_info passes these criteria
+        """
+        attributes = file_info[0]
+        if attributes & FILE_ATTRIBUTE.DIRECTORY:
+            if attributes & self.prune_attributes:
+                return False
+            if self.prune_name is not None and self.prune_name.search(file_info[8]):
+                return False
+            return True
+
+        if self.attributes_any and not attributes & self.attributes_any:
+            return False
+        if attributes & self.attributes_none:
+            return False
+        if self.min_size is not None or self.max_size is not None:
+            size = utils._longword(file_info[5], file_info[4])
+            if self.min_size is not None and size < self.min_size:
+                return False
+            if self.max_size is not None and size > self.max_size:
+                return False
+        if self.modified_after is not None and utils.filetime_from_pytime(file_info[3]) <= self.modified_after:
+            return False
+        if self.name is not None and not self.name.search(file_info[8]):
+            return False
+        return True
+
+def _filter(filter, criteria):
+    """Combine the filter and keyword criteria accepted by the walking
+    functions into a single :class:`Filter` or None.
+    """
+    if criteria:
+        if filter is not None:
+            raise x_fs(None, "_filter", "Pass either a filter or criteria, not both")
+        return Filter(**criteria)
+    else:
+        return filter
+
+class EntryRecord(object):
+    """A compact, read-only record of one entry in a directory listing, holding
+    only what the listing returned: the name, the raw attribute bits, the
+    times as integer FILETIMEs and the size. Records from the same directory
+    share a single copy of the directory path. Use this rather than a
+    :class:`File` or :class:`Dir` when holding very many entries at once,
+    eg via :func:`files`, :func:`flat` or :func:`walk` with `records=True`,
+    and call :meth:`entry` for the full object only where needed.
+
+    :func:`utils.from_filetime` will convert the times to datetimes.
+    """
+
+    __slots__ = ("dirpath", "name", "attributes", "created_at", "accessed_at", "written_at", "size", "reparse_tag")
+
+    def __init__(self, dirpath, name, attributes, created_at, accessed_at, written_at, size, reparse_tag=0):
+        self.dirpath = dirpath
+        self.name = name
+        self.attributes = attributes
+        self.created_at = created_at
+        self.accessed_at = accessed_at
+        self.written_at = written_at
+        self.size = size
+        self.reparse_tag = reparse_tag
+
+    @classmethod
+    def from_find_data(cls, dirpath, file_info):
+        """Build a record from the tuple returned by FindFilesIterator for
+        an entry in the directory dirpath.
+        """
+        return cls(
+            dirpath,
+            file_info[8],
+            file_info[0],
+            utils.filetime_from_pytime(file_info[1]),
+            utils.filetime_from_pytime(file_info[2]),
+            utils.filetime_from_pytime(file_info[3]),
+            utils._longword(file_info[5], file_info[4]),
+            file_info[6]
+        )
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.filepath)
+
+    def __str__(self):
+        return self.filepath
+    __unicode__ = __str__
+
+    def __eq__(self, other):
+        return self.filepath.lower() == unicode(other).lower()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.filepath.lower())
+
+    def _get_filepath(self):
+        return os.path.join(self.dirpath, self.name)
+    filepath = property(_get_filepath)
+
+    def _get_directory(self):
+        return bool(self.attributes & FILE_ATTRIBUTE.DIRECTORY)
+    directory = property(_get_directory)
+
+    def like(self, pattern):
+        """cf :meth:`Entry.like`
+        """
+        return matcher(pattern).match(self.name)
+
+    def entry(self):
+        """Return the :class:`File` or :class:`Dir` object corresponding to
+        this record, with the metadata from the record already in place.
+        """
+        e = (Dir if self.directory else File)(self.filepath)
+        e._attributes = constants.Attributes(self.attributes, FILE_ATTRIBUTE)
+        e._created_at = utils.from_filetime(self.created_at)
+        e._accessed_at = utils.from_filetime(self.accessed_at)
+        e._written_at = utils.from_filetime(self.written_at)
+        e._size = self.size
+        e._reparse_tag = self.reparse_tag
+        return e
+
+def files(pattern="*", ignore=[".", ".."], error_handler=None, records=False, filter=None, **criteria):
     """Iterate over files and directories matching pattern, which can include
     a path. Calls win32file.FindFilesIterator under the covers, which uses
     FindFirstFile / FindNextFile.
@@ -1843,13 +2676,31 @@ def files(pattern="*", ignore=[".", ".."], error_handler=None):
     :pattern: A string with one or more wildcard patterns, pipe-separated
     :ignore: A container of specific paths to ignore
     :error_handler: a callable which is passed sys.exc_info and returns True if the iteration is to continue, False otherwise
+    :records: whether to yield an :class:`EntryRecord` for each entry instead of a :class:`File` or :class:`Dir` [False]
+    :filter: a :class:`Filter` which entries must pass
+    :criteria: keyword arguments for a :class:`Filter`, as an alternative to `filter`
     """
-    for p in pattern.split("|"):
-        p = p.rstrip("/\\")
-        for f in _files(p, ignore=ignore, error_handler=error_handler):
+    filter = _filter(filter, criteria)
+    patterns = [p.rstrip(seps) for p in pattern.split("|")]
+    if len(patterns) == 1:
+        for f in _files(patterns[0], ignore=ignore, error_handler=error_handler, records=records, filter=filter):
             yield f
+        return
 
-def _files(pattern="*", ignore=[".", ".."], error_handler=None):
+    #
+    # Each pattern is passed to FindFirstFile in turn so that the Windows
+    # wildcard rules -- including matches on short names -- apply to all
+    # of them. An entry matched by more than one is only yielded once.
+    #
+    seen = set()
+    for p in patterns:
+        for f in _files(p, ignore=ignore, error_handler=error_handler, records=records, filter=filter):
+            key = unicode(f).lower()
+            if key not in seen:
+                seen.add(key)
+                yield f
+
+def _files(pattern="*", ignore=[".", ".."], error_handler=None, records=False, filter=None, match=None):
     #
     # special-case ".": FindFilesIterator treats a directory
     # name as an invitation to return only that directory.
@@ -1860,6 +2711,41 @@ def _files(pattern="*", ignore=[".", ".."], error_handler=None):
         yield Dir(".")
         return
 
+    for dirpath, file_info in _find_data(pattern, ignore, error_handler):
+        if match is not None and not match(file_info[8]):
+            continue
+        if filter is not None and not filter.accepts(file_info):
+            continue
+        if records:
+            yield EntryRecord.from_find_data(dirpath, file_info)
+        else:
+            yield entry(os.path.join(dirpath, file_info[8]), file_info)
+
+def _find_data(pattern, ignore=[".", ".."], error_handler=None):
+    """Yield the directory and the raw FindFilesIterator tuple for each
+    entry matching pattern, building no objects on the way. This is the
+    basis for :func:`files` and for anything which needs to get through
+    large numbers of entries as cheaply as possible.
+    """
+    parts = get_parts(unicode(pattern))
+    dirpath = parts[0] + sep.join(parts[1:-1])
+
+    #
+    # If this is a whole-directory listing beneath a root held by
+    # the listing cache, serve it from there if possible or else
+    # record it there as it is read.
+    #
+    recording = None
+    cache = _listing_cache
+    if cache is not None and parts[-1] == "*":
+        file_infos = cache.get(dirpath)
+        if file_infos is not None:
+            for file_info in file_infos:
+                if file_info[8] not in ignore:
+                    yield dirpath, file_info
+            return
+        recording = cache.recording(dirpath)
+
     try:
         iterator = wrapped(win32file.FindFilesIterator, pattern)
     except x_no_such_file:
@@ -1880,17 +2766,12 @@ def _files(pattern="*", ignore=[".", ".."], error_handler=None):
         else:
             raise
 
-    parts = get_parts(unicode(pattern))
-    dirpath = parts[0] + sep.join(parts[1:-1])
     while True:
         try:
             file_info = next(iterator)
-            filename = file_info[8]
-            if filename in ignore:
-                continue
-            filepath = os.path.join(dirpath, filename)
-            yield entry(filepath, file_info)
         except StopIteration:
+            if recording is not None:
+                cache.put(dirpath, recording)
             break
         except x_no_such_file:
             #
@@ -1906,39 +2787,303 @@ def _files(pattern="*", ignore=[".", ".."], error_handler=None):
             #
             if error_handler and error_handler(sys.exc_info()):
                 core.warn("Error %s ignored", sys.exc_info()[0])
+                recording = None
                 continue
             else:
                 raise
 
-def entry(filepath, _file_info=core.UNSET):
-    """Return a :class:`File` or :class:`Dir` object representing this
-    filepath.
-
-    ======================================= ==================================================
-    filepath                                Result
-    ======================================= ==================================================
-    :const:`None` or ""                     :const:`None`
-    an :class:`Entry` or subclass object    the same object
-    an existing file name                   a :class:`File` object representing that file
-    an existing directory name              a :class:`Dir` object representing that directory
-    a file name which doesn't exist         a :class:`Dir` if filepath ends with \\,
-                                            :class:`File` otherwise
-    ======================================= ==================================================
+        if recording is not None:
+            recording.append(file_info)
+        if file_info[8] in ignore:
+            continue
+        yield dirpath, file_info
+
+def _listing(dir, error_handler=None, records=False, filter=None):
+    """Split the entries of one directory into its subdirectories and its
+    files, the unit of work for each step of a walk. If records is True,
+    dir may be an :class:`EntryRecord` and records are returned. Anything
+    rejected by filter is left out, so pruned directories are never visited.
     """
-    def _guess(filepath):
-        """If the path doesn't exist on the filesystem,
-        guess whether it's intended to be a dir or a file
-        by looking for a trailing slash.
-        """
-        if filepath.endswith(sep):
-            return Dir(filepath)
+    dirs, nondirs = [], []
+    pattern = os.path.join(unicode(dir), "*")
+    for f in _files(pattern, error_handler=error_handler, records=records, filter=filter):
+        if (f.attributes & FILE_ATTRIBUTE.DIRECTORY) if records else isinstance(f, Dir):
+            dirs.append(f)
         else:
-            return File(filepath)
+            nondirs.append(f)
+    return dirs, nondirs
 
-    if filepath is None or filepath == "":
-        return None
-    elif isinstance(filepath, Entry):
-        return filepath
+def _get(q, timeout_s=0.5):
+    """Block on a queue in such a way that the wait can be interrupted
+    by a KeyboardInterrupt.
+    """
+    while True:
+        try:
+            return q.get(timeout=timeout_s)
+        except queue.Empty:
+            continue
+
+class _WalkNode(object):
+    """One directory in a multi-threaded walk. Its key is the path of
+    child indexes leading to it from the top of the walk, so sorting on
+    the key gives the order in which a single-threaded walk would
+    visit the directories.
+    """
+
+    def __init__(self, dir, key, parent=None):
+        self.dir = dir
+        self.key = key
+        self.parent = parent
+        self.dirs = self.files = None
+        self.children = []
+        self.exc_info = None
+        self.cancelled = False
+        self.holds_slot = False
+        self.n_pending = 0
+        self.listed = threading.Event()
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+    def is_cancelled(self):
+        node = self
+        while node is not None:
+            if node.cancelled:
+                return True
+            node = node.parent
+        return False
+
+    def result(self):
+        """Wait for this directory to be listed and return the tuple to be
+        yielded by the walk, raising whatever error escaped the listing.
+        """
+        while not self.listed.wait(0.5):
+            pass
+        if self.exc_info:
+            raise self.exc_info[1]
+        return self.dir, self.dirs, self.files
+
+    def prune(self, pool):
+        """Cancel any subdirectory which the caller has removed from the
+        list of dirs yielded, mimicking the os.walk convention, and give
+        back the slots held by anything already listed beneath it.
+        """
+        remaining = set(self.dirs)
+        for child in self.children:
+            if child.dir not in remaining:
+                child.cancelled = True
+                pool.release_tree(child)
+        return [child for child in self.children if not child.cancelled]
+
+    def done(self):
+        """Drop the listing once it has been yielded so that only the
+        directories still to be visited are held, not the whole tree.
+        """
+        self.dirs = self.files = None
+        self.children = []
+
+class _WalkerPool(object):
+    """A fixed number of threads taking directories from a shared queue,
+    listing them and putting their subdirectories back on the same queue.
+    The queue is ordered by each directory's position in a single-threaded
+    walk so the directories the caller needs soonest are listed first.
+
+    A worker must take one of a fixed number of slots before listing a
+    directory, and the slot is only given back once the caller has taken
+    the listing, so the workers can't get more than `LOOKAHEAD` listings
+    per worker ahead of the caller however big the tree is.
+    """
+
+    LOOKAHEAD = 32
+
+    def __init__(self, error_handler, records, filter, n_workers, on_listed=None):
+        self.error_handler = error_handler
+        self.records = records
+        self.filter = filter
+        self.on_listed = on_listed
+        self.queue = queue.PriorityQueue()
+        self.slots = threading.Semaphore(self.LOOKAHEAD * n_workers)
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.threads = [threading.Thread(target=self._work) for _ in range(n_workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, node):
+        self.queue.put(node)
+
+    def release(self, node):
+        """Give back the slot taken to list node, if it is still held
+        """
+        with self.lock:
+            if node.holds_slot:
+                node.holds_slot = False
+                self.slots.release()
+
+    def release_tree(self, node):
+        """Give back the slots held by node and anything listed beneath it,
+        none of which will now be yielded
+        """
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            self.release(node)
+            stack.extend(node.children)
+
+    def stop(self):
+        #
+        # An empty key sorts ahead of every real directory so
+        # the workers will pick these up next.
+        #
+        self.stopped = True
+        for _ in self.threads:
+            self.slots.release()
+            self.queue.put(_WalkNode(None, ()))
+
+    def _work(self):
+        while True:
+            self.slots.acquire()
+            node = self.queue.get()
+            if node.dir is None or self.stopped:
+                break
+            node.holds_slot = True
+            if not node.is_cancelled():
+                try:
+                    node.dirs, node.files = _listing(node.dir, self.error_handler, self.records, self.filter)
+                except:
+                    node.exc_info = sys.exc_info()
+                else:
+                    node.children = [
+                        _WalkNode(d, node.key + (i,), node) for (i, d) in enumerate(node.dirs)
+                    ]
+            #
+            # A directory cancelled before or while it was listed won't be
+            # taken by the caller so its slot is given back here.
+            #
+            if node.is_cancelled():
+                self.release(node)
+            if self.on_listed:
+                #
+                # Report this directory before queueing its children so that
+                # a parent is always seen before any of its subdirectories.
+                #
+                node.listed.set()
+                self.on_listed(node)
+                for child in node.children:
+                    self.submit(child)
+            else:
+                #
+                # Queue the children before the caller can take this directory
+                # so that the next directory it needs is always waiting for the
+                # next free slot.
+                #
+                for child in node.children:
+                    self.submit(child)
+                node.listed.set()
+
+def _ordered_walk(root, depthfirst, pool):
+    if depthfirst:
+        root.result()
+        pool.release(root)
+        stack = [(root, iter(root.children))]
+        while stack:
+            node, children = stack[-1]
+            for child in children:
+                child.result()
+                pool.release(child)
+                stack.append((child, iter(child.children)))
+                break
+            else:
+                stack.pop()
+                yield node.result()
+                node.done()
+    else:
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            result = node.result()
+            pool.release(node)
+            yield result
+            stack.extend(reversed(node.prune(pool)))
+            node.done()
+
+def _unordered_walk(root, depthfirst, results, pool):
+    n_outstanding = 1
+    while n_outstanding:
+        node = _get(results)
+        pool.release(node)
+        n_outstanding += len(node.children) - 1
+        if node.exc_info:
+            raise node.exc_info[1]
+        if node.is_cancelled():
+            node.done()
+            continue
+        if depthfirst:
+            #
+            # A directory can only be yielded once all its subdirectories
+            # have been, which may in turn release its own parent.
+            #
+            node.n_pending = len(node.children)
+            while node is not None and node.n_pending == 0:
+                yield node.result()
+                node.done()
+                node = node.parent
+                if node is not None:
+                    node.n_pending -= 1
+        else:
+            yield node.result()
+            node.prune(pool)
+            node.done()
+
+def _parallel_walk(top, depthfirst, error_handler, records, filter, n_workers, ordered):
+    """Implement :meth:`Dir.walk` with `n_workers` threads listing
+    directories. The threads are started on the first iteration and
+    stopped when the walk finishes or is abandoned.
+    """
+    results = None if ordered else queue.Queue()
+    pool = _WalkerPool(error_handler, records, filter, n_workers, None if ordered else results.put)
+    root = _WalkNode(top, (0,))
+    pool.submit(root)
+    try:
+        if ordered:
+            walker = _ordered_walk(root, depthfirst, pool)
+        else:
+            walker = _unordered_walk(root, depthfirst, results, pool)
+        for x in walker:
+            yield x
+    finally:
+        pool.stop()
+
+def entry(filepath, _file_info=core.UNSET):
+    """Return a :class:`File` or :class:`Dir` object representing this
+    filepath.
+
+    ======================================= ==================================================
+    filepath                                Result
+    ======================================= ==================================================
+    :const:`None` or ""                     :const:`None`
+    an :class:`Entry` or subclass object    the same object
+    an existing file name                   a :class:`File` object representing that file
+    an existing directory name              a :class:`Dir` object representing that directory
+    a file name which doesn't exist         a :class:`Dir` if filepath ends with \\,
+                                            :class:`File` otherwise
+    ======================================= ==================================================
+    """
+    def _guess(filepath):
+        """If the path doesn't exist on the filesystem,
+        guess whether it's intended to be a dir or a file
+        by looking for a trailing slash.
+        """
+        if filepath.endswith(sep):
+            return Dir(filepath)
+        else:
+            return File(filepath)
+
+    if filepath is None or filepath == "":
+        return None
+    elif isinstance(filepath, Entry):
+        return filepath
     else:
         filepath = unicode(filepath)
         if _file_info is core.UNSET:
@@ -1985,14 +3130,164 @@ def dir(filepath):
         else:
             return Dir(unicode(filepath))
 
-def glob(pattern):
+_GLOB_MAGIC = re.compile(r"[*?\[]")
+_GLOB_WILDCARDS = re.compile(r"[*?]")
+_GLOB_BRACES = re.compile(r"\{([^{},]*,[^{}]*)\}")
+
+def _expand_braces(pattern):
+    """Expand each {a,b,...} alternation in pattern, innermost first,
+    returning the list of distinct patterns which results. Braces without
+    a comma, such as those in a volume name, are left alone.
+    """
+    match = _GLOB_BRACES.search(pattern)
+    if not match:
+        return [pattern]
+    patterns = []
+    for alternative in match.group(1).split(","):
+        for p in _expand_braces(pattern[:match.start()] + alternative + pattern[match.end():]):
+            if p not in patterns:
+                patterns.append(p)
+    return patterns
+
+def glob(pattern, error_handler=None):
     """Mimic the built-in glob.glob functionality as a generator,
-    optionally ignoring access errors.
+    optionally ignoring access errors. As well as the usual wildcards
+    and character classes, pattern can contain {a,b} alternatives and
+    ** to match any number of directories, eg::
+
+        from winsys import fs
+        for f in fs.glob("c:/logs/**/2024-*/*.{log,txt}"):
+            print(f)
+
+    Path segments without wildcards are looked up directly and only those
+    directories which could still lead to a match are read, so a sparse
+    pattern over a large tree reads only a small part of it. A trailing
+    ** matches everything beneath that point. ** does not follow junctions
+    or symbolic links to directories.
+
+    :param pattern: a path with wildcards in any segment; several patterns can be separated by |
+    :param error_handler: as for :func:`files`
+    :returns: yields a :class:`File` or :class:`Dir` object for each matching entry
+    """
+    #
+    # A pattern whose wildcards are all in its last segment is
+    # exactly what FindFirstFile does by itself.
+    #
+    if not re.search(r"\*\*|[\[{]", pattern) and not _GLOB_MAGIC.search(os.path.dirname(pattern)):
+        return files(pattern, error_handler=error_handler)
+    return _glob(pattern, error_handler)
+
+def _glob(pattern, error_handler):
+    patterns = []
+    for p in pattern.split("|"):
+        patterns.extend(_expand_braces(p.rstrip(seps)))
+    seen = set() if len(patterns) > 1 or pattern.count("**") > 1 else None
+    for p in patterns:
+        for f in _glob_one(p, error_handler):
+            if seen is not None:
+                key = f._normpath.lower()
+                if key in seen:
+                    continue
+                seen.add(key)
+            yield f
+
+def _glob_one(pattern, error_handler):
+    parts = get_parts(pattern)
+    segments = []
+    for segment in parts[1:]:
+        if segment and not (segment == "**" and segments[-1:] == ["**"]):
+            segments.append(segment)
+    if not segments:
+        for f in files(pattern, error_handler=error_handler):
+            yield f
+        return
+    if segments[-1] == "**":
+        segments.append("*")
+
+    #
+    # Each item on the stack is a directory which has matched the first
+    # n segments of the pattern; it is only read if the next segment
+    # has wildcards in it.
+    #
+    last = len(segments) - 1
+    stack = [(parts[0], 0)]
+    while stack:
+        dirpath, n = stack.pop()
+        segment = segments[n]
+
+        if segment == "**":
+            subdirs = []
+            for _, file_info in _find_data(os.path.join(dirpath, "*"), error_handler=error_handler):
+                attributes = file_info[0]
+                if attributes & FILE_ATTRIBUTE.DIRECTORY and not attributes & FILE_ATTRIBUTE.REPARSE_POINT:
+                    subdirs.append((os.path.join(dirpath, file_info[8]), n))
+            stack.extend(reversed(subdirs))
+            stack.append((dirpath, n + 1))
+            continue
+
+        if not _GLOB_WILDCARDS.search(segment):
+            #
+            # A segment without * or ? is looked up as it stands. Square
+            # brackets are legal in Windows filenames, so one containing
+            # them is only treated as a character class if it isn't found.
+            #
+            filepath = os.path.join(dirpath, segment)
+            file_attribute_data = _glob_lookup(filepath, error_handler)
+            if file_attribute_data is not None:
+                is_dir = file_attribute_data[0] & FILE_ATTRIBUTE.DIRECTORY
+                if n == last:
+                    f = (Dir if is_dir else File)(filepath)
+                    f._set_file_attribute_data(file_attribute_data)
+                    yield f
+                elif is_dir:
+                    stack.append((filepath, n + 1))
+                continue
+            if "[" not in segment:
+                continue
 
-    :param pattern: passed to :func:`files`
-    :returns: yields a :class:`FilePath` object for each matching file
+        #
+        # Likewise, if a character class matches nothing in this
+        # directory, names which contain the brackets are used instead.
+        #
+        match = matcher(segment).match
+        match_literally = matcher(segment.replace("[", "[[]")).match if "[" in segment else None
+        subdirs = []
+        found_literally = []
+        n_found = 0
+        for _, file_info in _find_data(os.path.join(dirpath, "*"), error_handler=error_handler):
+            if match(file_info[8]):
+                n_found += 1
+            else:
+                if match_literally is not None and match_literally(file_info[8]):
+                    found_literally.append(file_info)
+                continue
+            filepath = os.path.join(dirpath, file_info[8])
+            if n == last:
+                yield entry(filepath, file_info)
+            elif file_info[0] & FILE_ATTRIBUTE.DIRECTORY:
+                subdirs.append((filepath, n + 1))
+        if not n_found:
+            for file_info in found_literally:
+                filepath = os.path.join(dirpath, file_info[8])
+                if n == last:
+                    yield entry(filepath, file_info)
+                elif file_info[0] & FILE_ATTRIBUTE.DIRECTORY:
+                    subdirs.append((filepath, n + 1))
+        stack.extend(reversed(subdirs))
+
+def _glob_lookup(filepath, error_handler):
+    """Return the file attribute data for filepath, or None if there is no
+    such file or if error_handler has dealt with an error looking it up
     """
-    return files(pattern)
+    try:
+        return _file_attribute_data(normalised(filepath))
+    except x_no_such_file:
+        return None
+    except:
+        if error_handler and error_handler(sys.exc_info()):
+            return None
+        else:
+            raise
 
 def listdir(d):
     """Mimic the built-in os.list functionality as a generator,
@@ -2003,18 +3298,35 @@ def listdir(d):
     """
     return (f.name for f in files(dir(d) + "*"))
 
-def walk(root, depthfirst=False, error_handler=None):
+def walk(root, depthfirst=False, error_handler=None, workers=None, ordered=True, records=False, filter=None, **criteria):
     """Walk the directory tree starting from root, optionally ignoring
-    access errors.
+    access errors and optionally listing directories in several threads
+    at once::
+
+        from winsys import fs
+        for dirpath, dirs, files in fs.walk("//server/share", workers=8, ordered=False):
+            print(dirpath, sum(f.size for f in files))
 
     :param root: anything accepted by :func:`dir`
     :param depthfirst: passed to :meth:`Dir.walk`
     :param error_handler: passed to :meth:`Dir.walk`
+    :param workers: passed to :meth:`Dir.walk`
+    :param ordered: passed to :meth:`Dir.walk`
+    :param records: passed to :meth:`Dir.walk`
+    :param filter: passed to :meth:`Dir.walk`
+    :param criteria: passed to :meth:`Dir.walk`
     :returns: as :meth:`Dir.walk`
     """
-    return dir(root).walk(depthfirst=depthfirst, error_handler=error_handler)
+    return dir(root).walk(
+        depthfirst=depthfirst,
+        error_handler=error_handler,
+        workers=workers,
+        ordered=ordered,
+        records=records,
+        filter=_filter(filter, criteria)
+    )
 
-def flat(root, pattern="*", includedirs=False, depthfirst=False, error_handler=None):
+def flat(root, pattern="*", includedirs=False, depthfirst=False, error_handler=None, workers=None, ordered=True, records=False, filter=None, **criteria):
     """Iterate over a flattened version of the directory tree starting
     from root. Implemented via :meth:`Dir.flat`.
 
@@ -2023,164 +3335,1938 @@ def flat(root, pattern="*", includedirs=False, depthfirst=False, error_handler=N
     :param includedirs: passed to :meth:`Dir.flat`
     :param depthfirst: passed to :meth:`Dir.flat`
     :param error_handler: passed to :meth:`Dir.flat`
+    :param workers: passed to :meth:`Dir.flat`
+    :param ordered: passed to :meth:`Dir.flat`
+    :param records: passed to :meth:`Dir.flat`
+    :param filter: passed to :meth:`Dir.flat`
+    :param criteria: passed to :meth:`Dir.flat`
     :returns: as :meth:`Dir.flat`
     """
     return dir(root).flat(
         pattern,
         includedirs=includedirs,
         depthfirst=depthfirst,
-        error_handler=error_handler
+        error_handler=error_handler,
+        workers=workers,
+        ordered=ordered,
+        records=records,
+        filter=_filter(filter, criteria)
     )
 
-def progress_wrapper(callback):
-
-    def _progress_wrapper(
-        TotalFileSize, TotalBytesTransferred,
-        StreamSize, StreamBytesTransferred, StreamNumber,
-        CallbackReason,
-        SourceFile, DestinationFile,
-        data
-    ):
-        if callback(TotalFileSize, TotalBytesTransferred, data):
-            return PROGRESS.CANCEL
-        else:
-            return PROGRESS.CONTINUE
+class Inventory(core._WinSysObject):
+    """The files beneath a directory held column by column rather than as
+    one object per file, as built by :func:`inventory`. Each file has an
+    index into these parallel columns:
 
-    if callback:
-        return _progress_wrapper
-    else:
-        return None
+    * :attr:`sizes` - array of 64-bit sizes
+    * :attr:`created_at`, :attr:`accessed_at`, :attr:`written_at` - arrays of 64-bit integer FILETIMEs
+    * :attr:`attributes` - array of 32-bit attribute bits (cf :const:`FILE_ATTRIBUTE`)
+    * :attr:`dir_indexes` - array of indexes into :attr:`dirpaths`, the list of directories seen
+    * :attr:`ext_indexes` - array of indexes into :attr:`exts`, the list of lowercase extensions seen
 
-def move(source_filepath, *args, **kwargs):
-    """Move one :class:`Entry` object to another, implemented via :meth:`File.move` or :meth:`Dir.move`
+    The filenames are held together in one buffer; use :meth:`name` or
+    :meth:`filepath` to get one back. If NumPy is installed, :meth:`numpy`
+    returns a NumPy view on each column without copying it, eg::
 
-    :param source_filepath: anything accepted by :func:`entry`
+        from winsys import fs
+        inv = fs.inventory("c:/data")
+        columns = inv.numpy()
+        bytes_by_ext = numpy.bincount(columns['ext_indexes'], weights=columns['sizes'])
     """
-    return entry(source_filepath).move(*args, **kwargs)
 
-def copy(source_filepath, *args, **kwargs):
-    """Copy one :class:`Entry` object to another, implemented via :meth:`File.copy` or :meth:`Dir.copy`
+    NUMERIC_COLUMNS = ["sizes", "created_at", "accessed_at", "written_at", "attributes", "dir_indexes", "ext_indexes"]
 
-    :param source_filepath: anything accepted by :func:`entry`
-    """
-    return entry(source_filepath).copy(*args, **kwargs)
+    def __init__(self, root):
+        self.root = root
+        self.sizes = array.array("q")
+        self.created_at = array.array("q")
+        self.accessed_at = array.array("q")
+        self.written_at = array.array("q")
+        self.attributes = array.array("I")
+        self.dir_indexes = array.array("I")
+        self.ext_indexes = array.array("I")
+        self.dirpaths = []
+        self.exts = []
+        self._ext_lookup = {}
+        self._names = bytearray()
+        self._name_offsets = array.array("q", [0])
 
-def delete(filepath):
-    """Deletes a :class:`Entry` object, implemented via :meth:`File.delete` or :meth:`Dir.delete`
+    def as_string(self):
+        return "Inventory of %s (%d files in %d directories)" % (self.root, len(self), len(self.dirpaths))
 
-    :param filepath: anything accepted by :func:`entry`
-    """
-    return entry(filepath).delete()
+    def dumped(self, level=0):
+        output = []
+        output.append("root: %s" % self.root)
+        output.append("files: %d" % len(self))
+        output.append("directories: %d" % len(self.dirpaths))
+        output.append("total size: %s" % utils.size_as_mb(sum(self.sizes)))
+        return utils.dumped("\n".join(output), level)
 
-def rmdir(filepath, recursive=False):
-    """Mimic the os.rmdir functionality, optionally recursing
+    def __len__(self):
+        return len(self.sizes)
 
-    :param filepath: anything accepted by :func:`dir`
-    :param recursive: passed to :meth:`Dir.delete`
-    """
-    return dir(filepath).delete(recursive=recursive)
+    def add_dir(self, dirpath):
+        """Add dirpath to the directories table and return its index
+        """
+        self.dirpaths.append(dirpath)
+        return len(self.dirpaths) - 1
 
-def attributes(filepath):
-    """Return an :class:`constants.Attributes` object representing the file attributes
-    of filepath, implemented via :meth:`Entry.attributes`
+    def add(self, dir_index, file_info):
+        """Add one file from the raw FIND data for it and the index of its directory
+        """
+        name = file_info[8]
+        ext = os.path.splitext(name)[1].lower()
+        ext_index = self._ext_lookup.get(ext)
+        if ext_index is None:
+            ext_index = self._ext_lookup[ext] = len(self.exts)
+            self.exts.append(ext)
+        self.sizes.append(utils._longword(file_info[5], file_info[4]))
+        self.created_at.append(utils.filetime_from_pytime(file_info[1]))
+        self.accessed_at.append(utils.filetime_from_pytime(file_info[2]))
+        self.written_at.append(utils.filetime_from_pytime(file_info[3]))
+        self.attributes.append(file_info[0])
+        self.dir_indexes.append(dir_index)
+        self.ext_indexes.append(ext_index)
+        self._names.extend(name.encode("utf-16-le"))
+        self._name_offsets.append(len(self._names))
+
+    def name(self, i):
+        """Return the filename of the i-th file
+        """
+        return self._names[self._name_offsets[i]:self._name_offsets[i + 1]].decode("utf-16-le")
 
-    :param filepath: anything accepted by :func:`entry`
-    :returns: an :class:`constants.Attributes` object
-    """
-    return entry(filepath).attributes
+    def filepath(self, i):
+        """Return the full path of the i-th file
+        """
+        return os.path.join(self.dirpaths[self.dir_indexes[i]], self.name(i))
 
-def exists(filepath):
-    """Mimic os.path.exists, implemented via the :class:`Entry` boolean mechanism
+    def filepaths(self):
+        """Iterate over the full path of every file, in index order
+        """
+        for i in range(len(self)):
+            yield self.filepath(i)
 
-    :param filepath: anything accepted by :func:`entry`
-    :returns: :const:`True` if filepath exists, :const:`False` otherwise
-    """
-    return bool(entry(filepath))
+    def size_by_ext(self):
+        """Return a dictionary mapping each lowercase extension to the total size of
+        the files with that extension.
+        """
+        totals = [0] * len(self.exts)
+        for ext_index, size in zip(self.ext_indexes, self.sizes):
+            totals[ext_index] += size
+        return dict(zip(self.exts, totals))
+
+    def numpy(self):
+        """Return a dictionary mapping the name of each numeric column to a
+        NumPy array sharing that column's memory. NumPy is only needed if this
+        is called.
+        """
+        try:
+            import numpy
+        except ImportError:
+            raise x_fs(None, "Inventory.numpy", "NumPy is not installed")
+        dtypes = dict(q=numpy.int64, I=numpy.uint32)
+        columns = {}
+        for name in self.NUMERIC_COLUMNS:
+            column = getattr(self, name)
+            columns[name] = numpy.frombuffer(column, dtype=dtypes[column.typecode]) if column else numpy.zeros(0, dtypes[column.typecode])
+        return columns
+
+def inventory(root, error_handler=None):
+    """Read every file beneath root into an :class:`Inventory`, which holds
+    the sizes, times and attributes in flat arrays instead of building an
+    object for each file. This is intended for reports over very large trees
+    which only need totals, counts or distributions::
 
-def mkdir(dirpath, *args, **kwargs):
-    """Mimic os.mkdir, implemented via :meth:`Dir.create`
+        from winsys import fs
+        inv = fs.inventory("c:/data")
+        for ext, size in sorted(inv.size_by_ext().items(), key=lambda x: -x[1])[:10]:
+            print(ext, size)
+
+    :param root: anything accepted by :func:`dir`
+    :param error_handler: as for :meth:`Dir.walk`
+    :returns: an :class:`Inventory`
     """
-    return dir(dirpath).create(*args, **kwargs)
+    root = dir(root)
+    inv = Inventory(root)
+    stack = [unicode(root)]
+    while stack:
+        dirpath = stack.pop()
+        dir_index = inv.add_dir(dirpath)
+        for _, file_info in _find_data(os.path.join(dirpath, "*"), error_handler=error_handler):
+            if file_info[0] & FILE_ATTRIBUTE.DIRECTORY:
+                stack.append(os.path.join(dirpath, file_info[8]))
+            else:
+                inv.add(dir_index, file_info)
+    return inv
+
+_TOP_KEYS = {
+    "size" : lambda dirpath, file_info: utils._longword(file_info[5], file_info[4]),
+    "written_at" : lambda dirpath, file_info: utils.filetime_from_pytime(file_info[3]),
+    "created_at" : lambda dirpath, file_info: utils.filetime_from_pytime(file_info[1]),
+    "accessed_at" : lambda dirpath, file_info: utils.filetime_from_pytime(file_info[2]),
+}
 
-def touch(filepath):
-    """Update a file's modification time, creating it if it
-    does not exist, implemented via :meth:`File.create`
+def _top_key(key):
+    """Return a function of (dirpath, file_info) which gives the value by
+    which :func:`top_files` ranks a file: one of the :data:`_TOP_KEYS`
+    or a function of an :class:`EntryRecord`.
+    """
+    if callable(key):
+        return lambda dirpath, file_info: key(EntryRecord.from_find_data(dirpath, file_info))
+    try:
+        return _TOP_KEYS[key]
+    except KeyError:
+        raise x_fs(None, "top_files", "key must be one of %s or a function" % ", ".join(sorted(_TOP_KEYS)))
+
+def _file_info(name, file_attribute_data):
+    """Build a tuple which looks like a FindFilesIterator tuple from what
+    GetFileAttributesEx returns so that it can be filtered and ranked in
+    the same way as an entry read from a directory listing.
+    """
+    attributes, created_at, accessed_at, written_at, size = file_attribute_data
+    return (attributes, created_at, accessed_at, written_at, size >> 32, size & 0xFFFFFFFF, 0, 0, name, "")
 
-    :param filepath: anything accepted by :func:`file`
+def _top_candidates(root, filter=None, error_handler=None, stopped=None):
+    """Yield the directory and FindFilesIterator tuple for every file
+    beneath root which passes filter, building no objects on the way.
+    If stopped is given, no more directories are read once it is set.
     """
-    return file(filepath).create()
+    stack = [root]
+    while stack and not (stopped is not None and stopped.is_set()):
+        dirpath = stack.pop()
+        for _, file_info in _find_data(os.path.join(dirpath, "*"), error_handler=error_handler):
+            if filter is not None and not filter.accepts(file_info):
+                continue
+            if file_info[0] & FILE_ATTRIBUTE.DIRECTORY:
+                stack.append(os.path.join(dirpath, file_info[8]))
+            else:
+                yield dirpath, file_info
 
-def mount(filepath, vol):
-    """Mount vol at filepath, implemented via :meth:`Dir.mount`
+def _top_heap(candidates, n, key_function):
+    """Keep the n highest-ranked of candidates in a min-heap of (value,
+    tiebreak, dirpath, file_info), so that memory use doesn't depend on
+    how many candidates there are.
 
-    :param filepath: anything accepted by :func:`dir`
-    :param vol: passed to :meth:`Dir.mount`
+    :returns: the heap and the highest value turned away, or None if none was
     """
-    return dir(filepath).mount(vol)
+    heap = []
+    counter = itertools.count()
+    floor = None
+    for dirpath, file_info in candidates:
+        value = key_function(dirpath, file_info)
+        if len(heap) < n:
+            heapq.heappush(heap, (value, next(counter), dirpath, file_info))
+            continue
+        if heap and value > heap[0][0]:
+            value = heapq.heapreplace(heap, (value, next(counter), dirpath, file_info))[0]
+        if floor is None or value > floor:
+            floor = value
+    return heap, floor
+
+def top_files(root, n=10, key="size", error_handler=None, filter=None, **criteria):
+    """Return the n largest -- or newest, or whatever `key` ranks highest --
+    files beneath root, highest first, as :class:`EntryRecord` objects. The
+    tree is read straight from the directory listings and only the best n
+    files so far are held at any time, so this costs the same in memory
+    however many files there are::
 
-def dismount(filepath):
-    """Dismount the volume at filepath, implemented via :meth:`Dir.dismount`
+        from winsys import fs
+        for f in fs.top_files("c:/data", 20, key="written_at", attributes_none="hidden"):
+            print(f, f.size)
 
-    :param filepath: anything accepted by :func:`dir`
+    To keep the list up-to-date as files change, use :func:`watch_top_files`.
+
+    :param root: anything accepted by :func:`dir`
+    :param n: how many files to return
+    :param key: one of "size", "written_at", "created_at" or "accessed_at",
+                or a function which takes an :class:`EntryRecord`
+    :param error_handler: as for :meth:`Dir.walk`
+    :param filter: a :class:`Filter` or None
+    :param criteria: keyword arguments for a :class:`Filter`, instead of filter
+    :returns: a list of :class:`EntryRecord`
+    """
+    heap, floor = _top_heap(
+        _top_candidates(unicode(dir(root)), _filter(filter, criteria), error_handler),
+        n,
+        _top_key(key)
+    )
+    return [EntryRecord.from_find_data(dirpath, file_info) for (_, _, dirpath, file_info) in sorted(heap, reverse=True)]
+
+class TopFiles(core._WinSysObject):
+    """The n highest-ranked files beneath a directory as for :func:`top_files`,
+    kept up-to-date by a thread which scans the tree and then watches it. Use
+    :func:`watch_top_files` to create and start one, :meth:`files` to see
+    where things stand at any moment and :meth:`stop` to finish with it.
+
+    Twice as many files as are asked for are held so that files can be
+    removed without the tree having to be read again. The tree is only
+    read again if so many have gone that some file which was not held might
+    now be among the top n, or if the watcher loses changes. Until the first
+    scan has finished, :attr:`scanning` is True and :meth:`files` returns
+    the best files seen so far.
     """
-    return dir(filepath).dismount()
 
-def zip(filepath, *args, **kwargs):
-    """Create and return a zip archive of filepath, implemented via :meth:`File.zip` or :meth:`Dir.zip`
+    def __init__(self, root, n=10, key="size", error_handler=None, filter=None, **criteria):
+        core._WinSysObject.__init__(self)
+        self.root = unicode(dir(root))
+        self.n = n
+        self.capacity = 2 * n
+        self.error_handler = error_handler
+        self.n_scans = 0
+        self.scanning = False
+        self._key_function = _top_key(key)
+        self._filter = _filter(filter, criteria)
+        self._lock = threading.Lock()
+        self._held = {}
+        self._heap = []
+        self._floor = None
+        self._counter = itertools.count()
+        self._stopped = threading.Event()
+        self._watcher = None
+        self._thread = None
 
-    :param filepath: anything accepted by :func:`entry`
-    """
-    return entry(filepath).zip(*args, **kwargs)
+    def as_string(self):
+        return "Top %d files under %s" % (self.n, self.root)
 
-def drive(drive):
-    """Return a :class:`Drive` object representing drive
+    def dumped(self, level):
+        output = []
+        output.append("root: %s" % self.root)
+        output.append("n: %d" % self.n)
+        output.append("n_scans: %d" % self.n_scans)
+        output.append("files:\n%s" % utils.dumped_list(("%s (%d)" % (f, f.size) for f in self.files()), level))
+        return utils.dumped("\n".join(output), level)
 
-    ======================================= ==================================================
-    drive                                   Result
-    ======================================= ==================================================
-    :const:`None`                           :const:`None`
-    an :class:`Drive` or subclass object    the same object
-    a drive letter                          a :class:`Drive` object
-    ======================================= ==================================================
-    """
-    if drive is None:
-        return None
-    elif isinstance(drive, Drive):
-        return drive
-    else:
-        return Drive(drive)
+    def start(self):
+        """Start watching the tree and then scan it, in a thread of its own
+        """
+        self._watcher = watch(self.root, True)
+        self._watcher._start_reading()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
 
-def drives():
-    """Iterate over all the drive letters in the system, yielding a :class:`Drive` object
-    representing each one.
-    """
-    for drive in wrapped(win32api.GetLogicalDriveStrings).strip("\x00").split("\x00"):
-        yield Drive(drive)
+    def stop(self):
+        """Stop watching the tree, leaving the files as they were last seen.
+        A scan which is under way stops after the directory it is reading.
+        """
+        self._stopped.set()
+        if self._watcher is not None:
+            self._watcher.stop()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+            #
+            # The thread has finished, so calls to :meth:`update` from
+            # now on can read the tree again if they need to.
+            #
+            self._stopped.clear()
 
-def volume(volume):
-    r"""Return a :class:`Volume` object corresponding to volume
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
 
-    ======================================= ==================================================
-    volume                                  Result
-    ======================================= ==================================================
-    :const:`None`                           :const:`None`
-    an :class:`Volume` or subclass object   the same object
-    a volume name \\?\Volume...             a :class:`Volume` object representing that volume
-    a directory name                        a :class:`Volume` object representing the volume
-                                            at that mountpoint
-    ======================================= ==================================================
-    """
-    if volume is None:
-        return None
-    elif isinstance(volume, Volume):
-        return volume
-    elif volume.startswith(r"\\?\Volume"):
-        return Volume(volume)
-    else:
-        return Volume(wrapped(win32file.GetVolumeNameForVolumeMountPoint, volume.rstrip(sep) + sep))
+    def files(self):
+        """Return the top n files, highest first, as :class:`EntryRecord` objects
+        """
+        with self._lock:
+            held = sorted(self._held.values(), reverse=True)
+            floor = self._floor
+        return [
+            EntryRecord.from_find_data(dirpath, file_info)
+                for (value, _, dirpath, file_info) in held[:self.n]
+                if floor is None or value >= floor
+        ]
+
+    def _run(self):
+        self._scan()
+        for batch in self._watcher.batches():
+            if self._stopped.is_set():
+                break
+            if batch.overflowed:
+                self._scan()
+            else:
+                self.update(batch)
 
-def volumes():
-    """Iterate over all the volumes in the system, yielding a :class:`Volume` object
+    def _scan(self):
+        self.scanning = True
+        try:
+            with self._lock:
+                self._held.clear()
+                del self._heap[:]
+                self._floor = None
+            for dirpath, file_info in _top_candidates(self.root, self._filter, self.error_handler, self._stopped):
+                self._offer(dirpath, file_info)
+            if not self._stopped.is_set():
+                self.n_scans += 1
+        finally:
+            self.scanning = False
+
+    def _lowest(self):
+        """Return the (value, tiebreak, key) of the lowest-ranked file held,
+        or None if none is. The heap is only added to, so entries for files
+        which have since been discarded or offered again are dropped as they
+        come to the top. The caller holds the lock.
+        """
+        heap = self._heap
+        while heap:
+            value, tiebreak, key = heap[0]
+            held = self._held.get(key)
+            if held is not None and held[1] == tiebreak:
+                return heap[0]
+            heapq.heappop(heap)
+        return None
+
+    def _turned_away(self, value):
+        if self._floor is None or value > self._floor:
+            self._floor = value
+
+    def _offer(self, dirpath, file_info):
+        """Hold the file in dirpath described by file_info if it ranks highly
+        enough, turning away the lowest-ranked file held if there are too many
+        """
+        value = self._key_function(dirpath, file_info)
+        key = os.path.join(dirpath, file_info[8]).lower()
+        with self._lock:
+            if key not in self._held and len(self._held) >= self.capacity:
+                lowest = self._lowest()
+                if lowest is not None and value <= lowest[0]:
+                    self._turned_away(value)
+                    return
+            held = self._held[key] = (value, next(self._counter), dirpath, file_info)
+            heapq.heappush(self._heap, (value, held[1], key))
+            if len(self._held) > self.capacity:
+                value, _, lowest_key = self._lowest()
+                heapq.heappop(self._heap)
+                del self._held[lowest_key]
+                self._turned_away(value)
+            #
+            # Keep the entries left behind by discarded files from piling up
+            #
+            if len(self._heap) > 2 * self.capacity + 16:
+                self._heap = [(held[0], held[1], held_key) for held_key, held in self._held.items()]
+                heapq.heapify(self._heap)
+
+    def _discard(self, filepath):
+        """Stop holding filepath and, if it is a directory, anything beneath it
+        """
+        key = filepath.lower()
+        prefix = key + sep
+        with self._lock:
+            self._held.pop(key, None)
+            for held_key in [k for k in self._held if k.startswith(prefix)]:
+                del self._held[held_key]
+
+    def _refresh(self, filepath, is_new):
+        """Look again at a file which has changed, or at a directory which
+        has appeared and everything beneath it
+        """
+        try:
+            file_attribute_data = _file_attribute_data(normalised(filepath), refresh=True)
+        except x_no_such_file:
+            self._discard(filepath)
+            return
+        dirpath, name = os.path.split(filepath)
+        file_info = _file_info(name, file_attribute_data)
+        if self._filter is not None and not self._filter.accepts(file_info):
+            self._discard(filepath)
+        elif file_info[0] & FILE_ATTRIBUTE.DIRECTORY:
+            if is_new:
+                for dirpath, file_info in _top_candidates(filepath, self._filter, self.error_handler, self._stopped):
+                    self._offer(dirpath, file_info)
+        else:
+            self._offer(dirpath, file_info)
+
+    def update(self, changes):
+        """Apply the changes from :func:`watch` -- or from :meth:`_DirWatcher.batches`
+        -- to the files held, reading the whole tree again if too many have gone.
+        This is called by the watching thread; it need only be called directly
+        when the changes come from somewhere else.
+
+        :param changes: an iterable of (action, old_filename, new_filename)
+        """
+        for action, old_filename, new_filename in changes:
+            try:
+                if action in (FILE_ACTION.REMOVED, FILE_ACTION.RENAMED_NEW_NAME) and old_filename is not None:
+                    self._discard(unicode(old_filename))
+                if new_filename is not None:
+                    self._refresh(unicode(new_filename), action != FILE_ACTION.MODIFIED)
+            except:
+                if self.error_handler and self.error_handler(sys.exc_info()):
+                    continue
+                else:
+                    raise
+
+        #
+        # Everything not held ranks no higher than the floor, so only files
+        # at or above it are certain to be in the right place. If fewer than
+        # n are, something which isn't held might belong in the top n.
+        #
+        with self._lock:
+            floor = self._floor
+            n_certain = sum(1 for held in self._held.values() if floor is None or held[0] >= floor)
+        if floor is not None and n_certain < self.n:
+            self._scan()
+
+def watch_top_files(root, n=10, key="size", error_handler=None, filter=None, **criteria):
+    """Return a started :class:`TopFiles` which keeps the n highest-ranked
+    files beneath root up-to-date as they change. The arguments are as for
+    :func:`top_files`::
+
+        from winsys import fs
+        top = fs.watch_top_files("c:/data", 50, min_size=100 * 1024 * 1024)
+        try:
+            while True:
+                time.sleep(60)
+                for f in top.files():
+                    print(f, f.size)
+        finally:
+            top.stop()
+
+    :returns: a :class:`TopFiles`
+    """
+    return TopFiles(root, n, key, error_handler, filter, **criteria).start()
+
+def stream_copy(source, target, buffer_size=CHUNK_SIZE):
+    """Copy everything from one file-like object to another through a single
+    buffer which is filled in place each time, so memory use doesn't depend
+    on how much is copied. If the source has no readinto method, it is read
+    in blocks of buffer_size instead.
+
+    :param source: an object with a readinto or a read method
+    :param target: an object with a write method
+    :param buffer_size: the size in bytes of the buffer [1Mb]
+    :returns: the number of bytes copied
+    """
+    n_bytes_copied = 0
+    readinto = getattr(source, "readinto", None)
+    if readinto is None:
+        while True:
+            data = source.read(buffer_size)
+            if not data:
+                break
+            target.write(data)
+            n_bytes_copied += len(data)
+    else:
+        buffer = bytearray(buffer_size)
+        view = memoryview(buffer)
+        while True:
+            n_bytes = readinto(buffer)
+            if not n_bytes:
+                break
+            target.write(view[:n_bytes])
+            n_bytes_copied += n_bytes
+    return n_bytes_copied
+
+class _Pending(object):
+    """One item handed to :func:`_ordered_map`, with the result of working
+    on it once ready is set.
+    """
+
+    def __init__(self, item):
+        self.item = item
+        self.ready = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+def _ordered_map(function, items, n_workers, window):
+    """Yield (item, result, exc_info) for function applied to each of items
+    by n_workers threads, in the order of items. No more than window items
+    are in hand at once, so neither items nor results need all fit in memory.
+    An exception raised while iterating over items is raised here once the
+    items before it have been yielded. If the caller stops early, the
+    threads stop too.
+    """
+    todo = queue.Queue()
+    pending = queue.Queue(maxsize=window)
+    stopped = threading.Event()
+    failed = []
+
+    def _put(item):
+        while not stopped.is_set():
+            try:
+                pending.put(item, timeout=0.5)
+            except queue.Full:
+                continue
+            else:
+                break
+
+    def _feed():
+        try:
+            for item in items:
+                if stopped.is_set():
+                    break
+                p = _Pending(item)
+                _put(p)
+                todo.put(p)
+        except:
+            failed.append(sys.exc_info())
+        finally:
+            _put(None)
+            for _ in range(n_workers):
+                todo.put(None)
+
+    def _work():
+        while True:
+            p = todo.get()
+            if p is None:
+                break
+            if not stopped.is_set():
+                try:
+                    p.result = function(p.item)
+                except:
+                    p.exc_info = sys.exc_info()
+            p.ready.set()
+
+    for target in [_feed] + [_work] * n_workers:
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+    try:
+        while True:
+            p = _get(pending)
+            if p is None:
+                break
+            while not p.ready.wait(0.5):
+                pass
+            yield p.item, p.result, p.exc_info
+        if failed:
+            raise failed[0][1]
+    finally:
+        stopped.set()
+
+ZIP_BUFFERED_SIZE = 64 * 1024 * 1024
+
+def _zip_member_segments(filename):
+    """Return the path segments beneath the target directory at which
+    :meth:`zipfile.ZipFile.extract` puts a member called filename: any drive,
+    leading separator, "." or ".." is dropped so that nothing can be
+    written outside the target.
+    """
+    filename = os.path.splitdrive(filename.replace("/", sep))[1]
+    return [segment for segment in filename.split(sep) if segment not in ("", os.curdir, os.pardir)]
+
+def _deflated(normpath, compresslevel=zlib.Z_DEFAULT_COMPRESSION):
+    """Return the CRC, the size and the raw deflated contents of a file,
+    as a zipfile needs them for a ZIP_DEFLATED member.
+    """
+    crc, size = 0, 0
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    pieces = []
+    with io.open(normpath, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            pieces.append(compressor.compress(chunk))
+    pieces.append(compressor.flush())
+    return crc & 0xffffffff, size, b"".join(pieces)
+
+#
+# The records of a zipfile, as laid out in PKWARE's APPNOTE.TXT: the local
+# header before each member's data, the central directory entry for each
+# member, the end of the central directory and, for an archive too big for
+# those, the zip64 end of central directory record and its locator.
+#
+_ZIP_LOCAL_HEADER = struct.Struct("<LHHHHHLLLHH")
+_ZIP_CENTRAL_HEADER = struct.Struct("<LHHHHHHLLLHHHHHLL")
+_ZIP_END = struct.Struct("<LHHHHLLH")
+_ZIP64_END = struct.Struct("<LQHHLLQQQQ")
+_ZIP64_END_LOCATOR = struct.Struct("<LLQL")
+_ZIP64_LIMIT = 0xFFFFFFFF
+_ZIP64_COUNT_LIMIT = 0xFFFF
+_ZIP_VERSION = 20
+_ZIP64_VERSION = 45
+_ZIP_UTF8 = 0x800
+
+class _ZipWriter(object):
+    """Write a new zipfile of deflated members to the file-like object f,
+    one member at a time, and its central directory on :meth:`close`. Members
+    can be handed over already deflated, as by :func:`_deflated`, so that
+    the compression can be done elsewhere; zipfile itself has no way to do that.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.members = []
+
+    @staticmethod
+    def _name(arcname):
+        name = arcname.replace(os.sep, "/").lstrip("/")
+        try:
+            return name.encode("ascii"), 0
+        except UnicodeError:
+            return name.encode("utf-8"), _ZIP_UTF8
+
+    @staticmethod
+    def _dos_time(st):
+        year, month, day, hour, minute, second = max(time.localtime(st.st_mtime)[:6], (1980, 1, 1, 0, 0, 0))
+        return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+    def _local_header(self, name, flags, dos_time, dos_date, crc, compressed_size, size, zip64):
+        extra = b""
+        if zip64:
+            extra = struct.pack("<HHQQ", 1, 16, size, compressed_size)
+            compressed_size = size = 0xFFFFFFFF
+        return _ZIP_LOCAL_HEADER.pack(
+            0x04034b50, _ZIP64_VERSION if zip64 else _ZIP_VERSION, flags, zipfile.ZIP_DEFLATED,
+            dos_time, dos_date, crc, compressed_size, size, len(name), len(extra)
+        ) + name + extra
+
+    def _write(self, normpath, arcname, crc, size, data):
+        """Write the member whose contents, deflated, are data
+        """
+        st = os.stat(normpath)
+        name, flags = self._name(arcname)
+        dos_time, dos_date = self._dos_time(st)
+        zip64 = size >= _ZIP64_LIMIT or len(data) >= _ZIP64_LIMIT
+        offset = self.f.tell()
+        self.f.write(self._local_header(name, flags, dos_time, dos_date, crc, len(data), size, zip64))
+        self.f.write(data)
+        self.members.append((name, flags, dos_time, dos_date, crc, len(data), size, offset, st.st_mode))
+
+    def _write_file(self, normpath, arcname):
+        """Deflate the file at normpath as it's written, a chunk at a time,
+        and then go back to fill in its local header
+        """
+        st = os.stat(normpath)
+        name, flags = self._name(arcname)
+        dos_time, dos_date = self._dos_time(st)
+        #
+        # Whether the local header has room for 64-bit sizes must be
+        # decided before the data is written; deflate can add a little.
+        #
+        zip64 = st.st_size + st.st_size // 16 + 1024 >= _ZIP64_LIMIT
+        offset = self.f.tell()
+        self.f.write(self._local_header(name, flags, dos_time, dos_date, 0, 0, 0, zip64))
+        crc, size, compressed_size = 0, 0, 0
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        with io.open(normpath, "rb") as source:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                data = compressor.compress(chunk)
+                compressed_size += len(data)
+                self.f.write(data)
+        data = compressor.flush()
+        compressed_size += len(data)
+        self.f.write(data)
+        crc &= 0xffffffff
+        if not zip64 and max(size, compressed_size) >= _ZIP64_LIMIT:
+            raise zipfile.LargeZipFile("%s grew too big while it was being zipped" % normpath)
+        end = self.f.tell()
+        self.f.seek(offset)
+        self.f.write(self._local_header(name, flags, dos_time, dos_date, crc, compressed_size, size, zip64))
+        self.f.seek(end)
+        self.members.append((name, flags, dos_time, dos_date, crc, compressed_size, size, offset, st.st_mode))
+
+    def close(self):
+        """Write the central directory
+        """
+        start = self.f.tell()
+        for name, flags, dos_time, dos_date, crc, compressed_size, size, offset, mode in self.members:
+            #
+            # Any field too big for its 32 bits is 0xFFFFFFFF and its real
+            # value goes into the zip64 extra field, in this order.
+            #
+            zip64_values = []
+            if size >= _ZIP64_LIMIT:
+                zip64_values.append(size)
+                size = 0xFFFFFFFF
+            if compressed_size >= _ZIP64_LIMIT:
+                zip64_values.append(compressed_size)
+                compressed_size = 0xFFFFFFFF
+            if offset >= _ZIP64_LIMIT:
+                zip64_values.append(offset)
+                offset = 0xFFFFFFFF
+            extra = b""
+            if zip64_values:
+                extra = struct.pack("<HH%dQ" % len(zip64_values), 1, 8 * len(zip64_values), *zip64_values)
+            version = _ZIP64_VERSION if extra else _ZIP_VERSION
+            self.f.write(_ZIP_CENTRAL_HEADER.pack(
+                0x02014b50, version, version, flags, zipfile.ZIP_DEFLATED, dos_time, dos_date,
+                crc, compressed_size, size, len(name), len(extra), 0, 0, 0, (mode & 0xFFFF) << 16, offset
+            ))
+            self.f.write(name)
+            self.f.write(extra)
+        end = self.f.tell()
+        n_members, central_size = len(self.members), end - start
+        if n_members >= _ZIP64_COUNT_LIMIT or central_size >= _ZIP64_LIMIT or start >= _ZIP64_LIMIT:
+            self.f.write(_ZIP64_END.pack(
+                0x06064b50, _ZIP64_END.size - 12, _ZIP64_VERSION, _ZIP64_VERSION,
+                0, 0, n_members, n_members, central_size, start
+            ))
+            self.f.write(_ZIP64_END_LOCATOR.pack(0x07064b50, 0, end, 1))
+            n_members = min(n_members, 0xFFFF)
+            central_size = min(central_size, 0xFFFFFFFF)
+            start = min(start, 0xFFFFFFFF)
+        self.f.write(_ZIP_END.pack(0x06054b50, 0, 0, n_members, n_members, central_size, start, 0))
+
+def _parallel_zip(zip_filename, top, n_workers):
+    """Write a new zipfile of everything beneath top, deflating files in
+    n_workers threads -- zlib lets go of the GIL while it works -- and
+    writing them from this one in the order of :meth:`Dir.flat`.
+    """
+    def _compress(f):
+        if f.size > ZIP_BUFFERED_SIZE:
+            return None
+        return _deflated(f._normpath)
+
+    with io.open(zip_filename, "wb") as output:
+        writer = _ZipWriter(output)
+        with contextlib.closing(_ordered_map(_compress, top.flat(), n_workers, 4 * n_workers)) as compressed:
+            for f, result, exc_info in compressed:
+                if exc_info:
+                    raise exc_info[1]
+                arcname = f.relative_to(top)
+                if result is None:
+                    writer._write_file(f._normpath, arcname)
+                else:
+                    writer._write(f._normpath, arcname, *result)
+        writer.close()
+
+def _copy_file(source_normpath, target_normpath, callback=None, callback_data=None):
+    wrapped(
+        win32file.CopyFileEx,
+        source_normpath,
+        target_normpath,
+        progress_wrapper(callback),
+        callback_data
+    )
+    _invalidate(target_normpath)
+
+def _mkdir(normpath):
+    """Create one directory whose parent is known to exist, succeeding
+    quietly if it exists already.
+    """
+    try:
+        wrapped(win32file.CreateDirectoryW, normpath, None)
+    except x_fs as err:
+        (errno, errctx, errmsg) = err.args
+        if errno != winerror.ERROR_ALREADY_EXISTS:
+            raise
+
+def _walk_prefix(top):
+    """Return the text which starts the path of every entry found by a walk
+    from top, so that slicing it off gives each entry's path relative to top.
+    """
+    parts = get_parts(os.path.join(unicode(top), "*"))
+    return os.path.join(parts[0] + sep.join(parts[1:-1]), "")
+
+LARGE_FILE_SIZE = 16 * 1024 * 1024
+
+class CopySummary(core._WinSysObject):
+    """The outcome of :func:`copy_tree`: how much was copied, how much was
+    skipped because an earlier run had already copied it, what went wrong
+    and how long it all took.
+    """
+
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+        self.n_dirs = 0
+        self.n_files = 0
+        self.n_bytes = 0
+        self.n_skipped = 0
+        self.errors = []
+        self.cancelled = False
+        self.elapsed = 0.0
+
+    def as_string(self):
+        return "%s -> %s: %d files, %d bytes in %.2fs" % (
+            self.source, self.target, self.n_files, self.n_bytes, self.elapsed
+        )
+
+    def dumped(self, level=0):
+        output = []
+        output.append("source: %s" % self.source)
+        output.append("target: %s" % self.target)
+        output.append("dirs: %d" % self.n_dirs)
+        output.append("files: %d" % self.n_files)
+        output.append("bytes: %d" % self.n_bytes)
+        output.append("skipped: %d" % self.n_skipped)
+        output.append("errors: %d" % len(self.errors))
+        output.append("cancelled: %s" % self.cancelled)
+        output.append("elapsed: %.2fs" % self.elapsed)
+        output.append("files/sec: %.1f" % self.files_per_sec)
+        output.append("bytes/sec: %.1f" % self.bytes_per_sec)
+        return utils.dumped("\n".join(output), level)
+
+    def _get_files_per_sec(self):
+        return self.n_files / self.elapsed if self.elapsed else 0.0
+    files_per_sec = property(_get_files_per_sec)
+
+    def _get_bytes_per_sec(self):
+        return self.n_bytes / self.elapsed if self.elapsed else 0.0
+    bytes_per_sec = property(_get_bytes_per_sec)
+
+class _CopyJournal(object):
+    """The relative paths of files already copied, read back from an
+    earlier run and added to as this one goes. Lines are flushed in
+    batches: losing the last few to a crash only means copying those
+    files again.
+    """
+
+    FLUSH_EVERY = 256
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.done = set()
+        if os.path.exists(filepath):
+            with codecs.open(filepath, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.rstrip("\r\n")
+                    if line:
+                        self.done.add(line.lower())
+        self._file = codecs.open(filepath, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._n_unflushed = 0
+
+    def __contains__(self, relpath):
+        return relpath.lower() in self.done
+
+    def add(self, relpath):
+        with self._lock:
+            self._file.write(relpath + "\n")
+            self._n_unflushed += 1
+            if self._n_unflushed >= self.FLUSH_EVERY:
+                self._file.flush()
+                self._n_unflushed = 0
+
+    def close(self, finished):
+        self._file.close()
+        if finished:
+            os.remove(self.filepath)
+
+class _CopyEngine(object):
+    """Walk the source tree in this thread, creating target directories as
+    they're found, and hand the files to two pools of threads: one for
+    small files, where the cost is mostly per file, and a smaller one for
+    large files, where it's mostly bandwidth. Keeping them apart stops a
+    few large files from holding up many small ones.
+    """
+
+    def __init__(
+        self, source, target,
+        n_workers, n_large_workers, large_file_size,
+        journal, callback, callback_data, error_handler
+    ):
+        self.source = source
+        self.target = target
+        self.large_file_size = large_file_size
+        self.journal = journal
+        self.callback = callback
+        self.callback_data = callback_data
+        self.error_handler = error_handler
+        self.summary = CopySummary(source, target)
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.exc_info = None
+        self.n_bytes_found = 0
+        self.n_bytes_copied = 0
+        self.small = queue.Queue(maxsize=64 * n_workers)
+        self.large = queue.Queue(maxsize=4 * n_large_workers)
+        self.lanes = [self.small] * n_workers + [self.large] * n_large_workers
+        self.threads = [threading.Thread(target=self._work, args=(lane,)) for lane in self.lanes]
+
+    def run(self):
+        started = time.time()
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            self._feed()
+        except:
+            self.stopped.set()
+            raise
+        finally:
+            self._finish()
+            self.summary.elapsed = time.time() - started
+            self.summary.cancelled = self.stopped.is_set()
+            if self.journal is not None:
+                self.journal.close(finished=not self.summary.cancelled and not self.summary.errors)
+
+        if self.exc_info:
+            raise self.exc_info[1]
+        return self.summary
+
+    def _feed(self):
+        target_base = self.target._normpath
+        prefix_len = len(_walk_prefix(self.source))
+        self.target.create()
+        for dirpath, dirs, files in self.source.walk(error_handler=self.error_handler, records=True):
+            if self.stopped.is_set():
+                break
+            for d in dirs:
+                target_normpath = os.path.join(target_base, d.filepath[prefix_len:])
+                if self._attempt(d.filepath, _mkdir, target_normpath):
+                    self.summary.n_dirs += 1
+            for f in files:
+                relpath = f.filepath[prefix_len:]
+                if self.journal is not None and relpath in self.journal:
+                    self.summary.n_skipped += 1
+                    continue
+                self.n_bytes_found += f.size
+                lane = self.large if f.size >= self.large_file_size else self.small
+                self._put(lane, (f.filepath, relpath, f.size))
+
+    def _put(self, lane, item):
+        while not self.stopped.is_set():
+            try:
+                lane.put(item, timeout=0.5)
+            except queue.Full:
+                continue
+            else:
+                break
+
+    def _finish(self):
+        #
+        # Workers keep taking items after a stop, without acting on
+        # them, so there's always room for the sentinels eventually.
+        #
+        for lane in self.lanes:
+            lane.put(None)
+        for thread in self.threads:
+            while thread.is_alive():
+                thread.join(0.5)
+
+    def _attempt(self, source_filepath, function, *args):
+        """Call function with args, returning True if it succeeded. A failure
+        is either recorded, if the error_handler says to carry on, or kept to
+        be raised once everything has stopped.
+        """
+        try:
+            function(*args)
+        except:
+            if self.stopped.is_set():
+                return False
+            if self.error_handler and self.error_handler(sys.exc_info()):
+                with self.lock:
+                    self.summary.errors.append((source_filepath, sys.exc_info()[1]))
+            else:
+                with self.lock:
+                    if self.exc_info is None:
+                        self.exc_info = sys.exc_info()
+                self.stopped.set()
+            return False
+        else:
+            return True
+
+    def _progress(self, total_file_size, file_bytes_copied, file_progress):
+        #
+        # CopyFileEx reports each file's own progress; turn that into
+        # progress across every file the walk has found so far.
+        #
+        with self.lock:
+            self.n_bytes_copied += file_bytes_copied - file_progress[0]
+            file_progress[0] = file_bytes_copied
+            cancel = self.callback(self.n_bytes_found, self.n_bytes_copied, self.callback_data)
+        if cancel:
+            self.stopped.set()
+        return cancel
+
+    def _work(self, lane):
+        target_base = self.target._normpath
+        callback = self._progress if self.callback else None
+        while True:
+            item = lane.get()
+            if item is None:
+                break
+            if self.stopped.is_set():
+                continue
+            source_filepath, relpath, size = item
+            if self._attempt(
+                source_filepath, _copy_file,
+                normalised(source_filepath), os.path.join(target_base, relpath),
+                callback, [0]
+            ):
+                with self.lock:
+                    self.summary.n_files += 1
+                    self.summary.n_bytes += size
+                if self.journal is not None:
+                    self.journal.add(relpath)
+
+def copy_tree(
+    source, target,
+    workers=4, large_workers=None, large_file_size=LARGE_FILE_SIZE,
+    journal=None,
+    callback=None, callback_data=None,
+    error_handler=None
+):
+    """Copy the contents of the source directory into the target directory,
+    creating it if needed, with several files being copied at once. Files
+    of at least `large_file_size` bytes are copied by a separate, smaller
+    set of threads so that they don't hold up the rest.
+
+    If a journal filepath is given, the relative path of each file is written
+    to it once the file is copied. If the copy is interrupted, running it again
+    with the same journal skips the files already copied. The journal is removed
+    when a copy finishes without errors. eg::
+
+        from winsys import fs
+        summary = fs.copy_tree("//server/share", "d:/migrated", workers=16, journal="d:/migrated.journal")
+        summary.dump()
+
+    The callback sees progress across the whole copy: its total is the size of
+    all the files found so far, which grows as the walk goes on.
+
+    :param source: anything accepted by :func:`dir`
+    :param target: anything accepted by :func:`dir`
+    :param workers: how many threads copy small files [4]
+    :param large_workers: how many threads copy large files [a quarter of workers, at least 1]
+    :param large_file_size: the size in bytes from which a file counts as large
+    :param journal: a filepath in which to record progress so that the copy can be resumed
+    :param callback: function receiving total size, total so far, callback_data; return True to cancel
+    :param callback_data: passed to callback
+    :param error_handler: passed sys.exc_info for each failure; returns True to note the failure and carry on
+    :returns: a :class:`CopySummary`
+    """
+    if large_workers is None:
+        large_workers = max(1, workers // 4)
+    return _CopyEngine(
+        dir(source), dir(target),
+        workers, large_workers, large_file_size,
+        None if journal is None else _CopyJournal(unicode(journal)),
+        callback, callback_data, error_handler
+    ).run()
+
+class SyncReport(core._WinSysObject):
+    """What :meth:`Dir.sync` did or, for a dry run, would do. Each list holds
+    paths relative to the top of the source and target.
+    """
+
+    def __init__(self, source, target, dry_run):
+        self.source = source
+        self.target = target
+        self.dry_run = dry_run
+        self.created = []
+        self.copied = []
+        self.updated = []
+        self.deleted = []
+        self.n_unchanged = 0
+        self.errors = []
+        self.elapsed = 0.0
+
+    def as_string(self):
+        return "%s -> %s%s: %d new, %d changed, %d deleted, %d unchanged" % (
+            self.source, self.target, " (dry run)" if self.dry_run else "",
+            len(self.copied), len(self.updated), len(self.deleted), self.n_unchanged
+        )
+
+    def dumped(self, level=0):
+        output = []
+        output.append(self.as_string())
+        for title, relpaths in [
+            ("Directories created", self.created),
+            ("Files copied", self.copied),
+            ("Files updated", self.updated),
+            ("Deleted", self.deleted),
+        ]:
+            if relpaths:
+                output.append("%s:" % title)
+                output.append(utils.dumped("\n".join(relpaths), level))
+        for filepath, exception in self.errors:
+            output.append("Error: %s: %s" % (filepath, exception))
+        output.append("elapsed: %.2fs" % self.elapsed)
+        return utils.dumped("\n".join(output), level)
+
+class _Syncer(object):
+    """Walk source and target together a directory at a time, comparing
+    the raw FIND data of each side and acting on the differences.
+    """
+
+    #
+    # Only the attributes which a copy carries over and which every
+    # filesystem keeps are compared: a target which is compressed,
+    # encrypted or not indexed would otherwise always look different.
+    # FAT and many SMB servers keep times to the nearest 2 seconds.
+    #
+    COMPARED_ATTRIBUTES = FILE_ATTRIBUTE.READONLY | FILE_ATTRIBUTE.HIDDEN | FILE_ATTRIBUTE.SYSTEM
+    TIME_TOLERANCE_SECS = 2
+
+    def __init__(self, source, target, delete_extras, dry_run, callback, callback_data, error_handler, time_tolerance_secs=TIME_TOLERANCE_SECS):
+        self.source = source
+        self.target = target
+        self.delete_extras = delete_extras
+        self.dry_run = dry_run
+        self.callback = callback
+        self.callback_data = callback_data
+        self.error_handler = error_handler
+        self.time_tolerance = int(time_tolerance_secs * 10000000)
+        self.report = SyncReport(source, target, dry_run)
+
+    def differs(self, source_info, target_info):
+        if utils._longword(source_info[5], source_info[4]) != utils._longword(target_info[5], target_info[4]):
+            return True
+        if abs(utils.filetime_from_pytime(source_info[3]) - utils.filetime_from_pytime(target_info[3])) > self.time_tolerance:
+            return True
+        return bool((source_info[0] ^ target_info[0]) & self.COMPARED_ATTRIBUTES)
+
+    def run(self):
+        started = time.time()
+        source_base = unicode(self.source)
+        target_base = self.target._normpath
+        target_exists = bool(self.target)
+        if not target_exists:
+            self.act(self.report.created, os.curdir, self.target.create)
+
+        stack = [("", target_exists)]
+        while stack:
+            relpath, target_exists = stack.pop()
+            target_dirpath = os.path.join(target_base, relpath)
+            target_infos = {}
+            if target_exists:
+                for _, file_info in _find_data(os.path.join(target_dirpath, "*"), error_handler=self.error_handler):
+                    target_infos[file_info[8].lower()] = file_info
+
+            subdirs = []
+            for _, file_info in _find_data(os.path.join(source_base, relpath, "*"), error_handler=self.error_handler):
+                name = file_info[8]
+                child = os.path.join(relpath, name)
+                source_filepath = os.path.join(source_base, child)
+                target_normpath = os.path.join(target_dirpath, name)
+                target_info = target_infos.pop(name.lower(), None)
+                is_dir = bool(file_info[0] & FILE_ATTRIBUTE.DIRECTORY)
+
+                #
+                # A file on one side and a directory on the other: the
+                # target has to go, whether or not extras are being deleted.
+                #
+                if target_info is not None and bool(target_info[0] & FILE_ATTRIBUTE.DIRECTORY) != is_dir:
+                    self.act(self.report.deleted, child, self.remove, target_normpath, target_info)
+                    target_info = None
+
+                if is_dir:
+                    if target_info is None:
+                        self.act(self.report.created, child, _mkdir, target_normpath)
+                    subdirs.append((child, target_info is not None))
+                elif target_info is None:
+                    self.act(self.report.copied, child, self.copy, source_filepath, target_normpath, None)
+                elif self.differs(file_info, target_info):
+                    self.act(self.report.updated, child, self.copy, source_filepath, target_normpath, target_info)
+                else:
+                    self.report.n_unchanged += 1
+
+            if self.delete_extras:
+                for target_info in target_infos.values():
+                    child = os.path.join(relpath, target_info[8])
+                    self.act(self.report.deleted, child, self.remove, os.path.join(target_dirpath, target_info[8]), target_info)
+
+            stack.extend(reversed(subdirs))
+
+        self.report.elapsed = time.time() - started
+        return self.report
+
+    def act(self, relpaths, relpath, function, *args):
+        """Note relpath against the action and, unless this is a dry run,
+        carry it out, handing any failure to the error_handler.
+        """
+        if self.dry_run:
+            relpaths.append(relpath)
+            return
+        try:
+            function(*args)
+        except:
+            if self.error_handler and self.error_handler(sys.exc_info()):
+                self.report.errors.append((relpath, sys.exc_info()[1]))
+            else:
+                raise
+        else:
+            relpaths.append(relpath)
+
+    def copy(self, source_filepath, target_normpath, target_info):
+        #
+        # CopyFileEx won't overwrite a read-only file
+        #
+        if target_info is not None and target_info[0] & FILE_ATTRIBUTE.READONLY:
+            wrapped(win32file.SetFileAttributesW, target_normpath, FILE_ATTRIBUTE.NORMAL)
+        _copy_file(normalised(source_filepath), target_normpath, self.callback, self.callback_data)
+
+    def remove(self, target_normpath, target_info):
+        if target_info[0] & FILE_ATTRIBUTE.DIRECTORY:
+            Dir(target_normpath).delete(recursive=True)
+        else:
+            if target_info[0] & FILE_ATTRIBUTE.READONLY:
+                wrapped(win32file.SetFileAttributesW, target_normpath, FILE_ATTRIBUTE.NORMAL)
+            wrapped(win32file.DeleteFileW, target_normpath)
+            _invalidate(target_normpath)
+
+class DeleteSummary(core._WinSysObject):
+    """The outcome of :func:`delete_tree`: how many files and directories
+    were deleted, what couldn't be deleted and why, and how long it took.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.n_files = 0
+        self.n_dirs = 0
+        self.n_bytes = 0
+        self.errors = []
+        self.elapsed = 0.0
+
+    def as_string(self):
+        return "%s: %d files, %d directories deleted, %d errors in %.2fs" % (
+            self.root, self.n_files, self.n_dirs, len(self.errors), self.elapsed
+        )
+
+    def dumped(self, level=0):
+        output = []
+        output.append(self.as_string())
+        output.append("bytes: %d" % self.n_bytes)
+        for filepath, exception in self.errors:
+            output.append("Error: %s: %s" % (filepath, exception))
+        return utils.dumped("\n".join(output), level)
+
+class _DeleteNode(object):
+    """A directory waiting to be removed once everything in it has gone.
+    pending counts the files and subdirectories still to go.
+    """
+
+    def __init__(self, normpath, attributes, parent):
+        self.normpath = normpath
+        self.attributes = attributes
+        self.parent = parent
+        self.pending = 0
+
+class _DeleteEngine(object):
+    """List each directory once, in this thread, and hand its files to be
+    deleted, by worker threads if there are any. A directory is removed by
+    whichever thread finishes the last thing inside it, so nothing is
+    listed twice and no directory waits for more than its own contents.
+    Junctions and symbolic links to directories are removed, not followed.
+    If fail_fast is True, nothing more is started once anything has failed.
+    """
+
+    def __init__(self, root, n_workers, fail_fast=False):
+        self.root = root
+        self.fail_fast = fail_fast
+        self.stopped = False
+        self.summary = DeleteSummary(root)
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=256 * n_workers) if n_workers else None
+        self.threads = [threading.Thread(target=self._work) for _ in range(n_workers or 0)]
+
+    def run(self):
+        started = time.time()
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            self._list_all()
+        finally:
+            for thread in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                while thread.is_alive():
+                    thread.join(0.5)
+            self.summary.elapsed = time.time() - started
+        return self.summary
+
+    def _list_all(self):
+        top = _DeleteNode(self.root._normpath, 0, None)
+        try:
+            top.attributes = _file_attribute_data(top.normpath, refresh=True)[0]
+        except:
+            self._failed(top.normpath)
+            return
+        stack = [top]
+        while stack and not self.stopped:
+            node = stack.pop()
+            subdirs = []
+            files = []
+            try:
+                for _, file_info in _find_data(os.path.join(node.normpath, "*")):
+                    normpath = os.path.join(node.normpath, file_info[8])
+                    attributes = file_info[0]
+                    if attributes & FILE_ATTRIBUTE.DIRECTORY and not attributes & FILE_ATTRIBUTE.REPARSE_POINT:
+                        subdirs.append(_DeleteNode(normpath, attributes, node))
+                    else:
+                        files.append((normpath, attributes, utils._longword(file_info[5], file_info[4])))
+            except:
+                self._failed(node.normpath)
+
+            with self.lock:
+                node.pending += len(subdirs) + len(files)
+                empty = node.pending == 0
+            if empty:
+                self._submit(self._remove_dir, node)
+            for normpath, attributes, size in files:
+                self._submit(self._remove_file, node, normpath, attributes, size)
+            stack.extend(reversed(subdirs))
+
+    def _submit(self, function, *args):
+        if self.queue is None:
+            if not self.stopped:
+                function(*args)
+        else:
+            self.queue.put((function, args))
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            function, args = item
+            if not self.stopped:
+                function(*args)
+
+    def _failed(self, normpath):
+        with self.lock:
+            self.summary.errors.append((normpath, sys.exc_info()[1]))
+            if self.fail_fast:
+                self.stopped = True
+
+    def _done(self, node):
+        #
+        # One more thing has gone from node; if it was the last,
+        # node itself can go, which may empty its own parent.
+        #
+        with self.lock:
+            node.pending -= 1
+            empty = node.pending == 0
+        if empty:
+            self._remove_dir(node)
+
+    def _remove_file(self, node, normpath, attributes, size):
+        try:
+            if attributes & FILE_ATTRIBUTE.READONLY:
+                wrapped(win32file.SetFileAttributesW, normpath, FILE_ATTRIBUTE.NORMAL)
+            if attributes & FILE_ATTRIBUTE.DIRECTORY:
+                wrapped(win32file.RemoveDirectory, normpath)
+            else:
+                wrapped(win32file.DeleteFileW, normpath)
+        except:
+            self._failed(normpath)
+        else:
+            _invalidate(normpath)
+            with self.lock:
+                if attributes & FILE_ATTRIBUTE.DIRECTORY:
+                    self.summary.n_dirs += 1
+                else:
+                    self.summary.n_files += 1
+                    self.summary.n_bytes += size
+        self._done(node)
+
+    def _remove_dir(self, node):
+        while node is not None and not self.stopped:
+            try:
+                if node.attributes & FILE_ATTRIBUTE.READONLY:
+                    wrapped(win32file.SetFileAttributesW, node.normpath, FILE_ATTRIBUTE.NORMAL)
+                wrapped(win32file.RemoveDirectory, node.normpath)
+            except:
+                self._failed(node.normpath)
+            else:
+                _invalidate(node.normpath)
+                with self.lock:
+                    self.summary.n_dirs += 1
+            parent, node = node.parent, None
+            if parent is not None:
+                with self.lock:
+                    parent.pending -= 1
+                    if parent.pending == 0:
+                        node = parent
+
+def delete_tree(root, workers=None, fail_fast=False):
+    """Delete the directory root and everything beneath it in a single
+    pass, clearing the read-only attribute where it's set. Anything which
+    can't be deleted is noted in the summary's `errors` and, unless
+    `fail_fast` is True, the rest carries on; the directories above it
+    will then fail to be deleted too. eg::
+
+        from winsys import fs
+        summary = fs.delete_tree("c:/build", workers=8)
+        if summary.errors:
+            summary.dump()
+
+    :param root: anything accepted by :func:`dir`
+    :param workers: how many threads delete files; if None, everything is done in this thread
+    :param fail_fast: whether to stop starting new deletions after the first failure [False]
+    :returns: a :class:`DeleteSummary`
+    """
+    return _DeleteEngine(dir(root), workers, fail_fast).run()
+
+def _threaded_map(function, items, n_workers, window=None):
+    """Yield (item, result, exc_info) for function applied to each of items
+    by n_workers threads, in whatever order they finish. exc_info is None
+    unless function raised an exception. Items are taken from items only
+    as results are yielded, so that no more than window of them -- by default
+    four for each thread -- are in hand at once. An exception raised while
+    iterating over items is raised here once the results before it have
+    been yielded. If the caller stops early, the threads stop too.
+    """
+    window = window or 4 * n_workers
+    slots = threading.Semaphore(window)
+    todo = queue.Queue()
+    done = queue.Queue()
+    stopped = threading.Event()
+    failed = []
+    finished = object()
+
+    def _feed():
+        try:
+            for item in items:
+                while not slots.acquire(timeout=0.5):
+                    if stopped.is_set():
+                        return
+                if stopped.is_set():
+                    return
+                todo.put(item)
+        except:
+            failed.append(sys.exc_info())
+        finally:
+            for _ in range(n_workers):
+                todo.put(finished)
+
+    def _work():
+        while True:
+            item = todo.get()
+            if item is finished:
+                done.put(finished)
+                break
+            if stopped.is_set():
+                continue
+            try:
+                done.put((item, function(item), None))
+            except:
+                done.put((item, None, sys.exc_info()))
+
+    for target in [_feed] + [_work] * n_workers:
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+    try:
+        n_finished = 0
+        while n_finished < n_workers:
+            result = _get(done)
+            if result is finished:
+                n_finished += 1
+                continue
+            slots.release()
+            yield result
+        if failed:
+            raise failed[0][1]
+    finally:
+        stopped.set()
+
+HASH_BLOCK_SIZE = 64 * 1024
+HASH_BUFFER_SIZE = CHUNK_SIZE
+
+def _hash_file(normpath, size, block_size=None):
+    """Return the SHA1 digest of the file at normpath or, if block_size is
+    given, of its first and last blocks of that size.
+    """
+    sha1 = hashlib.sha1()
+    with io.open(normpath, "rb") as f:
+        if block_size:
+            sha1.update(f.read(block_size))
+            if size > block_size:
+                f.seek(max(block_size, size - block_size))
+                sha1.update(f.read(block_size))
+        else:
+            buffer = bytearray(HASH_BUFFER_SIZE)
+            view = memoryview(buffer)
+            while True:
+                n_bytes = f.readinto(buffer)
+                if not n_bytes:
+                    break
+                sha1.update(view[:n_bytes])
+    return sha1.digest()
+
+def _file_id(normpath):
+    """Return (volume serial number, file index) for the file at normpath:
+    two paths with the same id are hard links to the same file. The file
+    is opened without asking for access to its contents so that a file
+    held open by someone else can still be identified.
+    """
+    hFile = wrapped(
+        win32file.CreateFile,
+        normpath,
+        0,
+        FILE_SHARE.READ | FILE_SHARE.WRITE | FILE_SHARE.DELETE,
+        None,
+        FILE_CREATION.OPEN_EXISTING,
+        FILE_FLAG.BACKUP_SEMANTICS,
+        None
+    )
+    try:
+        file_information = wrapped(win32file.GetFileInformationByHandle, hFile)
+    finally:
+        hFile.close()
+    return file_information[4], file_information[9], file_information[8]
+
+def _replace_with_hard_link(original, duplicate):
+    """Make duplicate a hard link to original. The link is created under
+    a temporary name and moved over duplicate so that there's no moment
+    at which duplicate doesn't exist.
+    """
+    temporary = duplicate._normpath + ".hardlink"
+    original.hard_link_to(temporary)
+    try:
+        wrapped(win32file.MoveFileEx, temporary, duplicate._normpath, MOVEFILE.REPLACE_EXISTING)
+    except:
+        wrapped(win32file.DeleteFileW, temporary)
+        raise
+    _invalidate(duplicate._normpath)
+
+def duplicates(roots, min_size=1, workers=4, block_size=HASH_BLOCK_SIZE, hard_link=False, error_handler=None):
+    """Find files with the same contents anywhere beneath one or more roots,
+    yielding a list of :class:`File` objects for each set of duplicates. The
+    work is staged so that only files which might be duplicates are read:
+
+    * files are grouped by size, from the directory data gathered by the walk;
+    * files of the same size are grouped by a hash of their first and last blocks;
+    * files which are already hard links to each other count only once;
+    * files which still match, and are bigger than those two blocks, are hashed in full.
+
+    The hashing is done by `workers` threads. If `hard_link` is True, every
+    file in a set after the first is replaced by a hard link to the first,
+    which only works if they're all on the same volume. eg::
+
+        from winsys import fs
+        for files in fs.duplicates(["//server/share1", "//server/share2"], min_size=1024 * 1024):
+            print(files[0].size, files)
+
+    :param roots: anything accepted by :func:`dir`, or a list of such
+    :param min_size: ignore files smaller than this many bytes [1, ie ignore empty files]
+    :param workers: how many threads hash files [4]
+    :param block_size: how much to hash at each end of a file in the second stage
+    :param hard_link: replace duplicates by hard links to the first of each set [False]
+    :param error_handler: passed sys.exc_info for each failure; returns True to leave that file out and carry on
+    :returns: yields a list of :class:`File` objects for each set of duplicates, sorted by path
+    """
+    if isinstance(roots, basestring):
+        roots = [roots]
+
+    by_size = collections.defaultdict(dict)
+    for root in roots:
+        for record in flat(root, error_handler=error_handler, records=True):
+            if record.size >= min_size:
+                by_size[record.size].setdefault(record.filepath.lower(), record)
+    candidates = [records for records in by_size.values() if len(records) > 1]
+    del by_size
+
+    def _distinct_files(groups):
+        """Keep only the first path, in sorted order, of any files in a group
+        which are already hard links to each other so that they're neither
+        reported nor relinked; groups left with only one file are dropped.
+        """
+        records = ((n_group, record) for n_group, group in enumerate(groups) for record in group)
+        file_id_of = lambda item: _file_id(normalised(item[1].filepath))
+        by_id = {}
+        with contextlib.closing(_threaded_map(file_id_of, records, workers)) as results:
+            for (n_group, record), file_id, exc_info in results:
+                if exc_info is None:
+                    key = n_group, file_id
+                    if key not in by_id or record.filepath.lower() < by_id[key].filepath.lower():
+                        by_id[key] = record
+                elif not (error_handler and error_handler(exc_info)):
+                    raise exc_info[1]
+        by_group = collections.defaultdict(list)
+        for (n_group, _), record in by_id.items():
+            by_group[n_group].append(record)
+        return [group for group in by_group.values() if len(group) > 1]
+
+    def _hashed_groups(groups, partial):
+        by_hash = collections.defaultdict(list)
+        records = (record for group in groups for record in group)
+        digest_of = lambda record: _hash_file(normalised(record.filepath), record.size, block_size if partial else None)
+        with contextlib.closing(_threaded_map(digest_of, records, workers)) as results:
+            for record, digest, exc_info in results:
+                if exc_info is None:
+                    by_hash[record.size, digest].append(record)
+                elif not (error_handler and error_handler(exc_info)):
+                    raise exc_info[1]
+        return [group for group in by_hash.values() if len(group) > 1]
+
+    def _found(group):
+        files = [record.entry() for record in sorted(group, key=lambda record: record.filepath.lower())]
+        if hard_link:
+            for duplicate in files[1:]:
+                try:
+                    _replace_with_hard_link(files[0], duplicate)
+                except:
+                    if not (error_handler and error_handler(sys.exc_info())):
+                        raise
+        return files
+
+    #
+    # Files are only checked for being hard links to each other once the
+    # partial hash has ruled out most of them, so that few need opening. A
+    # file no bigger than the two blocks hashed at its ends has been hashed
+    # in full already.
+    #
+    to_hash_in_full = []
+    for group in _distinct_files(_hashed_groups((records.values() for records in candidates), partial=True)):
+        if group[0].size <= 2 * block_size:
+            yield _found(group)
+        else:
+            to_hash_in_full.append(group)
+    for group in _hashed_groups(to_hash_in_full, partial=False):
+        yield _found(group)
+
+def progress_wrapper(callback):
+
+    def _progress_wrapper(
+        TotalFileSize, TotalBytesTransferred,
+        StreamSize, StreamBytesTransferred, StreamNumber,
+        CallbackReason,
+        SourceFile, DestinationFile,
+        data
+    ):
+        if callback(TotalFileSize, TotalBytesTransferred, data):
+            return PROGRESS.CANCEL
+        else:
+            return PROGRESS.CONTINUE
+
+    if callback:
+        return _progress_wrapper
+    else:
+        return None
+
+def move(source_filepath, *args, **kwargs):
+    """Move one :class:`Entry` object to another, implemented via :meth:`File.move` or :meth:`Dir.move`
+
+    :param source_filepath: anything accepted by :func:`entry`
+    """
+    return entry(source_filepath).move(*args, **kwargs)
+
+def copy(source_filepath, *args, **kwargs):
+    """Copy one :class:`Entry` object to another, implemented via :meth:`File.copy` or :meth:`Dir.copy`
+
+    :param source_filepath: anything accepted by :func:`entry`
+    """
+    return entry(source_filepath).copy(*args, **kwargs)
+
+MANIFEST_HEADER = "# winsys manifest 1"
+
+class ManifestEntry(collections.namedtuple("ManifestEntry", "path size written_at attributes hash")):
+    """One line of a manifest written by :meth:`Dir.snapshot`: the path relative
+    to the directory snapshotted, the size, the time last written as an integer
+    FILETIME, the attribute bits and the hex SHA1 of the contents or ""
+    """
+
+    __slots__ = ()
+
+    def _get_directory(self):
+        return bool(self.attributes & FILE_ATTRIBUTE.DIRECTORY)
+    directory = property(_get_directory)
+
+def _open_manifest(filepath, mode):
+    filepath = unicode(filepath)
+    if filepath.lower().endswith(".gz"):
+        return io.TextIOWrapper(gzip.open(filepath, mode + "b"), encoding="utf-8", newline="\n")
+    else:
+        return io.open(filepath, mode, encoding="utf-8", newline="\n")
+
+def _sorted_key(relative_path):
+    return relative_path.lower().split(sep)
+
+def _sorted_walk(top, error_handler=None):
+    """Yield an :class:`EntryRecord` for everything beneath top, parents before
+    their children and each directory's entries in order of name regardless of
+    case, so that the paths come out in the order of :func:`_sorted_key`.
+    Only one listing per level of the tree is held at a time.
+    """
+    def _listing(dirpath):
+        return iter(sorted(
+            _files(os.path.join(dirpath, "*"), error_handler=error_handler, records=True),
+            key=lambda record: record.name.lower()
+        ))
+
+    stack = [_listing(unicode(top))]
+    while stack:
+        for record in stack[-1]:
+            yield record
+            if record.directory and not record.attributes & FILE_ATTRIBUTE.REPARSE_POINT:
+                stack.append(_listing(record.filepath))
+                break
+        else:
+            stack.pop()
+
+def read_manifest(manifest_filepath):
+    """Generate a :class:`ManifestEntry` for each line of a manifest
+    written by :meth:`Dir.snapshot`, reading one line at a time.
+
+    :param manifest_filepath: anything accepted by :func:`file`
+    """
+    with _open_manifest(manifest_filepath, "r") as manifest:
+        for line in manifest:
+            if line.startswith("#"):
+                continue
+            path, size, written_at, attributes, digest = line.rstrip("\n").split("\t")
+            yield ManifestEntry(path, int(size), int(written_at), int(attributes), digest)
+
+def diff(manifest_a, manifest_b, ignored_attributes=FILE_ATTRIBUTE.ARCHIVE):
+    """Compare two manifests written by :meth:`Dir.snapshot`, generating
+    (action, old, new) for every path which differs, where action is
+    :const:`FILE_ACTION` ADDED, REMOVED or MODIFIED and old and new are the
+    :class:`ManifestEntry` from each side, or None if there isn't one. An entry
+    has been modified if its size, the time it was written or its attributes
+    differ or, where both manifests have them, its hash. Both manifests are
+    read in a single pass side by side, so memory use is constant however
+    many entries they hold.
+
+    :param manifest_a: anything accepted by :func:`file`
+    :param manifest_b: anything accepted by :func:`file`
+    :param ignored_attributes: attributes which aren't counted as a change [ARCHIVE]
+    """
+    entries_a = read_manifest(manifest_a)
+    entries_b = read_manifest(manifest_b)
+    a = next(entries_a, None)
+    b = next(entries_b, None)
+    while a is not None or b is not None:
+        key_a = None if a is None else _sorted_key(a.path)
+        key_b = None if b is None else _sorted_key(b.path)
+        if b is None or (a is not None and key_a < key_b):
+            yield FILE_ACTION.REMOVED, a, None
+            a = next(entries_a, None)
+        elif a is None or key_b < key_a:
+            yield FILE_ACTION.ADDED, None, b
+            b = next(entries_b, None)
+        else:
+            if (
+                a.size != b.size or
+                a.written_at != b.written_at or
+                (a.attributes ^ b.attributes) & ~ignored_attributes or
+                (a.hash and b.hash and a.hash != b.hash)
+            ):
+                yield FILE_ACTION.MODIFIED, a, b
+            a = next(entries_a, None)
+            b = next(entries_b, None)
+
+def snapshot(root, *args, **kwargs):
+    """Write a manifest of a directory tree, implemented via :meth:`Dir.snapshot`
+
+    :param root: anything accepted by :func:`dir`
+    """
+    return dir(root).snapshot(*args, **kwargs)
+
+def sync(source_filepath, *args, **kwargs):
+    """Bring one directory into line with another, implemented via :meth:`Dir.sync`
+
+    :param source_filepath: anything accepted by :func:`dir`
+    """
+    return dir(source_filepath).sync(*args, **kwargs)
+
+def delete(filepath):
+    """Deletes a :class:`Entry` object, implemented via :meth:`File.delete` or :meth:`Dir.delete`
+
+    :param filepath: anything accepted by :func:`entry`
+    """
+    return entry(filepath).delete()
+
+def rmdir(filepath, recursive=False):
+    """Mimic the os.rmdir functionality, optionally recursing
+
+    :param filepath: anything accepted by :func:`dir`
+    :param recursive: passed to :meth:`Dir.delete`
+    """
+    return dir(filepath).delete(recursive=recursive)
+
+def attributes(filepath):
+    """Return an :class:`constants.Attributes` object representing the file attributes
+    of filepath, implemented via :meth:`Entry.attributes`
+
+    :param filepath: anything accepted by :func:`entry`
+    :returns: an :class:`constants.Attributes` object
+    """
+    return entry(filepath).attributes
+
+def exists(filepath):
+    """Mimic os.path.exists, implemented via the :class:`Entry` boolean mechanism
+
+    :param filepath: anything accepted by :func:`entry`
+    :returns: :const:`True` if filepath exists, :const:`False` otherwise
+    """
+    return bool(entry(filepath))
+
+def mkdir(dirpath, *args, **kwargs):
+    """Mimic os.mkdir, implemented via :meth:`Dir.create`
+    """
+    return dir(dirpath).create(*args, **kwargs)
+
+def touch(filepath):
+    """Update a file's modification time, creating it if it
+    does not exist, implemented via :meth:`File.create`
+
+    :param filepath: anything accepted by :func:`file`
+    """
+    return file(filepath).create()
+
+def mount(filepath, vol):
+    """Mount vol at filepath, implemented via :meth:`Dir.mount`
+
+    :param filepath: anything accepted by :func:`dir`
+    :param vol: passed to :meth:`Dir.mount`
+    """
+    return dir(filepath).mount(vol)
+
+def dismount(filepath):
+    """Dismount the volume at filepath, implemented via :meth:`Dir.dismount`
+
+    :param filepath: anything accepted by :func:`dir`
+    """
+    return dir(filepath).dismount()
+
+def zip(filepath, *args, **kwargs):
+    """Create and return a zip archive of filepath, implemented via :meth:`File.zip` or :meth:`Dir.zip`
+
+    :param filepath: anything accepted by :func:`entry`
+    """
+    return entry(filepath).zip(*args, **kwargs)
+
+def drive(drive):
+    """Return a :class:`Drive` object representing drive
+
+    ======================================= ==================================================
+    drive                                   Result
+    ======================================= ==================================================
+    :const:`None`                           :const:`None`
+    an :class:`Drive` or subclass object    the same object
+    a drive letter                          a :class:`Drive` object
+    ======================================= ==================================================
+    """
+    if drive is None:
+        return None
+    elif isinstance(drive, Drive):
+        return drive
+    else:
+        return Drive(drive)
+
+def drives():
+    """Iterate over all the drive letters in the system, yielding a :class:`Drive` object
+    representing each one.
+    """
+    for drive in wrapped(win32api.GetLogicalDriveStrings).strip("\x00").split("\x00"):
+        yield Drive(drive)
+
+def volume(volume):
+    r"""Return a :class:`Volume` object corresponding to volume
+
+    ======================================= ==================================================
+    volume                                  Result
+    ======================================= ==================================================
+    :const:`None`                           :const:`None`
+    an :class:`Volume` or subclass object   the same object
+    a volume name \\?\Volume...             a :class:`Volume` object representing that volume
+    a directory name                        a :class:`Volume` object representing the volume
+                                            at that mountpoint
+    ======================================= ==================================================
+    """
+    if volume is None:
+        return None
+    elif isinstance(volume, Volume):
+        return volume
+    elif volume.startswith(r"\\?\Volume"):
+        return Volume(volume)
+    else:
+        return Volume(wrapped(win32file.GetVolumeNameForVolumeMountPoint, volume.rstrip(sep) + sep))
+
+def volumes():
+    """Iterate over all the volumes in the system, yielding a :class:`Volume` object
     representing each one.
     """
     hSearch, volume_name = _kernel32.FindFirstVolume()
@@ -2192,134 +5278,886 @@ def volumes():
         else:
             yield Volume(volume_name)
 
-def share(share):
-    """Return a :class:`Share` object corresponding to share
-    """
-    if share is None:
-        return None
-    elif isinstance(share, Share):
-        return share
-    else:
-        match = re.match(sep * 4 + "(" + LEGAL_FILECHARS + ")" + sep * 2 + "(" + LEGAL_FILECHARS + ")", share)
-        if match:
-            return Share(*match.groups())
-        else:
-            raise x_fs("Invalid share name: %s" % share)
+def share(share):
+    """Return a :class:`Share` object corresponding to share
+    """
+    if share is None:
+        return None
+    elif isinstance(share, Share):
+        return share
+    else:
+        match = re.match(sep * 4 + "(" + LEGAL_FILECHARS + ")" + sep * 2 + "(" + LEGAL_FILECHARS + ")", share)
+        if match:
+            return Share(*match.groups())
+        else:
+            raise x_fs("Invalid share name: %s" % share)
+
+def shares(servername="."):
+    """Iterate over all the shares in a system, yielding a :class:`Share` object
+    representing each one
+    """
+    infos, total, hResume = wrapped(win32net.NetShareEnum, servername, 0)
+    for info in infos:
+        yield Share(servername, info['netname'])
+    while hResume > 0:
+        infos, total, hResume = wrapped(win32net.NetShareEnum, servername, 0, hResume)
+        for info in infos:
+            yield Share(servername, info['netname'])
+
+def mounts():
+    """Iterate over all mounted volume mountpoints in the system, yielding a
+    (:class:`Dir`, :class:`Volume`) pair for each one, eg::
+
+        from winsys import fs
+        drive_volumes = dict(fs.mounts())
+    """
+    for v in volumes():
+        for m in v.mounts:
+            yield Dir(m), v
+
+class ChangeJournal(core._WinSysObject):
+    """The change journal of an NTFS or ReFS volume. Iterating over it yields
+    a :class:`_usn.UsnRecord` for every change recorded from :attr:`next_usn`
+    onwards, reading many at a time with one FSCTL_READ_USN_JOURNAL call::
+
+        from winsys import fs
+        journal = fs.change_journal("c:")
+        for record in journal:
+            print(record.name, fs.USN_REASON.names_from_value(record.reason))
+        save(journal.journal_id, journal.next_usn)
+
+    As each record is yielded, :attr:`next_usn` moves on to it, and at the end of
+    each batch it moves past the batch. Saving it together with :attr:`journal_id`
+    and passing both back in later picks up where this journal left off, seeing
+    at most one record again. If the records from there on have been discarded,
+    or the journal has been recreated since, :exc:`x_journal_entries_lost` is
+    raised and the volume should be scanned afresh.
+
+    Records only name the file changed and the file reference number of its
+    parent directory; a :func:`volume_index` can turn those into paths.
+    """
+
+    BUFFER_SIZE = CHUNK_SIZE
+
+    def __init__(
+        self,
+        volume,
+        start_usn=None,
+        journal_id=None,
+        reason_mask=0xffffffff,
+        follow=False,
+        buffer_size=BUFFER_SIZE
+    ):
+        core._WinSysObject.__init__(self)
+        self.volume = volume
+        self.reason_mask = reason_mask
+        self.follow = follow
+        self.buffer_size = buffer_size
+        hVolume = volume.handle()
+        try:
+            journal_data = _usn.journal_data(
+                wrapped(win32file.DeviceIoControl, hVolume, FSCTL.QUERY_USN_JOURNAL, None, 80, None)
+            )
+        finally:
+            hVolume.close()
+        self.journal_id = journal_data.journal_id
+        self.first_usn = journal_data.first_usn
+        if journal_id is not None and journal_id != self.journal_id:
+            raise x_journal_entries_lost(errctx="ChangeJournal", errmsg="The journal has been recreated since %s" % journal_id)
+        if start_usn is None:
+            start_usn = journal_data.next_usn
+        elif start_usn < self.first_usn:
+            raise x_journal_entries_lost(errctx="ChangeJournal", errmsg="The journal now starts after USN %s" % start_usn)
+        self.next_usn = start_usn
+
+    def as_string(self):
+        return "Change journal %x for %s at USN %s" % (self.journal_id, self.volume, self.next_usn)
+
+    def dumped(self, level=0):
+        output = []
+        output.append("volume: %s" % self.volume)
+        output.append("journal_id: %x" % self.journal_id)
+        output.append("first_usn: %s" % self.first_usn)
+        output.append("next_usn: %s" % self.next_usn)
+        return utils.dumped("\n".join(output), level)
+
+    def __iter__(self):
+        buffer = wrapped(win32file.AllocateReadBuffer, self.buffer_size)
+        hVolume = self.volume.handle()
+        try:
+            while True:
+                data = wrapped(
+                    win32file.DeviceIoControl,
+                    hVolume,
+                    FSCTL.READ_USN_JOURNAL,
+                    _usn.read_journal_data(
+                        self.next_usn,
+                        self.reason_mask,
+                        self.journal_id,
+                        bytes_to_wait_for=1 if self.follow else 0
+                    ),
+                    buffer,
+                    None
+                )
+                n_records = 0
+                for record in _usn.records(data):
+                    n_records += 1
+                    self.next_usn = record.usn
+                    yield record
+                self.next_usn = _usn.next_value(data)
+                if n_records == 0 and not self.follow:
+                    break
+        finally:
+            hVolume.close()
+
+def change_journal(vol, start_usn=None, journal_id=None, reason_mask=0xffffffff, follow=False, buffer_size=ChangeJournal.BUFFER_SIZE):
+    """Return a :class:`ChangeJournal` which iterates over the changes recorded
+    on a volume. By default only changes made from now on are seen, and iteration
+    stops when it catches up; with `follow` it waits for more instead.
+
+    :param vol: anything accepted by :func:`volume`
+    :param start_usn: the USN to start from, eg a saved :attr:`ChangeJournal.next_usn`
+    :param journal_id: the :attr:`ChangeJournal.journal_id` which start_usn belongs to
+    :param reason_mask: a combination of :const:`USN_REASON` values to report
+    :param follow: whether to wait for new changes rather than stopping
+    :param buffer_size: how many bytes of records to read at a time
+    :returns: a :class:`ChangeJournal`
+    """
+    return ChangeJournal(volume(vol), start_usn, journal_id, reason_mask, follow, buffer_size)
+
+VolumeIndex = _usn.VolumeIndex
+
+def volume_index(vol, buffer_size=CHUNK_SIZE):
+    """Return a :class:`VolumeIndex` of every file and directory on an NTFS volume,
+    read from its master file table with FSCTL_ENUM_USN_DATA. This is many times
+    faster than walking the volume: each read of `buffer_size` bytes returns the
+    name, attributes and parent of thousands of entries. Paths are rooted at the
+    volume's first mount point::
+
+        from winsys import fs
+        index = fs.volume_index("c:")
+        for filepath in index.with_extension(".iso"):
+            print(filepath)
+
+    This usually needs administrative rights.
+
+    :param vol: anything accepted by :func:`volume`
+    :param buffer_size: how many bytes of records to read at a time
+    :returns: a :class:`VolumeIndex`
+    """
+    vol = volume(vol)
+    mounts = list(vol.mounts)
+    index = VolumeIndex(unicode(mounts[0]) if mounts else vol.name)
+    buffer = wrapped(win32file.AllocateReadBuffer, buffer_size)
+    hVolume = vol.handle()
+    try:
+        start = 0
+        while True:
+            try:
+                data = wrapped(
+                    win32file.DeviceIoControl,
+                    hVolume,
+                    FSCTL.ENUM_USN_DATA,
+                    _usn.mft_enum_data(start),
+                    buffer,
+                    None
+                )
+            except x_fs as err:
+                (errno, errctx, errmsg) = err.args
+                if errno == winerror.ERROR_HANDLE_EOF:
+                    break
+                raise
+            start = index.add_buffer(data)
+    finally:
+        hVolume.close()
+    return index
+
+def _path_from_reference(hVolumeHint, file_reference):
+    """Return the path of the file or directory whose file reference number
+    is file_reference on the volume of hVolumeHint, or None if it's gone
+    """
+    try:
+        hFile = wrapped(
+            win32file.OpenFileById,
+            hVolumeHint,
+            file_reference,
+            0,
+            FILE_SHARE.READ | FILE_SHARE.WRITE | FILE_SHARE.DELETE,
+            FILE_FLAG.BACKUP_SEMANTICS,
+            None
+        )
+    except exc.x_winsys:
+        return None
+    try:
+        filepath = wrapped(win32file.GetFinalPathNameByHandle, hFile, 0)
+    finally:
+        hFile.close()
+    if filepath.startswith("\\\\?\\UNC\\"):
+        return "\\" + filepath[7:]
+    elif filepath.startswith("\\\\?\\"):
+        return filepath[4:]
+    else:
+        return filepath
+
+def _like(pattern):
+    """Translate a wildcard pattern into an SQL LIKE pattern using ! as
+    an escape, or return None if it uses sets, which LIKE can't express
+    """
+    if "[" in pattern:
+        return None
+    like = []
+    for c in pattern:
+        if c == "*":
+            like.append("%")
+        elif c == "?":
+            like.append("_")
+        elif c in "%_!":
+            like.append("!" + c)
+        else:
+            like.append(c)
+    return "".join(like)
+
+def _ext(name):
+    dot = name.rfind(".")
+    return name[dot:].lower() if dot > 0 else ""
+
+class Catalogue(core._WinSysObject):
+    """A persistent catalogue of every file and directory beneath one or more
+    roots, holding the raw FIND data -- path, size, times as integer FILETIMEs
+    and attributes -- in an indexed SQLite database. Once a root has been added,
+    questions like "where are the files called X" or "what has changed since
+    yesterday" are answered by :meth:`query` without going to the filesystem::
+
+        from winsys import fs
+        catalogue = fs.Catalogue("c:/catalogues/shares.db")
+        catalogue.add_root("//server/share")
+        catalogue.refresh()
+        for record in catalogue.query("*.pst", modified_after=datetime.timedelta(days=1)):
+            print(record.filepath, record.size)
+
+    The catalogue is kept up-to-date either by calling :meth:`refresh`, which
+    reads the change journal of each root's volume from where it last left off,
+    or by passing changes from :func:`watch` to :meth:`update`. A root whose
+    journal can't be read -- a network share, say, or when not running with
+    administrative rights -- is scanned afresh by :meth:`refresh` instead.
+
+    Like any SQLite connection, a catalogue should only be used by the thread
+    which opened it.
+    """
+
+    BATCH_SIZE = 10000
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            path TEXT NOT NULL PRIMARY KEY COLLATE NOCASE,
+            dirpath TEXT NOT NULL COLLATE NOCASE,
+            name TEXT NOT NULL COLLATE NOCASE,
+            ext TEXT NOT NULL,
+            attributes INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            accessed_at INTEGER NOT NULL,
+            written_at INTEGER NOT NULL,
+            size INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS entries_dirpath ON entries (dirpath);
+        CREATE INDEX IF NOT EXISTS entries_name ON entries (name);
+        CREATE INDEX IF NOT EXISTS entries_ext ON entries (ext);
+        CREATE INDEX IF NOT EXISTS entries_size ON entries (size);
+        CREATE INDEX IF NOT EXISTS entries_written_at ON entries (written_at);
+        CREATE TABLE IF NOT EXISTS roots (
+            root TEXT NOT NULL PRIMARY KEY COLLATE NOCASE,
+            journal_id INTEGER,
+            next_usn INTEGER
+        );
+    """
+    COLUMNS = "dirpath, name, attributes, created_at, accessed_at, written_at, size"
+
+    def __init__(self, filepath):
+        core._WinSysObject.__init__(self)
+        self.filepath = unicode(filepath)
+        self.db = sqlite3.connect(self.filepath)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.executescript(self.SCHEMA)
+
+    def as_string(self):
+        return "Catalogue in %s" % self.filepath
+
+    def dumped(self, level=0):
+        output = []
+        output.append("filepath: %s" % self.filepath)
+        output.append("roots:\n%s" % utils.dumped_list(self.roots(), level))
+        output.append("entries: %s" % len(self))
+        return utils.dumped("\n".join(output), level)
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def _key(filepath):
+        return unicode(filepath).rstrip(seps)
+
+    @staticmethod
+    def _beneath(column):
+        return "(%s = ? OR (%s >= ? AND %s < ?))" % (column, column, column)
+
+    @staticmethod
+    def _beneath_args(key):
+        #
+        # Everything beneath key sorts between key + "\" and key + "]"
+        #
+        return key, key + sep, key + "]"
 
-def shares(servername="."):
-    """Iterate over all the shares in a system, yielding a :class:`Share` object
-    representing each one
-    """
-    infos, total, hResume = wrapped(win32net.NetShareEnum, servername, 0)
-    for info in infos:
-        yield Share(servername, info['netname'])
-    while hResume > 0:
-        infos, total, hResume = wrapped(win32net.NetShareEnum, servername, 0, hResume)
-        for info in infos:
-            yield Share(servername, info['netname'])
+    def roots(self):
+        return [root for (root,) in self.db.execute("SELECT root FROM roots ORDER BY root")]
 
-def mounts():
-    """Iterate over all mounted volume mountpoints in the system, yielding a
-    (:class:`Dir`, :class:`Volume`) pair for each one, eg::
+    def _row(self, dirpath, name, attributes, created_at, accessed_at, written_at, size):
+        return (dirpath + sep + name, dirpath, name, _ext(name), attributes, created_at, accessed_at, written_at, size)
 
-        from winsys import fs
-        drive_volumes = dict(fs.mounts())
+    def _insert(self, rows):
+        self.db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def _delete(self, filepath):
+        self.db.execute("DELETE FROM entries WHERE %s" % self._beneath("path"), self._beneath_args(self._key(filepath)))
+
+    def _scan(self, top, error_handler=None):
+        """Add everything beneath top, which is assumed not to be in the
+        catalogue already, in batches of :attr:`BATCH_SIZE` rows
+        """
+        rows = []
+        stack = [self._key(top)]
+        while stack:
+            dirpath = stack.pop()
+            for _, file_info in _find_data(dirpath + sep + "*", error_handler=error_handler):
+                name = file_info[8]
+                attributes = file_info[0]
+                if attributes & FILE_ATTRIBUTE.DIRECTORY and not attributes & FILE_ATTRIBUTE.REPARSE_POINT:
+                    stack.append(dirpath + sep + name)
+                rows.append(self._row(
+                    dirpath,
+                    name,
+                    attributes,
+                    utils.filetime_from_pytime(file_info[1]),
+                    utils.filetime_from_pytime(file_info[2]),
+                    utils.filetime_from_pytime(file_info[3]),
+                    utils._longword(file_info[5], file_info[4])
+                ))
+                if len(rows) >= self.BATCH_SIZE:
+                    self._insert(rows)
+                    rows = []
+        self._insert(rows)
+
+    @staticmethod
+    def _journal(root):
+        """Return the change journal for root's volume, or None if it can't be read
+        """
+        try:
+            return change_journal(wrapped(win32file.GetVolumePathName, root))
+        except exc.x_winsys:
+            return None
+
+    def add_root(self, root, error_handler=None):
+        """Catalogue everything beneath root, replacing anything already held
+        for it. The position of its volume's change journal is noted first, so
+        that :meth:`refresh` will pick up any changes made during the scan.
+
+        :param root: anything accepted by :func:`dir`
+        :param error_handler: as for :meth:`Dir.walk`
+        :returns: this catalogue
+        """
+        root = self._key(dir(root))
+        journal = self._journal(root)
+        with self.db:
+            self._delete(root)
+            self.db.execute(
+                "INSERT OR REPLACE INTO roots VALUES (?, ?, ?)",
+                (root, journal and journal.journal_id, journal and journal.next_usn)
+            )
+            self._scan(root, error_handler)
+        return self
+
+    def remove_root(self, root):
+        """Stop cataloguing root and forget everything held for it
+
+        :param root: anything accepted by :func:`dir`
+        :returns: this catalogue
+        """
+        root = self._key(dir(root))
+        with self.db:
+            self._delete(root)
+            self.db.execute("DELETE FROM roots WHERE root = ?", (root,))
+        return self
+
+    def _root_for(self, filepath):
+        key = self._key(filepath).lower()
+        for root in self.roots():
+            if key == root.lower() or key.startswith(root.lower() + sep):
+                return root
+
+    def _apply(self, filepaths, error_handler=None):
+        """Bring the catalogue into line with the filesystem for each of
+        filepaths, all of which have changed in some way.
+        """
+        for filepath in filepaths:
+            key = self._key(filepath)
+            try:
+                attributes, created_at, accessed_at, written_at, size = _file_attribute_data(normalised(key), refresh=True)
+            except x_no_such_file:
+                self._delete(key)
+                continue
+            dirpath, name = key.rsplit(sep, 1)
+            is_new_dir = (
+                attributes & FILE_ATTRIBUTE.DIRECTORY and
+                self.db.execute("SELECT 1 FROM entries WHERE path = ?", (key,)).fetchone() is None
+            )
+            self._insert([self._row(
+                dirpath,
+                name,
+                attributes,
+                utils.filetime_from_pytime(created_at),
+                utils.filetime_from_pytime(accessed_at),
+                utils.filetime_from_pytime(written_at),
+                size
+            )])
+            #
+            # A directory appearing from elsewhere, eg by being renamed
+            # into place, brings everything beneath it with it.
+            #
+            if is_new_dir:
+                self._scan(key, error_handler)
+
+    def update(self, changes, error_handler=None):
+        """Apply the changes from :func:`watch` -- or from :meth:`_DirWatcher.batches`
+        -- to the catalogue. Changes outside every root are ignored. Each filename
+        changed is looked at afresh, so the same one appearing more than once costs
+        no more than once.
+
+        :param changes: an iterable of (action, old_filename, new_filename)
+        :param error_handler: as for :meth:`Dir.walk`
+        :returns: this catalogue
+        """
+        filepaths = collections.OrderedDict()
+        for action, old_filename, new_filename in changes:
+            for filename in old_filename, new_filename:
+                if filename is not None and self._root_for(filename):
+                    filepaths[self._key(filename).lower()] = self._key(filename)
+        with self.db:
+            self._apply(filepaths.values(), error_handler)
+        return self
+
+    def refresh(self, error_handler=None):
+        """Bring every root up-to-date from its volume's change journal,
+        or by scanning it again if there is no journal or if records
+        have been discarded from it since the last refresh.
+
+        :param error_handler: as for :meth:`Dir.walk`
+        :returns: this catalogue
+        """
+        for root, journal_id, next_usn in self.db.execute("SELECT root, journal_id, next_usn FROM roots").fetchall():
+            if journal_id is None:
+                self.add_root(root, error_handler)
+                continue
+            volume_root = wrapped(win32file.GetVolumePathName, root)
+            try:
+                journal = change_journal(volume_root, next_usn, journal_id)
+            except x_journal_entries_lost:
+                self.add_root(root, error_handler)
+                continue
+
+            prefix = root.lower() + sep
+            dirpaths = {}
+            filepaths = collections.OrderedDict()
+            hVolumeHint = handle(volume_root)
+            try:
+                for record in journal:
+                    dirpath = dirpaths.get(record.parent_reference)
+                    if dirpath is None:
+                        dirpath = dirpaths[record.parent_reference] = _path_from_reference(hVolumeHint, record.parent_reference) or ""
+                    filepath = dirpath.rstrip(seps) + sep + record.name
+                    if filepath.lower().startswith(prefix):
+                        filepaths[filepath.lower()] = filepath
+            finally:
+                hVolumeHint.close()
+
+            with self.db:
+                self._apply(filepaths.values(), error_handler)
+                self.db.execute("UPDATE roots SET next_usn = ? WHERE root = ?", (journal.next_usn, root))
+        return self
+
+    def query(
+        self,
+        pattern="*",
+        under=None,
+        min_size=None, max_size=None,
+        modified_after=None, modified_before=None,
+        directories=False
+    ):
+        """Generate an :class:`EntryRecord` for each file in the catalogue
+        meeting all the criteria given. Only files are returned unless
+        directories is True.
+
+        :param pattern: a wildcard pattern to match each name against
+        :param under: anything accepted by :func:`dir`; only entries beneath it are returned
+        :param min_size: files must be at least this many bytes
+        :param max_size: files must be no more than this many bytes
+        :param modified_after: files must have been written after this datetime or,
+                               if this is a timedelta, within that long before now
+        :param modified_before: files must have been written before this datetime or,
+                                if this is a timedelta, longer than that before now
+        :param directories: whether to return directories as well as files
+        """
+        where = []
+        args = []
+        match = None
+        if pattern and pattern != "*":
+            #
+            # ext holds only what follows the last dot, so "*.tar.gz"
+            # can't be looked up there.
+            #
+            if pattern.startswith("*.") and not _GLOB_MAGIC.search(pattern[2:]) and "." not in pattern[2:]:
+                where.append("ext = ?")
+                args.append(pattern[1:].lower())
+            else:
+                like = _like(pattern)
+                if like is None:
+                    match = matcher(pattern).match
+                else:
+                    where.append("name LIKE ? ESCAPE '!'")
+                    args.append(like)
+        if under is not None:
+            where.append(self._beneath("dirpath"))
+            args.extend(self._beneath_args(self._key(dir(under))))
+        if min_size is not None:
+            where.append("size >= ?")
+            args.append(min_size)
+        if max_size is not None:
+            where.append("size <= ?")
+            args.append(max_size)
+        for moment, comparison in (modified_after, ">"), (modified_before, "<"):
+            if moment is not None:
+                if isinstance(moment, datetime.timedelta):
+                    moment = datetime.datetime.now() - moment
+                where.append("written_at %s ?" % comparison)
+                args.append(utils.filetime_from_datetime(moment))
+        if not directories:
+            where.append("attributes & ? = 0")
+            args.append(FILE_ATTRIBUTE.DIRECTORY)
+
+        sql = "SELECT %s FROM entries" % self.COLUMNS
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        for dirpath, name, attributes, created_at, accessed_at, written_at, size in self.db.execute(sql, args):
+            if match is None or match(name):
+                yield EntryRecord(dirpath + sep, name, attributes, created_at, accessed_at, written_at, size)
+
+def _watch_handle(root):
+    """Open root for overlapped ReadDirectoryChangesW calls
     """
-    for v in volumes():
-        for m in v.mounts:
-            yield Dir(m), v
+    return wrapped(
+        win32file.CreateFile,
+        normalised(root),
+        FILE_ACCESS.LIST_DIRECTORY,
+        #
+        # This must allow RWD otherwises files in
+        # the dir will be constrained.
+        #
+        FILE_SHARE.READ | FILE_SHARE.WRITE | FILE_SHARE.DELETE,
+        None,
+        FILE_CREATION.OPEN_EXISTING,
+        FILE_FLAG.BACKUP_SEMANTICS | FILE_FLAG.OVERLAPPED,
+        None
+    )
+
+def _entry_or_none(filepath):
+    return None if filepath is None else entry(filepath)
 
 class _DirWatcher(object):
 
     WATCH_FOR = reduce(operator.or_, FILE_NOTIFY_CHANGE.values())
     BUFFER_SIZE = 8192
+    MAX_BUFFER_SIZE = 1024 * 1024
+    N_READS = 2
     TIMEOUT = 500
-
-    def __init__(self, root, subdirs=False, watch_for=WATCH_FOR, buffer_size=BUFFER_SIZE, stop_event=None):
+    BATCH_WINDOW_MS = 100
+    TIMED_OUT = object()
+
+    def __init__(
+        self,
+        root,
+        subdirs=False,
+        watch_for=WATCH_FOR,
+        buffer_size=BUFFER_SIZE,
+        stop_event=None,
+        max_buffer_size=MAX_BUFFER_SIZE
+    ):
         self.root = root
         self.subdirs = subdirs
         self.watch_for = watch_for
-        self.overlapped = wrapped(pywintypes.OVERLAPPED)
-        self.overlapped.hEvent = wrapped(win32event.CreateEvent, None, 0, 0, None)
-        self.buffer = wrapped(win32file.AllocateReadBuffer, buffer_size)
-        self.hDir = wrapped(
-            win32file.CreateFile,
-            normalised(root),
-            FILE_ACCESS.LIST_DIRECTORY,
-            #
-            # This must allow RWD otherwises files in
-            # the dir will be constrained.
-            #
-            FILE_SHARE.READ | FILE_SHARE.WRITE | FILE_SHARE.DELETE,
-            None,
-            FILE_CREATION.OPEN_EXISTING,
-            FILE_FLAG.BACKUP_SEMANTICS | FILE_FLAG.OVERLAPPED,
-            None
-        )
-        self.events = [self.overlapped.hEvent]
+        self.buffer_size = buffer_size
+        self.max_buffer_size = max(buffer_size, max_buffer_size)
+        self.n_reads = self.n_overflows = self.n_grown = 0
+        self.peak_bytes = 0
+        self.hDir = _watch_handle(root)
+        self._reads = self._new_reads()
+        self._next_read = 0
+        self._stop_event = wrapped(win32event.CreateEvent, None, 1, 0, None)
+        self.events = [self._reads[0][0].hEvent, self._stop_event]
         if stop_event is not None:
             self.events.append(stop_event.pyobject())
         self._changes = collections.deque()
+        self._reading = False
 
     def __iter__(self):
         return self
 
-    def next(self):
+    def _new_reads(self):
+        """Keep more than one read outstanding so that the kernel always
+        has a buffer to fill while the last one is being unpacked. The
+        reads complete in the order in which they were issued.
+        """
+        reads = []
+        for i in range(self.N_READS):
+            overlapped = wrapped(pywintypes.OVERLAPPED)
+            overlapped.hEvent = wrapped(win32event.CreateEvent, None, 0, 0, None)
+            reads.append([overlapped, wrapped(win32file.AllocateReadBuffer, self.buffer_size)])
+        return reads
+
+    def _read(self, read):
+        """Issue a ReadDirectoryChangesW using the overlapped structure and buffer in read
+        """
+        overlapped, buffer = read
         wrapped(
             win32file.ReadDirectoryChangesW,
             self.hDir,
-            self.buffer,
+            buffer,
             self.subdirs,
             self.watch_for,
-            self.overlapped
+            overlapped
         )
+
+    def _grow(self):
+        """Double the buffer size and carry on reading into the bigger buffers
+        from a new handle on the root: the kernel keeps its own buffer for a
+        handle, sized by the first read made on it, so reading the same handle
+        into a bigger buffer would lose changes just as before.
+
+        The new reads are issued before the old handle is closed so that
+        nothing is missed in between. Whatever the outstanding reads on the
+        old handle had picked up is returned, as (action, filename) pairs;
+        some of it may be reported again by the new handle.
+        """
+        self.buffer_size = min(2 * self.buffer_size, self.max_buffer_size)
+        self.n_grown += 1
+        hDir, reads = self.hDir, self._reads
+        outstanding = [reads[(self._next_read + i) % len(reads)] for i in range(len(reads) - 1)]
+        self.hDir = _watch_handle(self.root)
+        self._reads = self._new_reads()
+        self._next_read = 0
+        for read in self._reads:
+            self._read(read)
+
+        raw_changes = []
+        try:
+            for overlapped, buffer in outstanding:
+                try:
+                    win32file.CancelIoEx(hDir, overlapped)
+                except win32file.error:
+                    pass
+                try:
+                    n_bytes = wrapped(win32file.GetOverlappedResult, hDir, overlapped, True)
+                except exc.x_winsys:
+                    n_bytes = 0
+                if n_bytes:
+                    raw_changes.extend(wrapped(win32file.FILE_NOTIFY_INFORMATION, buffer, n_bytes))
+        finally:
+            hDir.close()
+        return raw_changes
+
+    def _start_reading(self):
+        """Issue the first reads, if they haven't been already, so that changes
+        from now on are caught even if nothing waits for them for a while.
+        """
+        if not self._reading:
+            for read in self._reads:
+                self._read(read)
+            self._reading = True
+
+    def _stopped(self):
+        return wrapped(win32event.WaitForSingleObject, self._stop_event, 0) == win32event.WAIT_OBJECT_0
+
+    def _raw_changes(self, timeout_ms=None):
+        """Wait for the oldest outstanding ReadDirectoryChangesW to complete,
+        returning the (action, filename) pairs it produced with filenames
+        relative to the root. An empty list means that there were more
+        changes than the buffer could hold and they have been lost; None
+        means that the watcher has been stopped.
+
+        Each time changes are lost, or a read comes close to filling its
+        buffer, the buffer size is doubled up to :attr:`max_buffer_size`
+        (cf :meth:`_grow`). The reads are reissued as soon as they have been
+        unpacked, so the next one is already outstanding when this returns.
+
+        If `timeout_ms` is given and nothing has happened by then,
+        :attr:`TIMED_OUT` is returned and the reads are left outstanding,
+        to be picked up by the next call.
+        """
+        self._start_reading()
+        read = self._reads[self._next_read]
+        overlapped, buffer = read
+        self.events[0] = overlapped.hEvent
+        if timeout_ms is not None:
+            deadline = time.time() + timeout_ms / 1000.0
         while True:
+            if timeout_ms is None:
+                wait_ms = self.TIMEOUT
+            else:
+                wait_ms = max(0, min(self.TIMEOUT, int(1000 * (deadline - time.time()))))
             stopped_by = wrapped(
                 win32event.WaitForMultipleObjects,
                 self.events,
                 0,
-                self.TIMEOUT
+                wait_ms
             )
-            if stopped_by == win32event.WAIT_OBJECT_0 + 1:
+            if stopped_by == win32event.WAIT_OBJECT_0:
+                break
+            elif win32event.WAIT_OBJECT_0 < stopped_by < win32event.WAIT_OBJECT_0 + len(self.events):
+                return None
+            elif timeout_ms is not None and time.time() >= deadline:
+                return self.TIMED_OUT
+
+        self._next_read = (self._next_read + 1) % len(self._reads)
+        self.n_reads += 1
+        try:
+            n_bytes = wrapped(win32file.GetOverlappedResult, self.hDir, overlapped, True)
+        except exc.x_winsys as err:
+            (errno, errctx, errmsg) = err.args
+            if errno != winerror.ERROR_NOTIFY_ENUM_DIR:
+                raise
+            n_bytes = 0
+
+        if n_bytes == 0:
+            self.n_overflows += 1
+            raw_changes = []
+        else:
+            self.peak_bytes = max(self.peak_bytes, n_bytes)
+            raw_changes = wrapped(win32file.FILE_NOTIFY_INFORMATION, buffer, n_bytes)
+
+        if self._stopped():
+            return None
+        if self.buffer_size < self.max_buffer_size and (n_bytes == 0 or n_bytes > len(buffer) * 3 // 4):
+            #
+            # Changes read by the old handle after an overflow add nothing:
+            # the caller must look at everything again anyway.
+            #
+            drained = self._grow()
+            if raw_changes:
+                raw_changes.extend(drained)
+        else:
+            self._read(read)
+        return raw_changes
+
+    def next(self):
+        while not self._changes:
+            raw_changes = self._raw_changes()
+            if raw_changes is None:
                 return
-            elif stopped_by == win32event.WAIT_OBJECT_0:
-                n_bytes = wrapped(win32file.GetOverlappedResult, self.hDir, self.overlapped, True)
-                if n_bytes == 0:
-                    continue
 
-                last_result = None
-                old_file = new_file = None
-                for action, filename in wrapped(win32file.FILE_NOTIFY_INFORMATION, self.buffer, n_bytes):
-                    if action == FILE_ACTION.ADDED:
-                        new_file = entry(os.path.join(self.root, filename))
-                    elif action == FILE_ACTION.REMOVED:
-                        old_file = entry(os.path.join(self.root, filename))
-                    elif action == FILE_ACTION.MODIFIED:
-                        old_file = new_file = entry(os.path.join(self.root, filename))
-                    elif action == FILE_ACTION.RENAMED_OLD_NAME:
-                        old_file = entry(os.path.join(self.root, filename))
-                        action = None
-                    elif action == FILE_ACTION.RENAMED_NEW_NAME:
-                        new_file = entry(os.path.join(self.root, filename))
-
-                    if action:
-                        result =(action, old_file, new_file)
-                        if result != last_result:
-                            self._changes.append(result)
-
-            if self._changes:
-                return self._changes.popleft()
+            for action, old_filename, new_filename in _watch.changes(self.root, raw_changes):
+                self._changes.append((action, _entry_or_none(old_filename), _entry_or_none(new_filename)))
+
+        return self._changes.popleft()
     __next__ = next
 
+    def batches(self, window_ms=BATCH_WINDOW_MS, resolve=False):
+        """Yield a :class:`WatchBatch` of changes every time something changes,
+        waiting `window_ms` milliseconds after the first change for any others
+        so that a burst arrives together. Within a batch, the same change to the
+        same file is only reported once, as is a change to a file which has just
+        been added. Unlike iterating over the watcher itself, the filenames are
+        not looked up -- by which time they may have gone -- unless `resolve`
+        is True, in which case they are :class:`Entry` objects as for :func:`watch`.
+
+        If changes were lost because there were too many for the buffer, the batch
+        has `overflowed` set, yielded straight away, and the caller should rescan
+        anything it cares about.
+
+        :param window_ms: how long to gather changes for after the first one
+        :param resolve: whether to return :class:`Entry` objects rather than filenames
+        :returns: an iterator of :class:`WatchBatch`
+        """
+        while True:
+            batch = WatchBatch()
+            raw_changes = self._raw_changes()
+            if raw_changes is None:
+                return
+            deadline = time.time() + window_ms / 1000.0
+            while True:
+                if not raw_changes:
+                    batch.overflowed = True
+                    break
+                batch._add(self.root, raw_changes)
+                timeout_ms = int(1000 * (deadline - time.time()))
+                if timeout_ms <= 0:
+                    break
+                raw_changes = self._raw_changes(timeout_ms)
+                if raw_changes is self.TIMED_OUT:
+                    break
+                elif raw_changes is None:
+                    yield batch._resolved() if resolve else batch
+                    return
+            yield batch._resolved() if resolve else batch
+
     def stop(self):
+        win32event.SetEvent(self._stop_event)
         self.hDir.close()
 
+class WatchBatch(list):
+    """The changes seen by :meth:`_DirWatcher.batches` within one window, each
+    an (action, old_filename, new_filename) triple as for :func:`watch`, in the
+    order in which they first happened. If `overflowed` is True, some changes
+    were lost and anything of interest beneath the watched directory should be
+    looked at again.
+    """
+
+    def __init__(self, changes=(), overflowed=False):
+        list.__init__(self, changes)
+        self.overflowed = overflowed
+        self._seen = set()
+
+    def _add(self, root, raw_changes):
+        for change in _watch.changes(root, raw_changes):
+            action, old_filename, new_filename = change
+            #
+            # A file which has just been added or which has already
+            # been modified in this batch needs no further mention.
+            #
+            if action == FILE_ACTION.MODIFIED and (FILE_ACTION.ADDED, None, new_filename) in self._seen:
+                continue
+            if change not in self._seen:
+                self._seen.add(change)
+                self.append(change)
+
+    def _resolved(self):
+        return self.__class__(
+            [(action, _entry_or_none(old_filename), _entry_or_none(new_filename)) for action, old_filename, new_filename in self],
+            self.overflowed
+        )
+
 def watch(
     root,
     subdirs=False,
     watch_for=_DirWatcher.WATCH_FOR,
     buffer_size=_DirWatcher.BUFFER_SIZE,
-    stop_event=None
+    stop_event=None,
+    max_buffer_size=_DirWatcher.MAX_BUFFER_SIZE
 ):
     """Return an iterator which returns a file change on every iteration.
     The file change comes in the form: action, old_filename, new_filename.
@@ -2336,8 +6174,507 @@ def watch(
                 print new_filename, "added"
             elif action == fs.FILE_ACTION.REMOVED:
                 print old_filename, "removed"
+
+    Where changes come in bursts, or may come faster than they can be handled
+    one at a time, the watcher's :meth:`_DirWatcher.batches` method yields them
+    in lists, with repeats removed and the filenames left as they are::
+
+        for batch in fs.watch("c:/temp", subdirs=True).batches(window_ms=250):
+            if batch.overflowed:
+                rescan()
+            for action, old_filename, new_filename in batch:
+                print action, old_filename, new_filename
+
+    The watcher keeps two reads outstanding so that changes have somewhere to
+    go while the last lot are being handled. It starts with a buffer of
+    `buffer_size` bytes and doubles it, up to `max_buffer_size`, whenever changes
+    are lost or a read comes close to filling it. (Watching a network share,
+    no more than 64Kb can be used). How it has got on is recorded in its
+    `buffer_size`, `n_reads`, `n_overflows`, `n_grown` and `peak_bytes`
+    attributes, which can be used to pick a starting size for a busy directory.
+
+    :param root: the directory to watch
+    :param subdirs: whether to watch the whole tree beneath root
+    :param watch_for: a combination of :const:`FILE_NOTIFY_CHANGE` values
+    :param buffer_size: the size in bytes of the buffer to start with
+    :param stop_event: an :class:`ipc.Event` which stops the watcher when set
+    :param max_buffer_size: the size in bytes beyond which the buffer will not grow
+    """
+    return _DirWatcher(unicode(root), subdirs, watch_for, buffer_size, stop_event, max_buffer_size)
+
+class _GroupWatch(object):
+    """One root being watched by a :class:`WatchGroup`: its directory handle,
+    the buffer and overlapped structure of its one outstanding read and
+    the key under which that read completes. `reading` is True from when
+    a read is issued until its completion has been taken off the port.
+    """
+
+    def __init__(self, key, root, tag, subdirs, watch_for, buffer_size):
+        self.key = key
+        self.root = root
+        self.tag = tag
+        self.subdirs = subdirs
+        self.watch_for = watch_for
+        self.buffer_size = buffer_size
+        self.buffer = None
+        self.overlapped = wrapped(pywintypes.OVERLAPPED)
+        self.hDir = None
+        self.reading = False
+        self.n_overflows = 0
+
+    def open(self, port):
+        """Open a handle on the root whose reads complete through port
+        """
+        hDir = _watch_handle(self.root)
+        try:
+            wrapped(win32file.CreateIoCompletionPort, hDir, port, self.key, 0)
+        except:
+            hDir.close()
+            raise
+        self.hDir = hDir
+
+    def reopen(self, port):
+        """Replace the handle on the root, which must have no read
+        outstanding: the kernel keeps its own buffer for a handle, sized by
+        the first read made on it, so a bigger buffer needs a new handle.
+        """
+        self.hDir.close()
+        self.open(port)
+
+    def read(self):
+        if self.buffer is None or len(self.buffer) < self.buffer_size:
+            self.buffer = wrapped(win32file.AllocateReadBuffer, self.buffer_size)
+        wrapped(
+            win32file.ReadDirectoryChangesW,
+            self.hDir,
+            self.buffer,
+            self.subdirs,
+            self.watch_for,
+            self.overlapped
+        )
+        self.reading = True
+
+class WatchGroup(core._WinSysObject):
+    """Watch any number of directories from one thread. Every directory handle
+    is tied to the same I/O completion port, so there is no limit to how many
+    roots can be watched at once and no thread for each one. Iterating over
+    the group yields a (tag, action, old_filename, new_filename) tuple for
+    each change under any root, where tag is whatever was given when the root
+    was added -- by default the root itself -- and the rest are as for
+    :func:`watch` except that the filenames are not looked up::
+
+        from winsys import fs
+        group = fs.WatchGroup(["//server1/share", "//server2/share"])
+        for tag, action, old_filename, new_filename in group:
+            if action == fs.WatchGroup.OVERFLOWED:
+                rescan(tag)
+            elif action == fs.WatchGroup.ERROR:
+                print tag, "failed:", old_filename
+            else:
+                print tag, action, old_filename, new_filename
+
+    If changes under a root are lost because there were too many for its buffer,
+    the action is :attr:`OVERFLOWED`, the filenames are None, and that root's
+    buffer is doubled up to `max_buffer_size`. If a root can't be watched any
+    longer -- because it has been deleted, say, or its share has gone -- the
+    action is :attr:`ERROR`, old_filename is the :class:`x_fs` exception and
+    new_filename is None; that root is no longer watched and can be added again
+    later. Roots can be added and removed from any thread while the group is
+    being iterated over, and fail, without affecting the others.
+    """
+
+    WATCH_FOR = _DirWatcher.WATCH_FOR
+    BUFFER_SIZE = _DirWatcher.BUFFER_SIZE
+    MAX_BUFFER_SIZE = 64 * 1024
+    TIMEOUT = _DirWatcher.TIMEOUT
+    OVERFLOWED = _watch.OVERFLOWED
+    ERROR = -1
+    _STOP = 0
+
+    def __init__(
+        self,
+        roots=(),
+        subdirs=True,
+        watch_for=WATCH_FOR,
+        buffer_size=BUFFER_SIZE,
+        max_buffer_size=MAX_BUFFER_SIZE
+    ):
+        core._WinSysObject.__init__(self)
+        self.subdirs = subdirs
+        self.watch_for = watch_for
+        self.buffer_size = buffer_size
+        self.max_buffer_size = max(buffer_size, max_buffer_size)
+        self.n_overflows = 0
+        self._port = wrapped(win32file.CreateIoCompletionPort, win32file.INVALID_HANDLE_VALUE, None, 0, 0)
+        self._lock = threading.Lock()
+        self._keys = {}
+        self._watches = {}
+        self._closing = {}
+        self._last_key = self._STOP
+        self._stopped = False
+        self._changes = collections.deque()
+        for root in roots:
+            self.add(root)
+
+    def as_string(self):
+        return "WatchGroup of %d roots" % len(self._watches)
+
+    def dumped(self, level=0):
+        output = []
+        output.append("roots:\n%s" % utils.dumped_list(self.roots(), level))
+        output.append("n_overflows: %s" % self.n_overflows)
+        return utils.dumped("\n".join(output), level)
+
+    @staticmethod
+    def _key(root):
+        return normalised(root).rstrip(seps).lower()
+
+    def roots(self):
+        with self._lock:
+            return [watch.root for watch in self._watches.values()]
+
+    def add(self, root, tag=core.UNSET, subdirs=core.UNSET):
+        """Start watching root, tagging its changes with tag
+
+        :param root: anything accepted by :func:`dir`
+        :param tag: any object to identify changes under root [root]
+        :param subdirs: whether to watch the whole tree beneath root [as for the group]
+        :returns: this group
+        """
+        root = unicode(dir(root))
+        root_key = self._key(root)
+        with self._lock:
+            if root_key in self._keys:
+                return self
+            self._last_key += 1
+            watch = _GroupWatch(
+                self._last_key,
+                root,
+                root if tag is core.UNSET else tag,
+                self.subdirs if subdirs is core.UNSET else subdirs,
+                self.watch_for,
+                self.buffer_size
+            )
+            watch.open(self._port)
+            try:
+                watch.read()
+            except:
+                watch.hDir.close()
+                raise
+            self._keys[root_key] = watch.key
+            self._watches[watch.key] = watch
+        return self
+
+    def remove(self, root):
+        """Stop watching root. Any of its changes which have already been
+        read will still be yielded.
+
+        :param root: anything accepted by :func:`dir`
+        :returns: this group
+        """
+        with self._lock:
+            key = self._keys.pop(self._key(root), None)
+            if key is None:
+                return self
+            self._drop(key)
+        return self
+
+    def _drop(self, key):
+        """Stop watching the root whose key is key. The caller holds the lock.
+        """
+        watch = self._watches.pop(key)
+        #
+        # Closing the handle cancels any outstanding read, which still
+        # completes through the port; the buffer it was using must outlive
+        # it. With no read outstanding there's nothing more to wait for.
+        #
+        if watch.reading:
+            self._closing[key] = watch
+        watch.hDir.close()
+
+    def stop(self):
+        """Stop watching every root and finish any iteration
+        """
+        with self._lock:
+            self._stopped = True
+            for root_key in list(self._keys):
+                self._drop(self._keys.pop(root_key))
+        wrapped(win32file.PostQueuedCompletionStatus, self._port, 0, self._STOP, None)
+
+    def __iter__(self):
+        return self
+
+    def _completed(self, watch, n_bytes):
+        """Unpack the changes read for one root and issue its next read
+        """
+        grow = False
+        if n_bytes == 0:
+            watch.n_overflows += 1
+            self.n_overflows += 1
+            grow = watch.buffer_size < self.max_buffer_size
+            self._changes.append((watch.tag, self.OVERFLOWED, None, None))
+        else:
+            raw_changes = wrapped(win32file.FILE_NOTIFY_INFORMATION, watch.buffer, n_bytes)
+            for action, old_filename, new_filename in _watch.changes(watch.root, raw_changes):
+                self._changes.append((watch.tag, action, old_filename, new_filename))
+        with self._lock:
+            if self._watches.get(watch.key) is watch:
+                try:
+                    if grow:
+                        watch.buffer_size = min(2 * watch.buffer_size, self.max_buffer_size)
+                        watch.reopen(self._port)
+                    watch.read()
+                except exc.x_winsys as err:
+                    self._failed(watch, err)
+
+    def _failed(self, watch, err):
+        """Stop watching a root whose read has failed or can't be issued and
+        report it, leaving the other roots as they are. The caller holds the lock.
+        """
+        if self._watches.get(watch.key) is watch:
+            self._keys.pop(self._key(watch.root), None)
+            self._drop(watch.key)
+        self._changes.append((watch.tag, self.ERROR, err, None))
+
+    def next(self):
+        while not self._changes:
+            if self._stopped:
+                raise StopIteration
+            rc, n_bytes, key, overlapped = wrapped(
+                win32file.GetQueuedCompletionStatus,
+                self._port,
+                self.TIMEOUT
+            )
+            if rc == winerror.WAIT_TIMEOUT and overlapped is None:
+                continue
+            with self._lock:
+                if key in self._closing:
+                    del self._closing[key]
+                    continue
+                watch = self._watches.get(key)
+                if watch is not None:
+                    watch.reading = False
+            if watch is None:
+                continue
+            if rc == winerror.ERROR_NOTIFY_ENUM_DIR:
+                n_bytes = 0
+            elif rc != 0:
+                with self._lock:
+                    self._failed(watch, x_fs(rc, "ReadDirectoryChangesW", win32api.FormatMessageW(rc).strip()))
+                continue
+            self._completed(watch, n_bytes)
+        return self._changes.popleft()
+    __next__ = next
+
+class ListingCache(core._WinSysObject):
+    """Hold the listings of directories beneath one or more roots so that
+    listing the same directory again -- via :meth:`Dir.entries` and so
+    :meth:`Dir.walk`, :func:`files` &c. -- needs no calls to the filesystem.
+    Each root is watched by a background thread (cf :func:`watch`) and each
+    change seen discards only the listings it affects, along with any metadata
+    held for the changed file by the stat cache (cf :func:`enable_stat_cache`).
+    If so many changes happen at once that some are lost, everything held for
+    that root is discarded.
+
+    Only listings of every entry in a directory, ie with the pattern "*",
+    are cached. Use :func:`enable_listing_cache` to have a process-wide cache.
+    """
+
+    def __init__(self, roots=()):
+        self.hits = self.misses = 0
+        self._listings = {}
+        self._roots = {}
+        self._lock = threading.Lock()
+        for root in roots:
+            self.add_root(root)
+
+    def as_string(self):
+        return "ListingCache of %d listings under %d roots" % (len(self._listings), len(self._roots))
+
+    def dumped(self, level=0):
+        output = []
+        output.append("roots:\n%s" % utils.dumped_list(self.roots(), level))
+        output.append("listings: %s" % len(self._listings))
+        output.append("hits: %s" % self.hits)
+        output.append("misses: %s" % self.misses)
+        return utils.dumped("\n".join(output), level)
+
+    @staticmethod
+    def _key(dirpath):
+        return normalised(dirpath or ".").rstrip(seps).lower()
+
+    def roots(self):
+        with self._lock:
+            return [watcher.root for (watcher, generation) in self._roots.values()]
+
+    def add_root(self, root):
+        """Start caching the listings of root and of every directory beneath it
+
+        :param root: anything accepted by :func:`dir`
+        :returns: this cache
+        """
+        root = dir(root)
+        key = self._key(root)
+        with self._lock:
+            if key in self._roots:
+                return self
+            watcher = _DirWatcher(unicode(root), subdirs=True)
+            self._roots[key] = [watcher, 0]
+        thread = threading.Thread(target=self._watch, args=(key, watcher))
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def remove_root(self, root):
+        """Stop watching root and discard all the listings held beneath it
+
+        :param root: anything accepted by :func:`dir`
+        :returns: this cache
+        """
+        key = self._key(root)
+        with self._lock:
+            watcher, generation = self._roots.pop(key, (None, None))
+            self._discard_beneath(key)
+        if watcher is not None:
+            watcher.stop()
+        return self
+
+    def stop(self):
+        """Stop watching every root and discard everything held
+        """
+        with self._lock:
+            watchers = [watcher for (watcher, generation) in self._roots.values()]
+            self._roots.clear()
+            self._listings.clear()
+        for watcher in watchers:
+            watcher.stop()
+
+    def _root_for(self, key):
+        for root_key, item in self._roots.items():
+            if key == root_key or key.startswith(root_key + sep):
+                return item
+
+    def get(self, dirpath):
+        """Return the raw FIND data held for dirpath, or :const:`None`
+        """
+        key = self._key(dirpath)
+        with self._lock:
+            file_infos = self._listings.get(key)
+            if file_infos is None:
+                if self._root_for(key):
+                    self.misses += 1
+            else:
+                self.hits += 1
+            return file_infos
+
+    def recording(self, dirpath):
+        """If dirpath is beneath a watched root, return a list to which the
+        raw FIND data should be appended as it is read and which should be
+        passed to :meth:`put` once the listing is complete. Otherwise
+        return :const:`None`.
+        """
+        with self._lock:
+            item = self._root_for(self._key(dirpath))
+            if item is None:
+                return None
+            else:
+                return _ListingRecording(item[1])
+
+    def put(self, dirpath, recording):
+        key = self._key(dirpath)
+        with self._lock:
+            #
+            # If anything has changed beneath this root since the listing
+            # started it may be out of date already, so don't keep it.
+            #
+            item = self._root_for(key)
+            if item is not None and item[1] == recording.generation:
+                self._listings[key] = list(recording)
+
+    def _discard_beneath(self, key):
+        prefix = key + sep
+        for listing_key in [k for k in self._listings if k == key or k.startswith(prefix)]:
+            del self._listings[listing_key]
+
+    def _changed(self, root_key, action, filename):
+        key = (root_key + sep + filename).lower()
+        with self._lock:
+            item = self._roots.get(root_key)
+            if item is None:
+                return
+            item[1] += 1
+            self._listings.pop(key.rsplit(sep, 1)[0], None)
+            if action in (FILE_ACTION.REMOVED, FILE_ACTION.RENAMED_OLD_NAME):
+                self._discard_beneath(key)
+        _invalidate(key, beneath=action in (FILE_ACTION.REMOVED, FILE_ACTION.RENAMED_OLD_NAME))
+        _invalidate(key + sep)
+
+    def _overflowed(self, root_key):
+        with self._lock:
+            item = self._roots.get(root_key)
+            if item is None:
+                return
+            item[1] += 1
+            self._discard_beneath(root_key)
+        if _stat_cache is not None:
+            _stat_cache.invalidate()
+
+    def _watch(self, root_key, watcher):
+        while True:
+            try:
+                raw_changes = watcher._raw_changes()
+            except x_fs:
+                raw_changes = None
+            if raw_changes is None:
+                break
+            elif not raw_changes:
+                core.warn("Changes lost under %s; discarding its listings", watcher.root)
+                self._overflowed(root_key)
+            else:
+                for action, filename in raw_changes:
+                    self._changed(root_key, action, filename)
+
+class _ListingRecording(list):
+    """The FIND data for one directory as it is read, remembering how
+    many changes had been seen under its root when reading started.
+    """
+
+    def __init__(self, generation):
+        list.__init__(self)
+        self.generation = generation
+
+_listing_cache = None
+
+def enable_listing_cache(roots=()):
+    """Start caching directory listings beneath roots across the whole process,
+    replacing any existing cache. The listings are kept up-to-date by watching
+    each root for changes::
+
+        from winsys import fs
+        cache = fs.enable_listing_cache(["c:/data"])
+        fs.enable_stat_cache()
+        while True:
+            for f in fs.dir("c:/data/incoming").files():
+                print(f, f.size)
+            time.sleep(5)
+
+    :param roots: an iterable of anything accepted by :func:`dir`
+    :returns: the new :class:`ListingCache`; use its :meth:`ListingCache.add_root`
+              to add more roots later
+    """
+    global _listing_cache
+    disable_listing_cache()
+    _listing_cache = ListingCache(roots)
+    return _listing_cache
+
+def disable_listing_cache():
+    """Stop caching directory listings, stopping the threads which watch
+    their roots
     """
-    return _DirWatcher(unicode(root), subdirs, watch_for, buffer_size, stop_event)
+    global _listing_cache
+    cache, _listing_cache = _listing_cache, None
+    if cache is not None:
+        cache.stop()
 
 if __name__ == '__main__':
     print("Watching", os.path.abspath("."))
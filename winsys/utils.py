@@ -7,6 +7,7 @@ from datetime import datetime, timedelta
 import re
 import struct
 import threading
+import time
 import winxpgui as win32gui
 
 from winsys._compat import *
@@ -38,6 +39,41 @@ def mask_as_list(mask, length=32):
 def _longword(lo, hi):
     return lo + (hi * 1 << 32)
 
+#
+# A FILETIME counts 100ns intervals since the start of 1601 (UTC)
+#
+FILETIME_EPOCH = datetime(1601, 1, 1)
+EPOCH_AS_FILETIME = 116444736000000000
+
+def filetime_from_pytime(pytime):
+    """Convert a pywintypes time to the integer value of the
+    corresponding FILETIME"""
+    if sys.version_info >= (3,):
+        offset = pytime.utcoffset() or timedelta(0)
+        delta = pytime.replace(tzinfo=None) - offset - FILETIME_EPOCH
+        return (delta.days * 86400 + delta.seconds) * 10000000 + delta.microseconds * 10
+    else:
+        return EPOCH_AS_FILETIME + int(pytime) * 10000000
+
+def filetime_from_datetime(moment):
+    """Convert a datetime to the integer value of the corresponding
+    FILETIME. A datetime without a timezone is taken to be local time."""
+    if moment.tzinfo is None:
+        timestamp = time.mktime(moment.timetuple())
+        return EPOCH_AS_FILETIME + int(timestamp) * 10000000 + moment.microsecond * 10
+    else:
+        return filetime_from_pytime(moment)
+
+if sys.version_info >= (3,):
+    from datetime import timezone
+    def from_filetime(filetime):
+        """Convert an integer FILETIME to the same kind of datetime
+        as :func:`from_pytime` returns"""
+        return (FILETIME_EPOCH + timedelta(microseconds=filetime // 10)).replace(tzinfo=timezone.utc)
+else:
+    def from_filetime(filetime):
+        return datetime.fromtimestamp((filetime - EPOCH_AS_FILETIME) // 10000000)
+
 def _set(obj, attr, value):
     obj.__dict__[attr] = value
 